@@ -1,14 +1,175 @@
-"""Admin interface of the portfolio app."""
+"""Admin interface of the portfolio app.
+
+Share prices and transactions may grow to millions of rows. Their foreign keys are therefore edited with raw id or
+autocomplete widgets instead of select boxes listing every row, changelists join the relations used by the string
+representations of their rows and large unfiltered changelists are paginated with an estimated row count.
+"""
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
+
+from portfolio.models import (
+    Asset, Bond, ExchangeRate, Fund, FundAllocation, Holding, Investment, Lot, Portfolio, PriceBar, RealizedGain,
+    SharePrice, Stock, Transaction,
+)
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator estimating the number of rows of large unfiltered tables.
+
+    Counting all rows of a large table requires a sequential scan on PostgreSQL. For unfiltered querysets the row
+    estimate of the query planner is used instead if it exceeds the threshold. Filtered querysets, small tables and
+    other databases are counted exactly.
+
+    :cvar threshold: minimum estimated number of rows for which the estimate is used
+    """
+
+    threshold = 10000
+
+    @cached_property
+    def count(self):
+        """Returns the (estimated) total number of objects.
+
+        :return: number of objects
+        """
+        queryset = self.object_list
+        connection = connections[getattr(queryset, 'db', 'default')]
+        if connection.vendor == 'postgresql' and hasattr(queryset, 'query') and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)',
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row is not None and row[0] >= self.threshold:
+                return int(row[0])
+        return super().count
+
+
+@admin.register(Portfolio)
+class PortfolioAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
+
+
+@admin.register(Asset)
+class AssetAdmin(admin.ModelAdmin):
+    list_display = ('name', 'isin', 'issuer', 'asset_type')
+    search_fields = ('name', '=isin', '=wkn', '=cusip')
+
+    def get_queryset(self, request):
+        # the asset changelist shows the class of each asset without a query per row
+        return super().get_queryset(request).polymorphic()
+
+    def asset_type(self, obj):
+        return obj._meta.verbose_name
+    asset_type.short_description = _('type')
+
+
+@admin.register(Fund)
+class FundAdmin(AssetAdmin):
+    list_display = ('name', 'isin', 'issuer', 'ter')
+
+
+@admin.register(Bond)
+class BondAdmin(AssetAdmin):
+    list_display = ('name', 'isin', 'issuer')
+    autocomplete_fields = ('funds',)
+
+
+@admin.register(Stock)
+class StockAdmin(AssetAdmin):
+    list_display = ('name', 'isin', 'issuer', 'sector')
+    autocomplete_fields = ('funds',)
+
+
+@admin.register(Investment)
+class InvestmentAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'portfolio', 'asset')
+    list_filter = ('portfolio',)
+    search_fields = ('asset__name', '=asset__isin', 'portfolio__name')
+    autocomplete_fields = ('portfolio', 'asset')
+
+    def get_queryset(self, request):
+        # also used by the autocomplete of transactions, which lists investments by their asset
+        return super().get_queryset(request).select_related('portfolio', 'asset')
+
+
+@admin.register(SharePrice)
+class SharePriceAdmin(admin.ModelAdmin):
+    list_display = ('asset', 'date', 'price')
+    list_select_related = ('asset',)
+    search_fields = ('=asset__isin', '=asset__wkn')
+    date_hierarchy = 'date'
+    autocomplete_fields = ('asset',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(PriceBar)
+class PriceBarAdmin(admin.ModelAdmin):
+    list_display = ('asset', 'resolution', 'period_start', 'open', 'high', 'low', 'close', 'currency')
+    list_select_related = ('asset',)
+    list_filter = ('resolution',)
+    search_fields = ('=asset__isin', '=asset__wkn')
+    date_hierarchy = 'period_start'
+    autocomplete_fields = ('asset',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Transaction)
+class TransactionAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'transaction_date', 'volume', 'share_price')
+    list_select_related = ('investment__asset', 'share_price')
+    list_filter = ('transaction_type',)
+    search_fields = ('=investment__asset__isin', '=investment__asset__wkn')
+    date_hierarchy = 'transaction_date'
+    autocomplete_fields = ('investment',)
+    raw_id_fields = ('share_price',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Holding)
+class HoldingAdmin(admin.ModelAdmin):
+    list_display = ('investment', 'volume', 'cost_basis', 'last_transaction_date')
+    list_select_related = ('investment__asset',)
+    search_fields = ('=investment__asset__isin', 'investment__asset__name')
+    raw_id_fields = ('investment',)
+
+
+@admin.register(Lot)
+class LotAdmin(admin.ModelAdmin):
+    list_display = ('investment', 'method', 'acquisition_date', 'volume', 'cost_basis')
+    list_select_related = ('investment__asset',)
+    list_filter = ('method',)
+    search_fields = ('=investment__asset__isin', 'investment__asset__name')
+    raw_id_fields = ('investment', 'transaction')
+
+
+@admin.register(RealizedGain)
+class RealizedGainAdmin(admin.ModelAdmin):
+    list_display = ('investment', 'method', 'date', 'acquisition_date', 'volume', 'proceeds', 'cost_basis')
+    list_select_related = ('investment__asset',)
+    list_filter = ('method',)
+    search_fields = ('=investment__asset__isin', 'investment__asset__name')
+    date_hierarchy = 'date'
+    raw_id_fields = ('investment', 'transaction')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
 
-from portfolio.models import Asset, Bond, Fund, Investment, Portfolio, SharePrice, Stock, Transaction
+@admin.register(FundAllocation)
+class FundAllocationAdmin(admin.ModelAdmin):
+    list_display = ('fund', 'asset', 'weight')
+    list_select_related = ('fund', 'asset')
+    search_fields = ('=fund__isin', 'fund__name')
+    autocomplete_fields = ('fund', 'asset')
 
 
-admin.site.register(Asset)
-admin.site.register(Bond)
-admin.site.register(Fund)
-admin.site.register(Investment)
-admin.site.register(Portfolio)
-admin.site.register(SharePrice)
-admin.site.register(Stock)
-admin.site.register(Transaction)
+@admin.register(ExchangeRate)
+class ExchangeRateAdmin(admin.ModelAdmin):
+    list_display = ('base_currency', 'quote_currency', 'date', 'rate')
+    list_filter = ('base_currency', 'quote_currency')
+    date_hierarchy = 'date'
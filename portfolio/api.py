@@ -0,0 +1,282 @@
+"""Read-only JSON API of the portfolio app.
+
+All endpoints return compact payloads: the column names are listed once in fields and every object is an array of
+values in the same order. Lists are paginated with keyset (cursor) pagination, so fetching a page costs the same
+regardless of its position. The opaque cursor of the next page is returned in next, which is null on the last page.
+
+Responses carry an ETag and a Last-Modified header derived from the version of the requested portfolio (see
+Portfolio.version). Clients sending the ETag in If-None-Match (or the date in If-Modified-Since) receive an empty 304
+response after a single query while the portfolio is unchanged.
+
+Price charts of single assets are served from the price bar rollups in a resolution fitting the requested period.
+"""
+import base64
+import binascii
+import datetime
+import hashlib
+import itertools
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, Q
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date
+from django.views import generic
+
+from portfolio.exports import filter_prices, merge_archived_prices
+from portfolio.models import Holding, Investment, Portfolio, PriceBar, Resolution
+
+
+def encode_cursor(key):
+    """Encodes the ordering key of the last object of a page as opaque cursor.
+
+    :param key: tuple of values of the ordering key
+    :return: the cursor
+    """
+    values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """Decodes a cursor created by encode_cursor.
+
+    :param cursor: the cursor
+    :param length: number of values of the ordering key
+    :return: list of values of the ordering key
+    :raises ValueError: if the cursor is malformed
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length or not all(
+            isinstance(value, (str, int, float)) for value in values):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def after(keys, values):
+    """Builds the condition selecting the objects following a key in lexicographic order.
+
+    :param keys: lookups of the ordering key
+    :param values: values of the ordering key
+    :return: Q object
+    """
+    condition = Q()
+    for i, key in enumerate(keys):
+        condition |= Q(**dict(zip(keys[:i], values[:i])), **{'{}__gt'.format(key): values[i]})
+    return condition
+
+
+class ApiView(generic.View):
+    """Base class of read-only JSON list endpoints with keyset pagination and conditional GET.
+
+    The query parameter limit selects the page size and cursor the page following a previous one.
+
+    :cvar fields: returned columns as (name, lookup) pairs
+    :cvar keys: lookups of the unique ordering key the pagination is based on
+    :cvar page_size: default number of objects per page
+    :cvar max_page_size: maximum number of objects per page
+    """
+
+    fields = ()
+    keys = ('id',)
+    page_size = 100
+    max_page_size = 1000
+
+    def get_queryset(self):
+        """Returns the objects of the endpoint.
+
+        :return: queryset of the listed model
+        """
+        raise NotImplementedError
+
+    def get_stamp(self):
+        """Returns the version stamp of the data of the endpoint.
+
+        :return: tuple of a string changing whenever the data changes and the time of the latest change or None
+        """
+        raise NotImplementedError
+
+    def get(self, request, **kwargs):
+        stamp, modified = self.get_stamp()
+        etag = '"{}"'.format(hashlib.md5('{}:{}'.format(stamp, request.get_full_path()).encode()).hexdigest())
+        last_modified = int(modified.timestamp()) if modified is not None else None
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            try:
+                response = self.get_page(request)
+            except ValueError as error:
+                return HttpResponseBadRequest(str(error))
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        # clients have to revalidate, which is cheap thanks to the ETag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def get_rows(self, queryset, lookups, cursor, count):
+        """Fetches the rows of a page.
+
+        :param queryset: objects of the endpoint
+        :param lookups: lookups of the values of each row
+        :param cursor: values of the ordering key the page follows or None for the first page
+        :param count: maximum number of rows
+        :return: list of tuples ordered by the ordering key
+        """
+        if cursor is not None:
+            queryset = queryset.filter(after(self.keys, cursor))
+        return list(queryset.order_by(*self.keys).values_list(*lookups)[:count])
+
+    def get_page(self, request):
+        """Renders a page of objects.
+
+        :param request: the request
+        :return: JSON response
+        :raises ValueError: if a query parameter is malformed
+        """
+        limit = int(request.GET.get('limit', self.page_size))
+        if not 0 < limit <= self.max_page_size:
+            raise ValueError('limit must be between 1 and {}'.format(self.max_page_size))
+        cursor = decode_cursor(request.GET['cursor'], len(self.keys)) if request.GET.get('cursor') else None
+        names = [name for name, _ in self.fields]
+        lookups = [lookup for _, lookup in self.fields]
+        lookups.extend(key for key in self.keys if key not in lookups)
+        positions = [lookups.index(key) for key in self.keys]
+        rows = self.get_rows(self.get_queryset(), lookups, cursor, limit + 1)
+
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = encode_cursor([rows[-1][position] for position in positions])
+        payload = {'fields': names, 'results': [row[:len(names)] for row in rows], 'next': cursor}
+        return HttpResponse(
+            json.dumps(payload, cls=DjangoJSONEncoder, separators=(',', ':')), content_type='application/json')
+
+
+class PortfolioListView(ApiView):
+    """Lists all portfolios including their versions."""
+
+    fields = (('id', 'id'), ('name', 'name'), ('version', 'version'), ('modified', 'modified'))
+
+    def get_queryset(self):
+        return Portfolio.objects.all()
+
+    def get_stamp(self):
+        stamp = Portfolio.objects.aggregate(count=Count('id'), modified=Max('modified'))
+        return '{count}:{modified}'.format(**stamp), stamp['modified']
+
+
+class PortfolioApiView(ApiView):
+    """Base class of endpoints listing data of a single portfolio, versioned by the portfolio's version."""
+
+    def get_stamp(self):
+        stamp = Portfolio.objects.filter(pk=self.kwargs['pk']).values_list('version', 'modified').first()
+        if stamp is None:
+            raise Http404('No portfolio found matching the query')
+        version, modified = stamp
+        return '{}:{}'.format(version, modified.isoformat()), modified
+
+
+class InvestmentListView(PortfolioApiView):
+    """Lists the investments of a portfolio."""
+
+    fields = (('id', 'id'), ('asset', 'asset_id'), ('isin', 'asset__isin'), ('name', 'asset__name'))
+
+    def get_queryset(self):
+        return Investment.objects.filter(portfolio=self.kwargs['pk'])
+
+
+class HoldingListView(PortfolioApiView):
+    """Lists the current holdings of the investments of a portfolio."""
+
+    fields = (
+        ('investment', 'investment_id'),
+        ('asset', 'investment__asset_id'),
+        ('volume', 'volume'),
+        ('cost_basis', 'cost_basis'),
+        ('last_transaction_date', 'last_transaction_date'),
+    )
+    keys = ('investment_id',)
+
+    def get_queryset(self):
+        return Holding.objects.filter(investment__portfolio=self.kwargs['pk'])
+
+
+class PriceListView(PortfolioApiView):
+    """Lists the share prices of the assets of a portfolio including archived prices.
+
+    The query parameter asset may be repeated to select assets, start and end restrict the date range (YYYY-MM-DD).
+    """
+
+    fields = (('asset', 'asset_id'), ('date', 'date'), ('price', 'price'), ('currency', 'price_currency'))
+    keys = ('asset_id', 'date')
+    page_size = 1000
+    max_page_size = 10000
+
+    def get_filters(self):
+        """Returns the filters of the listed prices.
+
+        :return: keyword arguments of filter_prices
+        :raises ValueError: if a query parameter is malformed
+        """
+        filters = {'portfolios': self.kwargs['pk']}
+        for name in ('start', 'end'):
+            if self.request.GET.get(name):
+                filters[name] = parse_date(self.request.GET[name])
+                if filters[name] is None:
+                    raise ValueError('Invalid {} date'.format(name))
+        filters['assets'] = [int(value) for value in self.request.GET.getlist('asset')] or None
+        return filters
+
+    def get_queryset(self):
+        return filter_prices(**self.get_filters())
+
+    def get_rows(self, queryset, lookups, cursor, count):
+        # limiting the rows of the database as well is safe, archived prices can only push them off the page
+        rows = super().get_rows(queryset, lookups, cursor, count)
+        if cursor is not None:
+            date = parse_datetime(cursor[1]) if isinstance(cursor[1], str) else None
+            if not isinstance(cursor[0], int) or date is None:
+                raise ValueError('Invalid cursor')
+            cursor = (cursor[0], date)
+        return list(itertools.islice(merge_archived_prices(rows, after=cursor, **self.get_filters()), count))
+
+
+class PriceChartView(generic.View):
+    """Returns open, high, low and close prices of an asset for charts.
+
+    The query parameters start and end (YYYY-MM-DD) select the charted days, by default the last year, and points the
+    maximum number of bars (default 500). Bars are read from the finest resolution of PriceBar fitting into points.
+
+    :cvar max_points: maximum number of bars which can be requested
+    """
+
+    max_points = 5000
+
+    def get(self, request, pk):
+        try:
+            end = parse_date(request.GET['end']) if 'end' in request.GET else timezone.localdate()
+            if end is None:
+                raise ValueError('Invalid end date')
+            start = parse_date(request.GET['start']) if 'start' in request.GET else end - datetime.timedelta(days=365)
+            if start is None:
+                raise ValueError('Invalid start date')
+            points = int(request.GET.get('points', 500))
+            if not 0 < points <= self.max_points:
+                raise ValueError('points must be between 1 and {}'.format(self.max_points))
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+
+        bars = PriceBar.objects.series(pk, start, end, points).values_list(
+            'period_start', 'open', 'high', 'low', 'close', 'currency')
+        payload = {
+            'resolution': Resolution.choose(start, end, points),
+            'fields': ['date', 'open', 'high', 'low', 'close', 'currency'],
+            'results': list(bars),
+        }
+        return HttpResponse(
+            json.dumps(payload, cls=DjangoJSONEncoder, separators=(',', ':')), content_type='application/json')
@@ -11,3 +11,7 @@ class PortfolioConfig(AppConfig):
     """
 
     name = 'portfolio'
+
+    def ready(self):
+        """Connects the signal receivers of the portfolio app."""
+        from portfolio import signals  # noqa: F401
@@ -0,0 +1,373 @@
+"""Columnar archive of old share prices.
+
+Old share prices are rarely changed and mostly read in bulk by valuations and return calculations over long periods.
+archive_prices moves prices before a cutoff from the SharePrice table into one file per asset, which holds the dates
+(microseconds since the epoch, UTC if time zone support is active), the prices and the currency codes as three fixed
+width columns. The columns are memory-mapped on read, so long price histories are sliced without copying them.
+
+The latest price of each asset before the cutoff and all prices referenced by transactions stay in the database. Thus
+the transaction ledger and SharePrice.objects.as_of for dates from the cutoff on keep working on the database alone,
+and price bars aren't touched as they already contain the archived prices. SharePrice.objects.as_of for earlier dates
+misses the archived prices and returns an older price still in the database.
+
+price_history, merge_rows and latest_prices read the archive and the database together. Database rows win over
+archived prices of the same asset and date, e.g. prices imported again after they were archived. Valuations, the price
+cache, price bars, price exports and the price API read prices through them.
+
+The archive is configured by the optional setting PORTFOLIO_PRICE_ARCHIVE, a dictionary with the key DIRECTORY (path
+of the archive files). Without it, prices can't be archived and all prices are read from the database.
+"""
+import datetime
+import decimal
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+from portfolio.models import Asset, Portfolio, SharePrice
+from portfolio.utils import day_start, to_datetime64
+
+# magic number and row count preceding the columns of every file
+_HEADER = struct.Struct('<8sQ')
+_MAGIC = b'PRICES01'
+_DATE = np.dtype('<M8[us]')
+_PRICE = np.dtype('<f8')
+_CURRENCY = np.dtype('S3')
+
+
+def _datetime(value):
+    """Converts an archived date back into a datetime.
+
+    :param value: datetime64 as stored in the archive
+    :return: datetime, aware if time zone support is active
+    """
+    value = value.astype(_DATE).item()
+    return timezone.make_aware(value, datetime.timezone.utc) if settings.USE_TZ else value
+
+
+class PriceSeries:
+    """Share prices of a single asset ordered by date.
+
+    :ivar dates: array of datetime64 in microseconds
+    :ivar prices: array of prices as floats
+    :ivar currencies: array of currency codes as bytes
+    """
+
+    __slots__ = ('dates', 'prices', 'currencies')
+
+    def __init__(self, dates, prices, currencies):
+        self.dates = dates
+        self.prices = prices
+        self.currencies = currencies
+
+    def __len__(self):
+        return len(self.dates)
+
+    @classmethod
+    def empty(cls):
+        """Returns a series without prices."""
+        return cls(np.zeros(0, _DATE), np.zeros(0, _PRICE), np.zeros(0, _CURRENCY))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Creates a series from share price rows.
+
+        :param rows: sequence of (date, amount, currency) tuples
+        :return: the series
+        """
+        if not rows:
+            return cls.empty()
+        dates, amounts, currencies = zip(*rows)
+        return cls(np.array([to_datetime64(date) for date in dates], dtype=_DATE), np.array(amounts, dtype=_PRICE),
+                   np.array(currencies, dtype=_CURRENCY))
+
+    def merge(self, other):
+        """Merges the prices of two series, prices of other replace prices of this series at the same date.
+
+        :param other: PriceSeries
+        :return: new series ordered by date
+        """
+        dates = np.concatenate([self.dates, other.dates])
+        order = np.argsort(dates, kind='stable')
+        dates = dates[order]
+        # of several prices at the same date the last one, i.e. the one of other, is kept
+        keep = np.append(dates[1:] != dates[:-1], True)
+        order = order[keep]
+        return PriceSeries(dates[keep], np.concatenate([self.prices, other.prices])[order],
+                           np.concatenate([self.currencies, other.currencies])[order])
+
+    def between(self, start=None, end=None):
+        """Returns the prices between two dates including the latest price before start.
+
+        :param start: datetime64 or None for all prices before end
+        :param end: datetime64 (exclusive) or None for all prices after start
+        :return: series sharing the arrays of this series
+        """
+        first = 0 if start is None else max(np.searchsorted(self.dates, start, side='left') - 1, 0)
+        last = len(self.dates) if end is None else np.searchsorted(self.dates, end, side='left')
+        return PriceSeries(self.dates[first:last], self.prices[first:last], self.currencies[first:last])
+
+
+class PriceArchive:
+    """Archive storing the share prices of every asset in a separate file.
+
+    Each file starts with a header holding a magic number and the number of rows n, followed by n dates, n prices and
+    n currency codes. Files are replaced atomically, so readers never see partially written files.
+
+    :ivar directory: path of the directory containing the files
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, asset_id):
+        """Returns the path of the file of an asset.
+
+        :param asset_id: id of the asset
+        :return: the path
+        """
+        return os.path.join(self.directory, '{}.prices'.format(asset_id))
+
+    def asset_ids(self):
+        """Returns the ids of all assets with archived prices.
+
+        :return: sorted list of asset ids
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name[:-len('.prices')]) for name in os.listdir(self.directory)
+                      if name.endswith('.prices') and name[:-len('.prices')].isdigit())
+
+    def read(self, asset_id):
+        """Memory-maps the archived prices of an asset.
+
+        :param asset_id: id of the asset
+        :return: PriceSeries backed by the file, empty if no prices of the asset are archived
+        """
+        path = self.path(asset_id)
+        try:
+            with open(path, 'rb') as file:
+                magic, count = _HEADER.unpack(file.read(_HEADER.size))
+        except FileNotFoundError:
+            return PriceSeries.empty()
+        if magic != _MAGIC:
+            raise ValueError('{} is not a price archive'.format(path))
+        if not count:
+            return PriceSeries.empty()
+        offset = _HEADER.size
+        columns = []
+        for dtype in (_DATE, _PRICE, _CURRENCY):
+            columns.append(np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)))
+            offset += dtype.itemsize * count
+        return PriceSeries(*columns)
+
+    def write(self, asset_id, series):
+        """Replaces the archived prices of an asset.
+
+        :param asset_id: id of the asset
+        :param series: PriceSeries ordered by date
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(_HEADER.pack(_MAGIC, len(series)))
+                for column, dtype in ((series.dates, _DATE), (series.prices, _PRICE),
+                                      (series.currencies, _CURRENCY)):
+                    file.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+            os.replace(temporary, self.path(asset_id))
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def append(self, asset_id, series):
+        """Adds prices to the archive of an asset, replacing archived prices at the same dates.
+
+        :param asset_id: id of the asset
+        :param series: PriceSeries
+        """
+        self.write(asset_id, self.read(asset_id).merge(series))
+
+    def delete(self, asset_id):
+        """Removes all archived prices of an asset.
+
+        :param asset_id: id of the asset
+        """
+        try:
+            os.remove(self.path(asset_id))
+        except FileNotFoundError:
+            pass
+
+
+def get_archive():
+    """Returns the archive configured by the setting PORTFOLIO_PRICE_ARCHIVE.
+
+    :return: PriceArchive or None if no archive is configured
+    """
+    directory = getattr(settings, 'PORTFOLIO_PRICE_ARCHIVE', {}).get('DIRECTORY')
+    return PriceArchive(directory) if directory else None
+
+
+def archive_prices(before, assets=None, archive=None):
+    """Moves share prices before a cutoff from the database into the archive.
+
+    The prices of each asset are written to the archive before they are deleted in one transaction, so a failure
+    leaves them in the database, at worst in addition to the archive. Prices are deleted without sending signals, as
+    the price bars, which include archived prices, must not be rebuilt. The price cache of each asset is invalidated
+    and its portfolios are touched explicitly instead.
+
+    :param before: datetime, prices before it are archived
+    :param assets: collection of asset ids, defaults to all assets
+    :param archive: PriceArchive, defaults to the configured archive
+    :return: number of archived prices
+    """
+    from portfolio.price_cache import get_price_cache  # the price cache reads the archive
+
+    archive = archive or get_archive()
+    if archive is None:
+        raise ImproperlyConfigured('The setting PORTFOLIO_PRICE_ARCHIVE has no DIRECTORY.')
+    if assets is None:
+        assets = Asset.objects.values('pk')
+    latest = SharePrice.objects.as_of(assets, before - datetime.timedelta(microseconds=1)).values('pk')
+    candidates = SharePrice.objects.filter(
+        asset__in=assets, date__lt=before, transaction__isnull=True,
+    ).exclude(pk__in=latest)
+
+    count = 0
+    for asset_id in candidates.order_by('asset_id').values_list('asset_id', flat=True).distinct():
+        with transaction.atomic():
+            rows = list(candidates.filter(asset=asset_id).order_by('date').values_list(
+                'pk', 'date', 'price', 'price_currency'))
+            if not rows:
+                continue
+            archive.append(asset_id, PriceSeries.from_rows([row[1:] for row in rows]))
+            ids = [row[0] for row in rows]
+            for first in range(0, len(ids), 500):
+                # A single DELETE without collecting the prices: the only foreign key to share prices is the protected
+                # one of transactions, which the candidates exclude, and the post_delete receivers would rebuild the
+                # price bars from the database alone, dropping the archived prices. The caches are invalidated below.
+                SharePrice.objects.filter(pk__in=ids[first:first + 500])._raw_delete(SharePrice.objects.db)
+            get_price_cache().invalidate(asset_id)
+            Portfolio.objects.filter(investment__asset=asset_id).touch()
+            count += len(rows)
+    return count
+
+
+def price_history(asset_ids, start=None, end=None, archive=None):
+    """Returns the share prices of assets from the archive and the database with at most two queries.
+
+    Series only read from the archive share the memory-mapped arrays of the archive files.
+
+    :param asset_ids: collection of asset ids
+    :param start: datetime, each series starts with the latest price before it, by default all prices are returned
+    :param end: datetime, prices from it on are omitted, by default all prices after start are returned
+    :param archive: PriceArchive, defaults to the configured archive
+    :return: dictionary mapping asset ids to PriceSeries ordered by date, assets without prices are omitted
+    """
+    archive = archive or get_archive()
+    asset_ids = list(asset_ids)
+    live = {asset_id: [] for asset_id in asset_ids}
+    prices = SharePrice.objects.filter(asset__in=asset_ids)
+    if start is not None:
+        initial = SharePrice.objects.as_of(asset_ids, start - datetime.timedelta(microseconds=1))
+        for asset_id, date, price, currency in initial.values_list('asset_id', 'date', 'price', 'price_currency'):
+            live[asset_id].append((date, price, currency))
+        prices = prices.filter(date__gte=start)
+    if end is not None:
+        prices = prices.filter(date__lt=end)
+    rows = prices.order_by('asset_id', 'date').values_list('asset_id', 'date', 'price', 'price_currency')
+    for asset_id, date, price, currency in rows.iterator():
+        live[asset_id].append((date, price, currency))
+
+    start = None if start is None else to_datetime64(start)
+    end = None if end is None else to_datetime64(end)
+    history = {}
+    for asset_id, rows in live.items():
+        series = PriceSeries.from_rows(rows)
+        if archive is not None:
+            archived = archive.read(asset_id).between(start, end)
+            if len(archived):
+                series = archived.merge(series).between(start) if len(series) else archived
+        if len(series):
+            history[asset_id] = series
+    return history
+
+
+def latest_prices(asset_ids, date, archive=None):
+    """Returns the latest share price of each asset on or before a date from the archive and the database.
+
+    The prices in the database are fetched with a single query (see SharePrice.objects.as_of) and replaced by later
+    archived prices.
+
+    :param asset_ids: collection of asset ids
+    :param date: date or datetime, dates include all prices of that day
+    :param archive: PriceArchive, defaults to the configured archive
+    :return: dictionary mapping asset ids to (amount, currency) tuples, amounts are decimals, assets without price are
+        omitted
+    """
+    archive = archive or get_archive()
+    asset_ids = list(asset_ids)
+    latest = {
+        asset_id: (price_date, amount, currency)
+        for asset_id, price_date, amount, currency in SharePrice.objects.as_of(asset_ids, date).values_list(
+            'asset_id', 'date', 'price', 'price_currency')
+    }
+    if archive is not None:
+        if isinstance(date, datetime.datetime):
+            bound, side = to_datetime64(date), 'right'
+        else:
+            bound, side = to_datetime64(day_start(date + datetime.timedelta(days=1))), 'left'
+        for asset_id in asset_ids:
+            series = archive.read(asset_id)
+            index = np.searchsorted(series.dates, bound, side=side) - 1
+            if index < 0:
+                continue
+            archived = _datetime(series.dates[index])
+            if asset_id not in latest or archived > latest[asset_id][0]:
+                latest[asset_id] = (archived, decimal.Decimal(repr(series.prices[index].item())),
+                                    series.currencies[index].decode())
+    return {asset_id: (amount, currency) for asset_id, (_, amount, currency) in latest.items()}
+
+
+def merge_rows(rows, assets=None, start=None, end=None, archive=None):
+    """Merges archived prices into a stream of share price rows.
+
+    :param rows: iterable of (asset id, date, amount, currency) tuples from the database ordered by asset and date
+    :param assets: collection of ids of the assets whose archived prices are merged, defaults to all archived assets
+    :param start: datetime, archived prices before it are omitted
+    :param end: datetime, archived prices from it on are omitted
+    :param archive: PriceArchive, defaults to the configured archive
+    :return: generator yielding (asset id, date, amount, currency) tuples ordered by asset and date, amounts are
+        decimals
+    """
+    archive = archive or get_archive()
+    if archive is None:
+        yield from rows
+        return
+    # missing files are read as empty series, so listing the directory is only required for all assets
+    asset_ids = archive.asset_ids() if assets is None else sorted(set(assets))
+    start = None if start is None else to_datetime64(start)
+    end = None if end is None else to_datetime64(end)
+
+    def archived():
+        for asset_id in asset_ids:
+            series = archive.read(asset_id)
+            first = 0 if start is None else np.searchsorted(series.dates, start, side='left')
+            last = len(series) if end is None else np.searchsorted(series.dates, end, side='left')
+            for date, price, currency in zip(series.dates[first:last], series.prices[first:last].tolist(),
+                                             series.currencies[first:last].tolist()):
+                yield (asset_id, _datetime(date), decimal.Decimal(repr(price)), currency.decode())
+
+    # archived rows precede database rows of the same asset and date, only the last of those is kept
+    merged = heapq.merge(archived(), rows, key=lambda row: (row[0], row[1]))
+    for _, group in itertools.groupby(merged, key=lambda row: (row[0], row[1])):
+        *_, row = group
+        yield row
@@ -0,0 +1,259 @@
+"""Benchmarks of the performance critical paths of the portfolio app.
+
+Every benchmark performs one operation against the data in the database, e.g. data created by
+portfolio.synthetic.SyntheticData. The runner executes each benchmark once to count its queries and warm up caches and
+then measures the duration of repeated executions. Results are plain dictionaries which can be serialized to JSON and
+compared with the results of a previous run (see the benchmark management command).
+"""
+import collections
+import datetime
+import statistics
+import time
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Max
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from portfolio.importers import ImportMode, PriceImporter, PriceRecord
+from portfolio.lots import realized_gains
+from portfolio.models import Asset, Portfolio, PriceBar, SharePrice
+from portfolio.price_cache import get_price_cache
+from portfolio.returns import compute_returns
+from portfolio.simulation import Universe
+from portfolio.utils import day_start, local_date
+from portfolio.valuation import value_history, value_portfolios
+from portfolio.views import IndexView
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    """Registers a function as benchmark.
+
+    :param name: unique name of the benchmark
+    :return: decorator registering the function, which is called with a Fixture
+    """
+    def decorator(function):
+        BENCHMARKS[name] = function
+        return function
+    return decorator
+
+
+class Fixture:
+    """Data shared by all benchmarks of a run.
+
+    :ivar portfolio_ids: ids of all portfolios
+    :ivar asset_ids: ids of all assets
+    :ivar date: date of the latest share price
+    :ivar user: superuser accessing the admin
+    :ivar factory: factory of requests
+    """
+
+    def __init__(self, portfolio_ids, asset_ids, date, user):
+        self.portfolio_ids = portfolio_ids
+        self.asset_ids = asset_ids
+        self.date = date
+        self.user = user
+        self.factory = RequestFactory()
+
+    @classmethod
+    def load(cls):
+        """Loads the fixture from the database, creating the benchmark superuser if necessary.
+
+        :return: the fixture
+        """
+        latest = SharePrice.objects.aggregate(latest=Max('date'))['latest'] or timezone.now()
+        user = User.objects.filter(username='benchmark').first() or User.objects.create_superuser(
+            'benchmark', 'benchmark@example.com', None)
+        return cls(
+            list(Portfolio.objects.values_list('id', flat=True)), list(Asset.objects.values_list('id', flat=True)),
+            local_date(latest), user)
+
+    def get(self, path, **parameters):
+        """Creates a GET request of the benchmark user.
+
+        :param path: requested path
+        :param parameters: query parameters
+        :return: the request
+        """
+        request = self.factory.get(path, parameters)
+        request.user = self.user
+        return request
+
+
+def _render(view, request):
+    """Calls a view and renders its response.
+
+    :param view: view function
+    :param request: the request
+    :return: the rendered response
+    """
+    response = view(request)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+@benchmark('index_view_cold')
+def index_view_cold(fixture):
+    get_price_cache().clear()
+    _render(IndexView.as_view(), fixture.get('/'))
+
+
+@benchmark('index_view_warm')
+def index_view_warm(fixture):
+    _render(IndexView.as_view(), fixture.get('/'))
+
+
+@benchmark('index_view_last_page')
+def index_view_last_page(fixture):
+    _render(IndexView.as_view(), fixture.get('/', page='last'))
+
+
+@benchmark('price_as_of')
+def price_as_of(fixture):
+    list(SharePrice.objects.as_of(fixture.asset_ids, fixture.date).values_list('asset_id', 'price'))
+
+
+@benchmark('price_cache')
+def price_cache(fixture):
+    get_price_cache().get_prices(fixture.asset_ids, fixture.date)
+
+
+@benchmark('price_chart')
+def price_chart(fixture):
+    for asset_id in fixture.asset_ids[:10]:
+        list(PriceBar.objects.series(asset_id, fixture.date - datetime.timedelta(days=3650), fixture.date).values_list(
+            'period_start', 'close'))
+
+
+@benchmark('bulk_import')
+def bulk_import(fixture):
+    # prices of the following 20 days of all assets, rolled back to keep the data unchanged
+    records = [
+        PriceRecord(isin, day_start(fixture.date + datetime.timedelta(days=day)), 100, 'EUR')
+        for isin in Asset.objects.filter(pk__in=fixture.asset_ids).values_list('isin', flat=True)
+        for day in range(1, 21)
+    ]
+    with transaction.atomic():
+        PriceImporter(mode=ImportMode.SKIP).run(records)
+        transaction.set_rollback(True)
+
+
+@benchmark('valuation')
+def valuation(fixture):
+    value_portfolios(fixture.portfolio_ids, fixture.date).by_portfolio()
+
+
+@benchmark('value_history')
+def valuation_history(fixture):
+    value_history(fixture.portfolio_ids, fixture.date - datetime.timedelta(days=365), fixture.date).by_portfolio()
+
+
+@benchmark('returns')
+def returns(fixture):
+    compute_returns(fixture.portfolio_ids, [(fixture.date - datetime.timedelta(days=365), fixture.date)])
+
+
+@benchmark('realized_gains')
+def realized_gains_of_year(fixture):
+    # the first execution replays all ledgers, the measured ones only check for new transactions
+    realized_gains(fixture.portfolio_ids, fixture.date - datetime.timedelta(days=365), fixture.date)
+
+
+@benchmark('rebalancing')
+def rebalancing(fixture):
+    # 1000 threshold bands of a monthly schedule and 10000 random trade sets of the first portfolio
+    universe = Universe.load(fixture.portfolio_ids[:1], fixture.date - datetime.timedelta(days=365), fixture.date)
+    if not len(universe.asset_ids):
+        return
+    target = dict.fromkeys(universe.groups, 1)
+    universe.simulate(target, ['monthly'] * 1000, thresholds=np.linspace(0, 0.5, 1000))
+    trades = np.random.RandomState(0).normal(size=(10000, len(universe.asset_ids)))
+    universe.evaluate_trades(trades, target=target)
+
+
+def _admin(fixture, name):
+    path = reverse(name)
+    _render(resolve(path).func, fixture.get(path))
+
+
+@benchmark('admin_transaction_changelist')
+def admin_transaction_changelist(fixture):
+    _admin(fixture, 'admin:portfolio_transaction_changelist')
+
+
+@benchmark('admin_shareprice_changelist')
+def admin_shareprice_changelist(fixture):
+    _admin(fixture, 'admin:portfolio_shareprice_changelist')
+
+
+@benchmark('admin_transaction_add')
+def admin_transaction_add(fixture):
+    _admin(fixture, 'admin:portfolio_transaction_add')
+
+
+def run_benchmarks(names=None, repeat=5):
+    """Runs benchmarks against the data in the database.
+
+    :param names: names of the benchmarks to run, defaults to all benchmarks
+    :param repeat: number of measured executions of each benchmark
+    :return: list of dictionaries with the keys name, queries, repeat, min, median, mean and max, durations are
+        given in seconds
+    """
+    names = list(BENCHMARKS) if names is None else names
+    unknown = set(names).difference(BENCHMARKS)
+    if unknown:
+        raise ValueError('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+    fixture = Fixture.load()
+    results = []
+    for name in names:
+        function = BENCHMARKS[name]
+        with CaptureQueriesContext(connection) as queries:
+            function(fixture)
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(fixture)
+            durations.append(time.perf_counter() - start)
+        results.append({
+            'name': name,
+            'queries': len(queries),
+            'repeat': repeat,
+            'min': min(durations),
+            'median': statistics.median(durations),
+            'mean': statistics.mean(durations),
+            'max': max(durations),
+        })
+    return results
+
+
+def compare(results, baseline, max_slowdown=1.5):
+    """Compares benchmark results with the results of a previous run.
+
+    :param results: list of results of run_benchmarks
+    :param baseline: list of results of a previous run
+    :param max_slowdown: maximum tolerated ratio of the median durations
+    :return: list of dictionaries with the keys name, ratio, queries, baseline_queries and regression for all
+        benchmarks contained in both runs
+    """
+    previous = {result['name']: result for result in baseline}
+    comparison = []
+    for result in results:
+        if result['name'] not in previous:
+            continue
+        old = previous[result['name']]
+        ratio = result['median'] / old['median'] if old['median'] else float('inf')
+        comparison.append({
+            'name': result['name'],
+            'ratio': ratio,
+            'queries': result['queries'],
+            'baseline_queries': old['queries'],
+            'regression': ratio > max_slowdown or result['queries'] > old['queries'],
+        })
+    return comparison
@@ -0,0 +1,137 @@
+"""Concurrent computation of portfolio summaries for the dashboard.
+
+Every portfolio is valued and its returns over the last year are computed in a bounded pool of threads, each using its
+own database connection. Summaries are yielded as soon as they are complete, so a streaming response sends them while
+slower portfolios are still computed and the latency is bounded by the slowest portfolio instead of the sum of all.
+Portfolios exceeding the timeout are reported as timed out. Their threads can't be interrupted and finish in the
+background, but the caller doesn't wait for them.
+
+The dashboard is configured by the optional setting PORTFOLIO_DASHBOARD, a dictionary with the keys WORKERS (maximum
+number of threads per request) and TIMEOUT (seconds per portfolio).
+"""
+import concurrent.futures
+import datetime
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from portfolio.models import Portfolio
+from portfolio.returns import compute_returns
+from portfolio.utils import local_date, object_ids
+from portfolio.valuation import value_portfolios
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'WORKERS': 4,
+    'TIMEOUT': 10.0,
+}
+
+
+def get_options():
+    """Returns the dashboard options merged with their defaults.
+
+    :return: dictionary of options
+    """
+    return dict(DEFAULTS, **getattr(settings, 'PORTFOLIO_DASHBOARD', {}))
+
+
+def _number(value):
+    """Converts a NumPy scalar into a float, NaN into None."""
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def summarize(portfolio_id, date, currency=None):
+    """Computes the key figures of a single portfolio.
+
+    :param portfolio_id: id of the portfolio
+    :param date: datetime of the valuation
+    :param currency: currency code all amounts are converted to, by default amounts are not converted
+    :return: dictionary with the keys market_value, cost_basis, gain, twr and xirr, the returns cover the last year
+    """
+    totals = value_portfolios([portfolio_id], date, currency).by_portfolio().get(
+        portfolio_id, {'cost_basis': 0.0, 'market_value': 0.0})
+    end = local_date(date)
+    returns = compute_returns([portfolio_id], [(end - datetime.timedelta(days=365), end)], currency=currency)
+    has_returns = bool(returns.ids)
+    return {
+        'market_value': _number(totals['market_value']),
+        'cost_basis': _number(totals['cost_basis']),
+        'gain': _number(totals['market_value'] - totals['cost_basis']),
+        'twr': _number(returns.twr[0, 0]) if has_returns else None,
+        'xirr': _number(returns.xirr[0, 0]) if has_returns else None,
+    }
+
+
+def _summarize(portfolio_id, date, currency, started):
+    """Summarizes a portfolio in a worker thread, recording its start and closing the thread's connections."""
+    started[portfolio_id] = time.monotonic()
+    try:
+        return summarize(portfolio_id, date, currency)
+    finally:
+        connections.close_all()
+
+
+def iter_summaries(portfolios=None, date=None, currency=None, workers=None, timeout=None):
+    """Summarizes portfolios concurrently and yields each summary once it is complete.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them, defaults to all portfolios
+    :param date: date or datetime of the valuation, defaults to now
+    :param currency: currency code all amounts are converted to, by default amounts are not converted
+    :param workers: maximum number of threads, defaults to the WORKERS option
+    :param timeout: seconds a single portfolio may take, defaults to the TIMEOUT option
+    :return: generator yielding dictionaries with the keys id, name and status (ok, timeout or error), those of
+        successful summaries additionally contain the key figures returned by summarize
+    """
+    options = get_options()
+    workers = workers or options['WORKERS']
+    timeout = timeout if timeout is not None else options['TIMEOUT']
+    date = date or timezone.now()
+    queryset = Portfolio.objects.all()
+    if portfolios is not None:
+        queryset = queryset.filter(pk__in=object_ids(portfolios))
+    names = dict(queryset.order_by('name', 'pk').values_list('pk', 'name'))
+    if not names:
+        return
+
+    started = {}
+    workers = min(workers, len(names))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = {
+        executor.submit(_summarize, portfolio_id, date, currency, started): portfolio_id for portfolio_id in names}
+    # portfolios waiting for a free thread must have started once every thread had enough time for its share
+    latest_start = time.monotonic() + timeout * (math.ceil(len(names) / workers) - 1)
+
+    def deadline(future):
+        portfolio_id = futures[future]
+        return started[portfolio_id] + timeout if portfolio_id in started else latest_start + timeout
+
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=max(min(map(deadline, pending)) - time.monotonic(), 0),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                portfolio_id = futures[future]
+                summary = {'id': portfolio_id, 'name': names[portfolio_id]}
+                try:
+                    summary.update(future.result(), status='ok')
+                except Exception as error:
+                    logger.exception('Summary of portfolio %s failed', portfolio_id)
+                    summary.update(status='error', error=str(error))
+                yield summary
+            now = time.monotonic()
+            for future in [future for future in pending if deadline(future) <= now and not future.done()]:
+                pending.remove(future)
+                future.cancel()
+                yield {'id': futures[future], 'name': names[futures[future]], 'status': 'timeout'}
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,253 @@
+"""Streaming exports of transactions and share price histories.
+
+Rows are fetched as tuples with iterator(), which uses server-side cursors on PostgreSQL, and serialized incrementally
+to CSV or JSON. The exported data is never held in memory as a whole, so exports of any size are produced with
+constant memory by the export views as well as by the export_data management command.
+
+Price exports use the columns isin, date, price and currency and can be imported again with portfolio.importers.
+They include the prices moved to the archive (see portfolio.archive), which are merged into the rows of the database.
+"""
+import csv
+import datetime
+import itertools
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from portfolio.archive import get_archive, merge_rows
+from portfolio.models import Asset, Investment, SharePrice, Transaction
+from portfolio.utils import day_start, object_ids
+
+EXPORT_FORMATS = ('csv', 'json')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'json': 'application/json',
+}
+
+# exported columns as (name, lookup) pairs
+TRANSACTION_FIELDS = (
+    ('id', 'id'),
+    ('portfolio', 'investment__portfolio_id'),
+    ('investment', 'investment_id'),
+    ('isin', 'investment__asset__isin'),
+    ('type', 'transaction_type'),
+    ('date', 'transaction_date'),
+    ('volume', 'volume'),
+    ('price', 'share_price__price'),
+    ('currency', 'share_price__price_currency'),
+    ('exchange_rate', 'exchange_rate'),
+)
+PRICE_FIELDS = (
+    ('isin', 'asset__isin'),
+    ('date', 'date'),
+    ('price', 'price'),
+    ('currency', 'price_currency'),
+)
+
+
+class _Echo:
+    """File-like object returning written values instead of storing them, used to serialize single CSV rows."""
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    """Converts a value into its CSV representation.
+
+    :param value: value of an exported column
+    :return: the value to write
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+
+def _join(lines, rows_per_chunk):
+    """Concatenates serialized rows to chunks, avoiding a separate write for every row.
+
+    :param lines: iterable of strings
+    :param rows_per_chunk: number of strings per chunk
+    :return: generator yielding strings
+    """
+    lines = iter(lines)
+    while True:
+        chunk = ''.join(itertools.islice(lines, rows_per_chunk))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_csv(names, rows, rows_per_chunk=500):
+    """Serializes rows to CSV incrementally.
+
+    :param names: column names written as header
+    :param rows: iterable of tuples
+    :param rows_per_chunk: number of rows per yielded chunk
+    :return: generator yielding chunks of CSV data
+    """
+    writer = csv.writer(_Echo())
+    lines = itertools.chain(
+        [writer.writerow(names)], (writer.writerow([_csv_value(value) for value in row]) for row in rows))
+    return _join(lines, rows_per_chunk)
+
+
+def iter_json(names, rows, rows_per_chunk=500):
+    """Serializes rows to a JSON array of objects incrementally.
+
+    :param names: keys of the objects
+    :param rows: iterable of tuples
+    :param rows_per_chunk: number of rows per yielded chunk
+    :return: generator yielding chunks of JSON data
+    """
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    objects = (encoder.encode(dict(zip(names, row))) for row in rows)
+    lines = itertools.chain(
+        ['['], (('\n' if index == 0 else ',\n') + value for index, value in enumerate(objects)), ['\n]\n'])
+    return _join(lines, rows_per_chunk)
+
+
+def serialize(names, rows, file_format='csv'):
+    """Serializes rows to CSV or JSON incrementally.
+
+    :param names: column names
+    :param rows: iterable of tuples
+    :param file_format: either 'csv' or 'json'
+    :return: generator yielding chunks of serialized data
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format: {}'.format(file_format))
+    serializer = iter_csv if file_format == 'csv' else iter_json
+    return serializer(names, rows)
+
+
+def export(queryset, fields, file_format='csv', chunk_size=2000):
+    """Streams the rows of a queryset as CSV or JSON.
+
+    :param queryset: queryset of the exported model
+    :param fields: exported columns as (name, lookup) pairs
+    :param file_format: either 'csv' or 'json'
+    :param chunk_size: number of rows fetched from the database at once
+    :return: generator yielding chunks of serialized data
+    """
+    rows = queryset.values_list(*[lookup for _, lookup in fields]).iterator(chunk_size=chunk_size)
+    return serialize([name for name, _ in fields], rows, file_format)
+
+
+def filter_transactions(portfolios=None, assets=None, start=None, end=None):
+    """Selects transactions ordered by their date.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them, None for all portfolios
+    :param assets: asset, asset id or collection / queryset of them, None for all assets
+    :param start: first transaction date or None
+    :param end: last transaction date or None
+    :return: queryset of transactions
+    """
+    queryset = Transaction.objects.all()
+    if portfolios is not None:
+        queryset = queryset.filter(investment__portfolio__in=object_ids(portfolios))
+    if assets is not None:
+        queryset = queryset.filter(investment__asset__in=object_ids(assets))
+    if start is not None:
+        queryset = queryset.filter(transaction_date__gte=start)
+    if end is not None:
+        queryset = queryset.filter(transaction_date__lte=end)
+    return queryset.order_by('transaction_date', 'id')
+
+
+def _price_assets(portfolios=None, assets=None):
+    """Selects the assets whose share prices are exported.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them, None for all portfolios
+    :param assets: asset, asset id or collection / queryset of them, None for all assets
+    :return: queryset of asset ids or None for all assets
+    """
+    if portfolios is None and assets is None:
+        return None
+    queryset = Asset.objects.all()
+    if portfolios is not None:
+        queryset = queryset.filter(
+            pk__in=Investment.objects.filter(portfolio__in=object_ids(portfolios)).values('asset_id'))
+    if assets is not None:
+        queryset = queryset.filter(pk__in=object_ids(assets))
+    return queryset.values('pk')
+
+
+def filter_prices(portfolios=None, assets=None, start=None, end=None):
+    """Selects share prices ordered by asset and date.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them to select the prices of the assets
+        they are invested in, None for all portfolios
+    :param assets: asset, asset id or collection / queryset of them, None for all assets
+    :param start: first day or None
+    :param end: last day or None
+    :return: queryset of share prices
+    """
+    queryset = SharePrice.objects.all()
+    selected = _price_assets(portfolios, assets)
+    if selected is not None:
+        queryset = queryset.filter(asset__in=selected)
+    # compare with the bounds of the days instead of truncating the column, so the date index can be used
+    if start is not None:
+        queryset = queryset.filter(date__gte=day_start(start))
+    if end is not None:
+        queryset = queryset.filter(date__lt=day_start(end + datetime.timedelta(days=1)))
+    return queryset.order_by('asset_id', 'date')
+
+
+def merge_archived_prices(rows, portfolios=None, assets=None, start=None, end=None, after=None):
+    """Merges the archived share prices selected by the filters of filter_prices into rows of the database.
+
+    :param rows: iterable of (asset id, date, amount, currency) tuples of filter_prices ordered by asset and date
+    :param portfolios: portfolio, portfolio id or collection / queryset of them, None for all portfolios
+    :param assets: asset, asset id or collection / queryset of them, None for all assets
+    :param start: first day or None
+    :param end: last day or None
+    :param after: (asset id, date) tuple, archived prices up to it are omitted, or None
+    :return: iterable of (asset id, date, amount, currency) tuples ordered by asset and date
+    """
+    archive = get_archive()
+    if archive is None:
+        return rows
+    selected = _price_assets(portfolios, assets)
+    asset_ids = archive.asset_ids() if selected is None else selected.values_list('pk', flat=True)
+    if after is not None:
+        asset_ids = [asset_id for asset_id in asset_ids if asset_id >= after[0]]
+    merged = merge_rows(
+        rows, asset_ids, None if start is None else day_start(start),
+        None if end is None else day_start(end + datetime.timedelta(days=1)), archive)
+    if after is not None:
+        # rows of the database already follow the key, only archived prices have to be skipped
+        merged = itertools.dropwhile(lambda row: (row[0], row[1]) <= after, merged)
+    return merged
+
+
+def export_transactions(file_format='csv', chunk_size=2000, **filters):
+    """Streams transactions as CSV or JSON.
+
+    :param file_format: either 'csv' or 'json'
+    :param chunk_size: number of rows fetched from the database at once
+    :param filters: keyword arguments of filter_transactions
+    :return: generator yielding chunks of serialized data
+    """
+    return export(filter_transactions(**filters), TRANSACTION_FIELDS, file_format, chunk_size)
+
+
+def export_prices(file_format='csv', chunk_size=2000, **filters):
+    """Streams share prices as CSV or JSON.
+
+    :param file_format: either 'csv' or 'json'
+    :param chunk_size: number of rows fetched from the database at once
+    :param filters: keyword arguments of filter_prices
+    :return: generator yielding chunks of serialized data
+    """
+    rows = filter_prices(**filters).values_list('asset_id', 'date', 'price', 'price_currency').iterator(
+        chunk_size=chunk_size)
+    selected = _price_assets(filters.get('portfolios'), filters.get('assets'))
+    isins = dict((Asset.objects.all() if selected is None else Asset.objects.filter(pk__in=selected)).values_list(
+        'pk', 'isin'))
+    rows = ((isins[asset_id], date, price, currency)
+            for asset_id, date, price, currency in merge_archived_prices(rows, **filters))
+    return serialize([name for name, _ in PRICE_FIELDS], rows, file_format)
@@ -0,0 +1,167 @@
+"""Batched conversion of amounts between currencies.
+
+All exchange rates needed for a conversion are loaded once into a RateTable: a single sorted array of keys combining
+the source currency and the day, and an array of rates aligned with it. Converting any number of amounts with mixed
+currencies and dates then takes one binary search over the keys, using the latest rate on or before each date.
+
+Amounts without a known rate are converted to NaN, or raise a MissingRateError if the conversion is strict, so they
+can't silently be mistaken for zero.
+"""
+import datetime
+
+import numpy as np
+from django.db.models import Q
+
+from portfolio.models import ExchangeRate
+
+# multiplier separating the currency index from the day number within a key
+_KEY_STRIDE = np.int64(1) << 32
+
+
+class MissingRateError(Exception):
+    """Raised if amounts have to be converted but no exchange rate of their currency is known.
+
+    :ivar missing: sorted list of (currency code, date) pairs without rate
+    """
+
+    def __init__(self, target, missing):
+        self.missing = missing
+        super().__init__('No exchange rate into {} known for {}'.format(
+            target, ', '.join('{} at {}'.format(currency, date) for currency, date in missing[:10])
+            + (' and {} more'.format(len(missing) - 10) if len(missing) > 10 else '')))
+
+
+def _days(dates):
+    """Converts dates into day numbers since the epoch.
+
+    :param dates: sequence or array of dates
+    :return: array of int64 day numbers
+    """
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+
+class RateTable:
+    """Exchange rates of several currencies into one target currency.
+
+    :ivar target: currency code all amounts are converted to
+    :ivar currencies: sorted currency codes with rates, their position is part of the key
+    :ivar keys: sorted array of currency index * 2 ** 32 + day number
+    :ivar rates: price of one unit of the source currency in the target currency, aligned with keys
+    """
+
+    def __init__(self, target, series):
+        self.target = target
+        self.currencies = sorted(series)
+        keys, rates = [], []
+        for index, currency in enumerate(self.currencies):
+            dates, values = series[currency]
+            order = np.argsort(dates, kind='stable')
+            keys.append(index * _KEY_STRIDE + _days(dates)[order])
+            rates.append(np.asarray(values, dtype=np.float64)[order])
+        self.keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        self.rates = np.concatenate(rates) if rates else np.zeros(0)
+
+    @classmethod
+    def load(cls, target, currencies, start, end, lookback=31):
+        """Loads the rates of currencies into the target currency with a single query.
+
+        Direct rates (currency / target) are preferred, inverse rates (target / currency) are used otherwise.
+
+        :param target: currency code to convert to
+        :param currencies: collection of currency codes to convert from or None for all currencies with rates
+        :param start: first day amounts are converted at
+        :param end: last day amounts are converted at
+        :param lookback: number of days before start searched for a rate valid at start
+        :return: the loaded rate table
+        """
+        if currencies is None:
+            pairs = Q(quote_currency=target) | Q(base_currency=target)
+        else:
+            currencies = set(currencies) - {target}
+            pairs = Q(base_currency__in=currencies, quote_currency=target) | Q(
+                base_currency=target, quote_currency__in=currencies)
+        series = {}
+        if currencies is None or currencies:
+            rates = ExchangeRate.objects.filter(
+                pairs, date__range=(start - datetime.timedelta(days=lookback), end),
+            ).values_list('base_currency', 'quote_currency', 'date', 'rate')
+            direct, inverse = {}, {}
+            for base, quote, date, rate in rates:
+                if base == target:
+                    inverse[(quote, date)] = 1 / float(rate)
+                else:
+                    direct[(base, date)] = float(rate)
+            inverse.update(direct)
+            for (currency, date), rate in inverse.items():
+                dates, values = series.setdefault(currency, ([], []))
+                dates.append(date)
+                values.append(rate)
+        return cls(target, series)
+
+    def lookup(self, currencies, dates, strict=False):
+        """Returns the rate of each currency at each date.
+
+        :param currencies: sequence of currency codes
+        :param dates: sequence of dates aligned with currencies
+        :param strict: whether to raise a MissingRateError instead of returning NaN if a rate is unknown
+        :return: array of rates, 1 for the target currency and NaN if no rate is known
+        :raises MissingRateError: if the lookup is strict and a rate is unknown
+        """
+        currencies = np.asarray(currencies, dtype=object)
+        codes, inverse = np.unique(currencies.astype(str), return_inverse=True)
+        position = {currency: index for index, currency in enumerate(self.currencies)}
+        index = np.array([position.get(code, -1) for code in codes], dtype=np.int64)[inverse]
+        keys = index * _KEY_STRIDE + _days(dates)
+
+        found = np.searchsorted(self.keys, keys, side='right') - 1
+        valid = (index >= 0) & (found >= 0)
+        valid[valid] = self.keys[found[valid]] // _KEY_STRIDE == index[valid]
+        rates = np.full(len(keys), np.nan)
+        rates[valid] = self.rates[found[valid]]
+        rates[currencies.astype(str) == self.target] = 1.0
+        if strict:
+            self.check(rates, currencies, dates)
+        return rates
+
+    def check(self, converted, currencies, dates):
+        """Raises an error if amounts couldn't be converted.
+
+        :param converted: array of converted amounts or rates, NaN if no rate is known
+        :param currencies: currency code of each amount
+        :param dates: date of each amount
+        :raises MissingRateError: if an amount is NaN
+        """
+        missing = np.isnan(converted)
+        if missing.any():
+            days = np.asarray(dates, dtype='datetime64[D]')[missing].tolist()
+            pairs = set(zip(np.asarray(currencies, dtype=object)[missing].astype(str).tolist(), days))
+            raise MissingRateError(self.target, sorted(pairs))
+
+    def convert(self, amounts, currencies, dates, strict=False):
+        """Converts amounts into the target currency.
+
+        :param amounts: sequence of amounts
+        :param currencies: currency code of each amount
+        :param dates: date of each amount, the latest rate on or before it is used
+        :param strict: whether to raise a MissingRateError instead of returning NaN if a rate is unknown
+        :return: array of converted amounts, NaN if no rate is known
+        :raises MissingRateError: if the conversion is strict and a rate is unknown
+        """
+        return np.asarray(amounts, dtype=np.float64) * self.lookup(currencies, dates, strict=strict)
+
+
+def convert(amounts, currencies, dates, target):
+    """Converts amounts into a target currency loading the required rates with a single query.
+
+    :param amounts: sequence of amounts
+    :param currencies: currency code of each amount
+    :param dates: date of each amount
+    :param target: currency code to convert to
+    :return: array of converted amounts, NaN if no rate is known
+    """
+    days = np.asarray(dates, dtype='datetime64[D]')
+    if not len(days):
+        return np.zeros(0)
+    table = RateTable.load(target, set(np.asarray(currencies, dtype=str).tolist()), days.min().item(),
+                           days.max().item())
+    return table.convert(amounts, currencies, days)
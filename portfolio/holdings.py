@@ -0,0 +1,194 @@
+"""Maintenance of the holdings snapshot table.
+
+Holdings are updated incrementally when a transaction is appended to the ledger of an investment. Changes which
+can't be applied incrementally, e.g. deleted or backdated transactions, recompute the holding of the affected
+investment from its ledger. rebuild_holdings recomputes holdings of many portfolios in bulk using the vectorized
+ledger of portfolio.valuation.
+"""
+import decimal
+
+import numpy as np
+from django.db import transaction
+
+from portfolio.models import Holding, Investment, Portfolio, Transaction, TransactionType
+from portfolio.valuation import Ledger
+
+_QUANTUM = decimal.Decimal('0.000001')
+
+
+def apply_transaction(holding, transaction_type, transaction_date, volume, price):
+    """Applies a single transaction to a holding following the average cost method.
+
+    :param holding: holding to update, it isn't saved
+    :param transaction_type: type of the transaction, see TransactionType
+    :param transaction_date: date of the transaction
+    :param volume: amount of shares of the transaction
+    :param price: price of one share at which the transaction was executed
+    """
+    if transaction_type in TransactionType.INFLOWS:
+        holding.volume += volume
+        holding.cost_basis += volume * price
+    elif holding.volume > 0:
+        holding.cost_basis -= holding.cost_basis * min(volume, holding.volume) / holding.volume
+        holding.volume -= volume
+    else:
+        holding.volume -= volume
+    if holding.volume <= 0:
+        holding.cost_basis = decimal.Decimal(0)
+    holding.cost_basis = holding.cost_basis.quantize(_QUANTUM)
+    if holding.last_transaction_date is None or transaction_date > holding.last_transaction_date:
+        holding.last_transaction_date = transaction_date
+
+
+def recompute_holding(investment_id):
+    """Recomputes the holding of an investment from its ledger.
+
+    :param investment_id: id of the investment
+    :return: the saved holding
+    """
+    holding = Holding(investment_id=investment_id)
+    ledger = Transaction.objects.filter(investment_id=investment_id).order_by('transaction_date', 'id').values_list(
+        'transaction_type', 'transaction_date', 'volume', 'share_price__price')
+    for row in ledger.iterator():
+        apply_transaction(holding, *row)
+    holding.save()
+    return holding
+
+
+def transaction_saved(transaction_obj, created):
+    """Updates the holding of an investment after one of its transactions was saved.
+
+    Transactions appended to the end of the ledger are applied incrementally, all other changes recompute the holding.
+
+    :param transaction_obj: the saved transaction
+    :param created: whether the transaction was newly created
+    """
+    with transaction.atomic():
+        holding = Holding.objects.select_for_update().filter(investment_id=transaction_obj.investment_id).first()
+        if created and holding is not None and (
+                holding.last_transaction_date is None or
+                transaction_obj.transaction_date >= holding.last_transaction_date):
+            price = transaction_obj.share_price.price.amount
+            apply_transaction(
+                holding, transaction_obj.transaction_type, transaction_obj.transaction_date,
+                decimal.Decimal(str(transaction_obj.volume)), price)
+            holding.save()
+        else:
+            recompute_holding(transaction_obj.investment_id)
+
+
+def recompute_holdings(investment_ids):
+    """Recomputes the holdings of several investments which still exist.
+
+    :param investment_ids: collection of investment ids
+    """
+    for investment_id in Investment.objects.filter(pk__in=set(investment_ids)).values_list('pk', flat=True):
+        recompute_holding(investment_id)
+
+
+def share_price_changed(share_price_id):
+    """Recomputes the holdings of all investments with transactions executed at a share price.
+
+    :param share_price_id: id of the changed share price
+    """
+    recompute_holdings(Transaction.objects.filter(share_price_id=share_price_id).values_list(
+        'investment_id', flat=True).distinct())
+
+
+class Mismatch:
+    """Represents a holding which differs from its ledger.
+
+    :ivar investment_id: id of the investment
+    :ivar stored: tuple of (volume, cost basis) stored in the holdings table, None if the holding is missing
+    :ivar expected: tuple of (volume, cost basis) computed from the ledger
+    """
+
+    def __init__(self, investment_id, stored, expected):
+        self.investment_id = investment_id
+        self.stored = stored
+        self.expected = expected
+
+    def __str__(self):
+        """Returns a nicely printable description of this mismatch.
+
+        :return: a string representation of the mismatch
+        """
+        return 'investment {}: stored {}, expected {}'.format(self.investment_id, self.stored, self.expected)
+
+
+def _portfolio_batches(portfolios, batch_size):
+    """Splits portfolio ids into batches.
+
+    :param portfolios: collection of portfolio ids or None for all portfolios
+    :param batch_size: number of portfolios per batch
+    :return: generator yielding lists of portfolio ids
+    """
+    if portfolios is None:
+        portfolios = list(Portfolio.objects.order_by('id').values_list('id', flat=True))
+    portfolios = list(portfolios)
+    for i in range(0, len(portfolios), batch_size):
+        yield portfolios[i:i + batch_size]
+
+
+def rebuild_holdings(portfolios=None, batch_size=100, verify=False, tolerance=0.001):
+    """Recomputes holdings of many portfolios in bulk.
+
+    Ledgers of batch_size portfolios are loaded at once and evaluated with the vectorized average cost method. Each
+    batch is replaced in its own database transaction.
+
+    :param portfolios: collection of portfolio ids, defaults to all portfolios
+    :param batch_size: number of portfolios processed at once
+    :param verify: only compare the stored holdings with the ledger instead of replacing them
+    :param tolerance: maximum absolute difference of volume and cost basis tolerated by the verification
+    :return: number of rebuilt holdings or list of Mismatch objects if verify is set
+    """
+    rebuilt = 0
+    mismatches = []
+    for batch in _portfolio_batches(portfolios, batch_size):
+        ledger = Ledger.load(batch)
+        volume, cost_basis = ledger.final_positions()
+        last_dates = ledger.last_dates()
+
+        if verify:
+            stored = {
+                investment_id: (float(stored_volume), float(stored_cost_basis))
+                for investment_id, stored_volume, stored_cost_basis in Holding.objects.filter(
+                    investment__portfolio__in=batch).values_list('investment_id', 'volume', 'cost_basis')
+            }
+            for i, investment_id in enumerate(ledger.investment_ids.tolist()):
+                expected = (float(volume[i]), float(cost_basis[i]))
+                actual = stored.get(investment_id)
+                if actual is None or not np.allclose(actual, expected, rtol=1e-9, atol=tolerance):
+                    mismatches.append(Mismatch(investment_id, actual, expected))
+            continue
+
+        holdings = [
+            Holding(
+                investment_id=investment_id,
+                volume=decimal.Decimal(volume[i]).quantize(_QUANTUM),
+                cost_basis=decimal.Decimal(cost_basis[i]).quantize(_QUANTUM),
+                last_transaction_date=None if np.isnat(last_dates[i]) else last_dates[i].item(),
+            )
+            for i, investment_id in enumerate(ledger.investment_ids.tolist())
+        ]
+        with transaction.atomic():
+            Holding.objects.filter(investment__portfolio__in=batch).delete()
+            Holding.objects.bulk_create(holdings)
+            Portfolio.objects.filter(pk__in=batch).touch()
+        rebuilt += len(holdings)
+    return mismatches if verify else rebuilt
+
+
+def current_holdings(investments):
+    """Returns the holdings of investments, creating missing ones from their ledger.
+
+    :param investments: collection or queryset of investments or investment ids
+    :return: dictionary mapping investment ids to holdings
+    """
+    investment_ids = {getattr(investment, 'pk', investment) for investment in investments}
+    holdings = Holding.objects.in_bulk(investment_ids)
+    missing = investment_ids.difference(holdings)
+    if missing:
+        for investment_id in Investment.objects.filter(pk__in=missing).values_list('pk', flat=True):
+            holdings[investment_id] = recompute_holding(investment_id)
+    return holdings
@@ -0,0 +1,242 @@
+"""Validation, conversion and batched resolution of security identifiers.
+
+Assets are identified by ISIN, WKN (Germany), CUSIP (North America) or VALOR (Switzerland). National identifiers are
+embedded in the ISINs of their countries, so WKNs, CUSIPs and VALORs can be derived from ISINs and vice versa. The
+AssetResolver resolves any mix of identifiers to assets with a single query per batch and remembers every identifier
+it has seen, so repeated lookups of the same securities don't hit the database at all.
+"""
+import string
+
+from django.db.models import Q
+
+from portfolio.models import Asset
+
+_CHARACTER_VALUES = {character: value for value, character in enumerate(string.digits + string.ascii_uppercase)}
+_CUSIP_VALUES = dict(_CHARACTER_VALUES, **{'*': 36, '@': 37, '#': 38})
+
+# countries whose ISINs embed a CUSIP respectively a VALOR
+_CUSIP_COUNTRIES = ('US', 'CA')
+_VALOR_COUNTRIES = ('CH', 'LI')
+
+
+def isin_check_digit(body):
+    """Computes the check digit of an ISIN.
+
+    Letters are replaced by their values (A = 10, ..., Z = 35) and the Luhn algorithm is applied to the digits.
+
+    :param body: the first eleven characters of an ISIN
+    :return: the check digit as string
+    """
+    digits = ''.join(str(_CHARACTER_VALUES[character]) for character in body.upper())
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit) * (2 if position % 2 == 0 else 1)
+        total += value // 10 + value % 10
+    return str((10 - total % 10) % 10)
+
+
+def is_valid_isin(isin):
+    """Checks the format and check digit of an ISIN.
+
+    :param isin: the ISIN to check
+    :return: whether the ISIN is valid
+    """
+    isin = isin.upper()
+    return (len(isin) == 12 and isin[:2].isalpha() and isin[-1].isdigit() and
+            all(character in _CHARACTER_VALUES for character in isin) and isin_check_digit(isin[:11]) == isin[-1])
+
+
+def cusip_check_digit(body):
+    """Computes the check digit of a CUSIP.
+
+    :param body: the first eight characters of a CUSIP
+    :return: the check digit as string
+    """
+    total = 0
+    for position, character in enumerate(body.upper()):
+        value = _CUSIP_VALUES[character] * (2 if position % 2 else 1)
+        total += value // 10 + value % 10
+    return str((10 - total % 10) % 10)
+
+
+def is_valid_cusip(cusip):
+    """Checks the format and check digit of a CUSIP.
+
+    :param cusip: the CUSIP to check
+    :return: whether the CUSIP is valid
+    """
+    cusip = cusip.upper()
+    return (len(cusip) == 9 and all(character in _CUSIP_VALUES for character in cusip) and
+            cusip_check_digit(cusip[:8]) == cusip[-1])
+
+
+def wkn_to_isin(wkn):
+    """Derives the German ISIN of a WKN.
+
+    :param wkn: the WKN
+    :return: the ISIN
+    """
+    body = 'DE000' + wkn.upper()
+    return body + isin_check_digit(body)
+
+
+def cusip_to_isin(cusip, country='US'):
+    """Derives the ISIN of a CUSIP.
+
+    :param cusip: the CUSIP
+    :param country: country code of the ISIN, US or CA
+    :return: the ISIN
+    """
+    body = country + cusip.upper()
+    return body + isin_check_digit(body)
+
+
+def valor_to_isin(valor, country='CH'):
+    """Derives the ISIN of a VALOR.
+
+    :param valor: the VALOR
+    :param country: country code of the ISIN, CH or LI
+    :return: the ISIN
+    """
+    body = '{}{:09d}'.format(country, int(valor))
+    return body + isin_check_digit(body)
+
+
+def national_identifiers(isin):
+    """Derives the national identifiers embedded in an ISIN.
+
+    :param isin: a valid ISIN
+    :return: dictionary which may contain the keys wkn, cusip and valor
+    """
+    isin = isin.upper()
+    if isin.startswith('DE000'):
+        return {'wkn': isin[5:11]}
+    if isin[:2] in _CUSIP_COUNTRIES:
+        return {'cusip': isin[2:11]}
+    if isin[:2] in _VALOR_COUNTRIES and isin[2:11].isdigit():
+        return {'valor': int(isin[2:11])}
+    return {}
+
+
+def candidate_isins(identifier):
+    """Derives the ISINs an identifier of unknown type might correspond to.
+
+    :param identifier: an ISIN, WKN, CUSIP or VALOR
+    :return: list of valid ISINs
+    """
+    identifier = identifier.strip().upper()
+    if is_valid_isin(identifier):
+        return [identifier]
+    candidates = []
+    if len(identifier) == 6 and identifier.isalnum():
+        candidates.append(wkn_to_isin(identifier))
+    if is_valid_cusip(identifier):
+        candidates.extend(cusip_to_isin(identifier, country) for country in _CUSIP_COUNTRIES)
+    if identifier.isdigit() and len(identifier) <= 9:
+        candidates.extend(valor_to_isin(identifier, country) for country in _VALOR_COUNTRIES)
+    return candidates
+
+
+class AssetResolver:
+    """Resolves mixed security identifiers to asset ids in batches.
+
+    Identifiers are matched against the ISIN, WKN, CUSIP and VALOR of all assets as well as against the ISINs derived
+    from them. Results, including failed lookups, are kept in memory for the lifetime of the resolver.
+    """
+
+    def __init__(self):
+        self._isins = {}
+        self._wkns = {}
+        self._cusips = {}
+        self._valors = {}
+        self._resolved = {}
+        self._complete = False
+
+    def warm(self, queryset=None):
+        """Loads the identifiers of many assets into memory with a single query.
+
+        After all assets have been loaded, identifiers of known assets are resolved without any further query. Unknown
+        identifiers are still looked up in the database, so assets created afterwards are found.
+
+        :param queryset: assets to load, defaults to all assets
+        """
+        self._remember((Asset.objects.all() if queryset is None else queryset).values_list(
+            'id', 'isin', 'wkn', 'cusip', 'valor').iterator())
+        self._resolved.clear()
+        self._complete = queryset is None
+
+    def _remember(self, rows):
+        """Adds rows of asset ids and identifiers to the in-memory maps.
+
+        :param rows: iterable of (id, isin, wkn, cusip, valor) tuples
+        """
+        for asset_id, isin, wkn, cusip, valor in rows:
+            self._isins[isin.upper()] = asset_id
+            if wkn:
+                self._wkns[wkn.upper()] = asset_id
+            if cusip:
+                self._cusips[cusip.upper()] = asset_id
+            if valor is not None:
+                self._valors[valor] = asset_id
+
+    def _lookup(self, identifier):
+        """Resolves an identifier using the in-memory maps only.
+
+        :param identifier: normalized identifier
+        :return: the asset id or None
+        """
+        asset_id = self._isins.get(identifier) or self._wkns.get(identifier) or self._cusips.get(identifier)
+        if asset_id is None and identifier.isdigit():
+            asset_id = self._valors.get(int(identifier))
+        if asset_id is None:
+            for isin in candidate_isins(identifier):
+                asset_id = self._isins.get(isin)
+                if asset_id is not None:
+                    break
+        if asset_id is None and is_valid_isin(identifier):
+            national = national_identifiers(identifier)
+            asset_id = (self._wkns.get(national.get('wkn')) or self._cusips.get(national.get('cusip')) or
+                        self._valors.get(national.get('valor')))
+        return asset_id
+
+    def resolve(self, identifiers):
+        """Resolves identifiers to asset ids with at most one query.
+
+        :param identifiers: iterable of ISINs, WKNs, CUSIPs or VALORs in any mix
+        :return: dictionary mapping each identifier to an asset id or None if it is unknown
+        """
+        identifiers = set(identifiers)
+        normalized = {identifier: str(identifier).strip().upper() for identifier in identifiers}
+        unknown = {value for value in normalized.values() if value not in self._resolved}
+        if self._complete:
+            for identifier in unknown:
+                asset_id = self._lookup(identifier)
+                if asset_id is not None:
+                    self._resolved[identifier] = asset_id
+            unknown.difference_update(self._resolved)
+        if unknown:
+            codes, valors = set(unknown), set()
+            for identifier in unknown:
+                codes.update(candidate_isins(identifier))
+                if identifier.isdigit():
+                    valors.add(int(identifier))
+                if is_valid_isin(identifier):
+                    national = national_identifiers(identifier)
+                    codes.update(str(value) for key, value in national.items() if key != 'valor')
+                    if 'valor' in national:
+                        valors.add(national['valor'])
+            query = Q(isin__in=codes) | Q(wkn__in=codes) | Q(cusip__in=codes)
+            if valors:
+                query |= Q(valor__in=valors)
+            self._remember(Asset.objects.filter(query).values_list('id', 'isin', 'wkn', 'cusip', 'valor'))
+        for identifier in unknown:
+            self._resolved[identifier] = self._lookup(identifier)
+        return {identifier: self._resolved[normalized[identifier]] for identifier in identifiers}
+
+    def resolve_one(self, identifier):
+        """Resolves a single identifier.
+
+        :param identifier: an ISIN, WKN, CUSIP or VALOR
+        :return: the asset id or None
+        """
+        return self.resolve([identifier])[identifier]
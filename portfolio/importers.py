@@ -0,0 +1,663 @@
+"""Bulk importers loading external data into the portfolio data model."""
+import collections
+import csv
+import datetime
+import decimal
+import hashlib
+import itertools
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from djmoney.money import Money
+
+from portfolio.holdings import rebuild_holdings, recompute_holdings
+from portfolio.identifiers import AssetResolver
+from portfolio.lots import reset_lots
+from portfolio.models import Investment, Portfolio, SharePrice, Transaction, TransactionType
+from portfolio.price_cache import get_price_cache
+from portfolio.rollups import add_prices, rebuild_bars
+from portfolio.utils import local_date
+
+_QUANTUM = decimal.Decimal('0.000001')
+
+
+class ImportDataError(Exception):
+    """Raised if an import file contains malformed records."""
+
+
+class ImportMode:
+    """Collection of strategies how to handle share prices which already exist for an (asset, date) pair."""
+
+    INSERT = 'insert'
+    SKIP = 'skip'
+    REPLACE = 'replace'
+
+    ALL = (INSERT, SKIP, REPLACE)
+
+
+class PriceRecord:
+    """Represents a single share price parsed from an import file.
+
+    :ivar isin: International securities identification number (ISIN) of the asset
+    :ivar date: date of the price
+    :ivar amount: price of one share
+    :ivar currency: currency code of the price
+    """
+
+    __slots__ = ('isin', 'date', 'amount', 'currency')
+
+    def __init__(self, isin, date, amount, currency):
+        self.isin = isin
+        self.date = date
+        self.amount = amount
+        self.currency = currency
+
+
+class ImportResult:
+    """Collects statistics of an import run.
+
+    :ivar created: number of newly created rows
+    :ivar replaced: number of existing rows which were updated
+    :ivar skipped: number of records skipped because a row already existed
+    :ivar unknown: number of records skipped because their asset is unknown
+    :ivar unknown_isins: set of ISINs which could not be resolved to an asset
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.replaced = 0
+        self.skipped = 0
+        self.unknown = 0
+        self.unknown_isins = set()
+
+    def __str__(self):
+        """Returns a nicely printable summary of this import run.
+
+        :return: a string representation of the import statistics
+        """
+        return '{} created, {} replaced, {} skipped, {} with unknown asset'.format(
+            self.created, self.replaced, self.skipped, self.unknown)
+
+
+def chunked(iterable, size):
+    """Splits an iterable into lists of at most size elements without materializing it.
+
+    :param iterable: iterable to split
+    :param size: maximum number of elements per chunk
+    :return: generator yielding lists of elements
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_price_date(value):
+    """Converts a date or datetime string into a datetime suitable for SharePrice.date.
+
+    Plain dates are interpreted as midnight. Naive datetimes are made aware in the current time zone if time zone
+    support is active.
+
+    :param value: ISO 8601 formatted date or datetime
+    :return: the parsed datetime
+    :raises ImportDataError: if the value is not a valid date
+    """
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(value)
+            parsed = datetime.datetime.combine(day, datetime.time())
+    except ValueError:
+        raise ImportDataError('Invalid date: {!r}'.format(value))
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _text(row, key, default=None):
+    """Returns a text field of a raw row without surrounding whitespace.
+
+    Numbers, e.g. VALORs in JSON data, are converted to text.
+
+    :param row: mapping of raw field values
+    :param key: name of the field
+    :param default: value of a missing or empty field, by default such a field is an error
+    :return: the stripped text
+    :raises ImportDataError: if the field is missing or neither a string nor a number
+    """
+    value = row.get(key)
+    if value is None or value == '':
+        if default is None:
+            raise ImportDataError('Missing field {!r} in record {!r}'.format(key, row))
+        return default
+    if isinstance(value, bool) or not isinstance(value, (str, int, float, decimal.Decimal)):
+        raise ImportDataError('Invalid {} in record {!r}'.format(key, row))
+    return str(value).strip()
+
+
+def _make_record(row, default_currency):
+    """Creates a PriceRecord from a mapping of raw field values.
+
+    :param row: mapping containing the keys isin, date, price and optionally currency
+    :param default_currency: currency used if the row doesn't specify one
+    :return: the parsed price record
+    :raises ImportDataError: if a field is missing or malformed
+    """
+    isin = _text(row, 'isin').upper()
+    date = parse_price_date(_text(row, 'date'))
+    try:
+        amount = decimal.Decimal(_text(row, 'price'))
+    except decimal.InvalidOperation:
+        raise ImportDataError('Invalid price in record {!r}'.format(row))
+    currency = _text(row, 'currency', default_currency).upper()
+    return PriceRecord(isin, date, amount, currency)
+
+
+def read_csv_prices(stream, default_currency='USD', delimiter=','):
+    """Parses share prices from a CSV stream.
+
+    The CSV data must contain a header with the columns isin, date and price. Instead of an ISIN the isin column may
+    also contain a WKN, CUSIP or VALOR. An additional currency column is optional. Rows are parsed lazily so that
+    arbitrary large files can be processed.
+
+    :param stream: text stream containing CSV data
+    :param default_currency: currency used for rows without currency column
+    :param delimiter: field delimiter of the CSV data
+    :return: generator yielding PriceRecord objects
+    """
+    for row in csv.DictReader(stream, delimiter=delimiter):
+        yield _make_record(row, default_currency)
+
+
+def _iter_json_objects(stream, buffer_size=65536):
+    """Decodes JSON values from a stream containing either a JSON array or newline delimited JSON.
+
+    Values are decoded one by one from a sliding buffer, so a top level array is never loaded into memory at once.
+
+    :param stream: text stream containing JSON data
+    :param buffer_size: number of characters read from the stream at once
+    :return: generator yielding decoded JSON values
+    """
+    decoder = json.JSONDecoder(parse_float=decimal.Decimal)
+    buffer = ''
+    position = 0
+    in_array = None
+    eof = False
+    while True:
+        # skip whitespace and separators between values
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if in_array is None and position < len(buffer):
+            in_array = buffer[position] == '['
+            if in_array:
+                position += 1
+                continue
+        if in_array and position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                if buffer[position:].strip():
+                    raise ImportDataError('Malformed JSON near {!r}'.format(buffer[position:position + 50]))
+                return
+            chunk = stream.read(buffer_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        if end == len(buffer) and not eof:
+            # a number at the end of the buffer might be truncated, make sure it is complete
+            chunk = stream.read(buffer_size)
+            if chunk:
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            eof = True
+        position = end
+        yield value
+
+
+def read_json_prices(stream, default_currency='USD'):
+    """Parses share prices from a JSON stream.
+
+    The JSON data must be either an array of objects or newline delimited objects, each containing the keys isin, date,
+    price and optionally currency.
+
+    :param stream: text stream containing JSON data
+    :param default_currency: currency used for objects without currency key
+    :return: generator yielding PriceRecord objects
+    """
+    for obj in _iter_json_objects(stream):
+        if not isinstance(obj, dict):
+            raise ImportDataError('Expected JSON object, got {!r}'.format(obj))
+        yield _make_record(obj, default_currency)
+
+
+class PriceImporter:
+    """Writes streams of share prices into the database in batches.
+
+    Records are consumed in chunks of batch_size. Each chunk is written in its own database transaction using a single
+    bulk insert, so memory consumption stays constant regardless of the number of records. If the import fails, e.g.
+    because a price already exists in insert mode, the chunks written before stay committed. Assets are resolved by
+    identifier once and cached for the lifetime of the importer.
+
+    :ivar batch_size: number of records written per database transaction
+    :ivar mode: strategy for records whose (asset, date) pair already exists, see ImportMode
+    """
+
+    def __init__(self, batch_size=5000, mode=ImportMode.INSERT):
+        if mode not in ImportMode.ALL:
+            raise ValueError('Unknown import mode: {}'.format(mode))
+        self.batch_size = batch_size
+        self.mode = mode
+        self.resolver = AssetResolver()
+
+    def resolve_assets(self, identifiers):
+        """Resolves identifiers to asset ids using a single query for all identifiers not seen before.
+
+        :param identifiers: collection of ISINs, WKNs, CUSIPs or VALORs
+        :return: dictionary mapping identifiers to asset ids, unknown identifiers map to None
+        """
+        return self.resolver.resolve(identifiers)
+
+    def run(self, records, result=None):
+        """Imports the given share price records.
+
+        :param records: iterable of PriceRecord objects
+        :param result: ImportResult to add the statistics to, by default a new one is created
+        :return: ImportResult with statistics of this run
+        """
+        result = ImportResult() if result is None else result
+        for chunk in chunked(records, self.batch_size):
+            with transaction.atomic():
+                self._import_chunk(chunk, result)
+        return result
+
+    def _import_chunk(self, chunk, result):
+        """Writes one chunk of records into the database.
+
+        :param chunk: list of PriceRecord objects
+        :param result: ImportResult to update
+        """
+        asset_ids = self.resolve_assets(record.isin for record in chunk)
+        # deduplicate (asset, date) pairs within the chunk, the last record wins
+        prices = {}
+        identifiers = {}
+        for record in chunk:
+            asset_id = asset_ids[record.isin]
+            if asset_id is None:
+                result.unknown += 1
+                result.unknown_isins.add(record.isin)
+                continue
+            prices[(asset_id, record.date)] = Money(record.amount, record.currency)
+            identifiers[asset_id] = record.isin
+
+        touched = list(prices)
+        if self.mode != ImportMode.INSERT and prices:
+            existing = SharePrice.objects.filter(
+                asset_id__in={asset_id for asset_id, _ in prices},
+                date__range=(min(date for _, date in prices), max(date for _, date in prices)),
+            )
+            changed = []
+            for share_price in existing.only('id', 'asset_id', 'date'):
+                price = prices.pop((share_price.asset_id, share_price.date), None)
+                if price is None:
+                    continue
+                if self.mode == ImportMode.SKIP:
+                    result.skipped += 1
+                else:
+                    share_price.price = price
+                    changed.append(share_price)
+            if changed:
+                SharePrice.objects.bulk_update(changed, ['price', 'price_currency'])
+                result.replaced += len(changed)
+                # bulk updates don't send signals, refresh holdings and price bars depending on the replaced prices
+                recompute_holdings(
+                    Transaction.objects.filter(share_price__in=changed).values_list('investment_id', flat=True))
+                days = [local_date(share_price.date) for share_price in changed]
+                rebuild_bars({share_price.asset_id for share_price in changed}, min(days), max(days))
+
+        try:
+            with transaction.atomic():
+                SharePrice.objects.bulk_create(
+                    SharePrice(asset_id=asset_id, date=date, price=price) for (asset_id, date), price in prices.items()
+                )
+        except IntegrityError:
+            if self.mode != ImportMode.INSERT:
+                raise
+            existing = SharePrice.objects.filter(
+                asset_id__in={asset_id for asset_id, _ in prices},
+                date__range=(min(date for _, date in prices), max(date for _, date in prices)),
+            ).values_list('asset_id', 'date')
+            asset_id, date = next((key for key in existing.iterator() if key in prices), (None, None))
+            if asset_id is None:
+                raise
+            if timezone.is_aware(date):
+                date = timezone.localtime(date)
+            raise ImportDataError(
+                'A share price of {} at {} already exists, use the mode {} or {} (--mode) to keep or replace '
+                'existing prices'.format(identifiers[asset_id], date.isoformat(), ImportMode.SKIP, ImportMode.REPLACE))
+        add_prices(
+            (asset_id, date, price.amount, str(price.currency)) for (asset_id, date), price in prices.items())
+        result.created += len(prices)
+
+        # bulk operations don't send signals, drop cached prices and mark the portfolios of all touched assets
+        touched_assets = {asset_id for asset_id, _ in touched}
+        price_cache = get_price_cache()
+        for asset_id in touched_assets:
+            price_cache.invalidate(asset_id)
+        if touched_assets:
+            Portfolio.objects.filter(investment__asset__in=touched_assets).touch()
+
+
+def import_prices(records, batch_size=5000, mode=ImportMode.INSERT):
+    """Imports share prices using a PriceImporter.
+
+    :param records: iterable of PriceRecord objects, e.g. from read_csv_prices or read_json_prices
+    :param batch_size: number of records written per database transaction
+    :param mode: strategy for records whose (asset, date) pair already exists, see ImportMode
+    :return: ImportResult with statistics of the import
+    """
+    return PriceImporter(batch_size=batch_size, mode=mode).run(records)
+
+
+class TransactionRecord:
+    """Represents a single transaction parsed from a broker statement.
+
+    :ivar isin: ISIN, WKN, CUSIP or VALOR of the asset
+    :ivar transaction_type: type of the transaction, see TransactionType
+    :ivar date: execution time of the transaction, used as date of its share price
+    :ivar volume: amount of shares
+    :ivar amount: price of one share
+    :ivar currency: currency code of the price
+    :ivar exchange_rate: exchange rate in force of the transaction or None
+    :ivar reference: reference of the transaction assigned by the broker or None
+    """
+
+    __slots__ = ('isin', 'transaction_type', 'date', 'volume', 'amount', 'currency', 'exchange_rate', 'reference')
+
+    def __init__(self, isin, transaction_type, date, volume, amount, currency, exchange_rate=None, reference=None):
+        self.isin = isin
+        self.transaction_type = transaction_type
+        self.date = date
+        self.volume = volume
+        self.amount = amount
+        self.currency = currency
+        self.exchange_rate = exchange_rate
+        self.reference = reference
+
+
+# transaction types by code and by name as used in statements
+_TRANSACTION_TYPES = dict(
+    {code: code for code in TransactionType.INFLOWS + TransactionType.OUTFLOWS},
+    SALE=TransactionType.SALE, SELL=TransactionType.SALE, REINVESTMENT=TransactionType.REINVESTMENT,
+    REDEMPTION=TransactionType.REDEMPTION, DEPOT_FEE=TransactionType.DEPOT_FEE, FEE=TransactionType.DEPOT_FEE,
+)
+
+
+def _decimal(row, key, required=True):
+    """Parses a decimal field of a raw row.
+
+    :param row: mapping of raw field values
+    :param key: name of the field
+    :param required: whether a missing or empty field is an error
+    :return: the parsed decimal or None
+    :raises ImportDataError: if the field is missing or malformed
+    """
+    value = str(row.get(key) or '').strip()
+    if not value:
+        if required:
+            raise ImportDataError('Missing field {!r} in record {!r}'.format(key, row))
+        return None
+    try:
+        return decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        raise ImportDataError('Invalid {} in record {!r}'.format(key, row))
+
+
+def _make_transaction_record(row, default_currency):
+    """Creates a TransactionRecord from a mapping of raw field values.
+
+    :param row: mapping containing the keys isin, type, date, volume, price and optionally currency, exchange_rate and
+        reference
+    :param default_currency: currency used if the row doesn't specify one
+    :return: the parsed transaction record
+    :raises ImportDataError: if a field is missing or malformed
+    """
+    isin = _text(row, 'isin').upper()
+    date = parse_price_date(_text(row, 'date'))
+    transaction_type = _TRANSACTION_TYPES.get(_text(row, 'type').upper().replace(' ', '_'))
+    if transaction_type is None:
+        raise ImportDataError('Unknown transaction type in record {!r}'.format(row))
+    currency = _text(row, 'currency', default_currency).upper()
+    reference = str(row.get('reference') or '').strip() or None
+    return TransactionRecord(
+        isin, transaction_type, date, _decimal(row, 'volume'), _decimal(row, 'price'), currency,
+        _decimal(row, 'exchange_rate', required=False), reference)
+
+
+def read_csv_transactions(stream, default_currency='USD', delimiter=','):
+    """Parses transactions from a CSV broker statement.
+
+    The CSV data must contain a header with the columns isin, type, date, volume and price. The columns currency,
+    exchange_rate and reference are optional. The type is a transaction type code or name, e.g. BUY or sale. Rows are
+    parsed lazily so that arbitrary large files can be processed.
+
+    :param stream: text stream containing CSV data
+    :param default_currency: currency used for rows without currency column
+    :param delimiter: field delimiter of the CSV data
+    :return: generator yielding TransactionRecord objects
+    """
+    for row in csv.DictReader(stream, delimiter=delimiter):
+        yield _make_transaction_record(row, default_currency)
+
+
+def read_json_transactions(stream, default_currency='USD'):
+    """Parses transactions from a JSON broker statement.
+
+    The JSON data must be either an array of objects or newline delimited objects with the keys of the CSV columns
+    described in read_csv_transactions.
+
+    :param stream: text stream containing JSON data
+    :param default_currency: currency used for objects without currency key
+    :return: generator yielding TransactionRecord objects
+    """
+    for obj in _iter_json_objects(stream):
+        if not isinstance(obj, dict):
+            raise ImportDataError('Expected JSON object, got {!r}'.format(obj))
+        yield _make_transaction_record(obj, default_currency)
+
+
+class TransactionImportResult:
+    """Collects statistics of a transaction import run.
+
+    :ivar created: number of newly created transactions
+    :ivar duplicates: number of records skipped because they were imported before
+    :ivar unknown: number of records skipped because their asset is unknown
+    :ivar unknown_isins: set of identifiers which could not be resolved to an asset
+    :ivar investments: number of newly created investments
+    :ivar prices: number of newly created share prices
+    :ivar price_mismatches: set of (identifier, execution time) pairs of records whose price differs from the share
+        price already stored for the asset and time, their transactions refer to the stored share price
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.duplicates = 0
+        self.unknown = 0
+        self.unknown_isins = set()
+        self.investments = 0
+        self.prices = 0
+        self.price_mismatches = set()
+
+    def __str__(self):
+        """Returns a nicely printable summary of this import run.
+
+        :return: a string representation of the import statistics
+        """
+        return ('{} created, {} duplicates, {} with unknown asset, {} new investments, {} new share prices, '
+                '{} with differing price').format(
+            self.created, self.duplicates, self.unknown, self.investments, self.prices, len(self.price_mismatches))
+
+
+def _normalize(value):
+    """Formats an optional decimal with the six decimal places stored in the database."""
+    return '' if value is None else str(value.quantize(_QUANTUM))
+
+
+class TransactionImporter:
+    """Writes streams of broker statement transactions of a portfolio into the database in batches.
+
+    Every transaction is identified by a hash of its content: portfolio, asset, type, execution time, volume, price,
+    exchange rate, broker reference and the number of identical records before it in the same run. Records whose hash
+    already exists are skipped, so importing the same statements again creates nothing. Each chunk resolves its assets
+    and looks up its hashes, investments and share prices with one query each and creates the missing rows in bulk
+    within its own database transaction. Missing investments are created, share prices existing for the asset and time
+    of a transaction are reused. Records whose price differs from such a share price are reported as price mismatches
+    of the result. Holdings are rebuilt once at the end of the run.
+
+    :ivar portfolio_id: id of the portfolio the transactions belong to
+    :ivar batch_size: number of records written per database transaction
+    :ivar dry_run: whether all changes are rolled back after the run
+    """
+
+    def __init__(self, portfolio, batch_size=1000, dry_run=False):
+        self.portfolio_id = getattr(portfolio, 'pk', portfolio)
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.resolver = AssetResolver()
+        self._occurrences = collections.Counter()
+
+    def run(self, records, result=None):
+        """Imports the given transaction records.
+
+        :param records: iterable of TransactionRecord objects
+        :param result: TransactionImportResult to add the statistics to, by default a new one is created
+        :return: TransactionImportResult with statistics of this run
+        """
+        result = TransactionImportResult() if result is None else result
+        self._occurrences.clear()
+        if not self.dry_run:
+            self._import(records, result)
+            return result
+        with transaction.atomic():
+            self._import(records, result)
+            transaction.set_rollback(True)
+        return result
+
+    def _import(self, records, result):
+        """Writes the records chunk by chunk and rebuilds the holdings of the portfolio if any record was created.
+
+        :param records: iterable of TransactionRecord objects
+        :param result: TransactionImportResult to update
+        """
+        created = result.created
+        try:
+            for chunk in chunked(records, self.batch_size):
+                with transaction.atomic():
+                    self._import_chunk(chunk, result)
+        finally:
+            if result.created > created:
+                rebuild_holdings([self.portfolio_id])
+
+    def content_hash(self, record, asset_id):
+        """Computes the content hash of a record, counting identical records seen in the current run before.
+
+        :param record: TransactionRecord object
+        :param asset_id: id of the asset of the record
+        :return: hexadecimal SHA-256 digest
+        """
+        content = '|'.join(str(value) for value in (
+            self.portfolio_id, asset_id, record.transaction_type, record.date.isoformat(), _normalize(record.volume),
+            _normalize(record.amount), record.currency, _normalize(record.exchange_rate), record.reference or ''))
+        occurrence = self._occurrences[content]
+        self._occurrences[content] += 1
+        return hashlib.sha256('{}|{}'.format(content, occurrence).encode()).hexdigest()
+
+    def _import_chunk(self, chunk, result):
+        """Writes one chunk of records into the database.
+
+        :param chunk: list of TransactionRecord objects
+        :param result: TransactionImportResult to update
+        """
+        asset_ids = self.resolver.resolve(record.isin for record in chunk)
+        pending = {}
+        for record in chunk:
+            asset_id = asset_ids[record.isin]
+            if asset_id is None:
+                result.unknown += 1
+                result.unknown_isins.add(record.isin)
+                continue
+            pending[self.content_hash(record, asset_id)] = (asset_id, record)
+        existing = set(Transaction.objects.filter(content_hash__in=list(pending)).values_list(
+            'content_hash', flat=True))
+        result.duplicates += len(existing)
+        for content_hash in existing:
+            del pending[content_hash]
+        if not pending:
+            return
+
+        assets = {asset_id for asset_id, _ in pending.values()}
+        investments = dict(Investment.objects.filter(portfolio=self.portfolio_id, asset__in=assets).values_list(
+            'asset_id', 'pk'))
+        if len(investments) < len(assets):
+            Investment.objects.bulk_create(
+                Investment(portfolio_id=self.portfolio_id, asset_id=asset_id) for asset_id in assets - set(investments))
+            result.investments += len(assets) - len(investments)
+            investments = dict(Investment.objects.filter(portfolio=self.portfolio_id, asset__in=assets).values_list(
+                'asset_id', 'pk'))
+
+        price_keys = {(asset_id, record.date) for asset_id, record in pending.values()}
+        dates = [date for _, date in price_keys]
+        existing_prices = SharePrice.objects.filter(asset__in=assets, date__range=(min(dates), max(dates)))
+        prices = {}
+        quotes = {}
+        for pk, asset_id, date, amount, currency in existing_prices.values_list(
+                'pk', 'asset_id', 'date', 'price', 'price_currency'):
+            if (asset_id, date) in price_keys:
+                prices[(asset_id, date)] = pk
+                quotes[(asset_id, date)] = (amount, currency)
+        new_prices = {}
+        for asset_id, record in pending.values():
+            key = (asset_id, record.date)
+            quote = (record.amount.quantize(_QUANTUM), record.currency)
+            if key not in quotes:
+                quotes[key] = quote
+                new_prices[key] = Money(*quote)
+            elif quotes[key] != quote:
+                result.price_mismatches.add((record.isin, record.date))
+        if new_prices:
+            SharePrice.objects.bulk_create(
+                SharePrice(asset_id=asset_id, date=date, price=price) for (asset_id, date), price in new_prices.items())
+            add_prices(
+                (asset_id, date, price.amount, str(price.currency)) for (asset_id, date), price in new_prices.items())
+            result.prices += len(new_prices)
+            created_prices = SharePrice.objects.filter(
+                asset__in={asset_id for asset_id, _ in new_prices},
+                date__range=(min(date for _, date in new_prices), max(date for _, date in new_prices)),
+            ).values_list('pk', 'asset_id', 'date')
+            prices.update(((asset_id, date), pk) for pk, asset_id, date in created_prices)
+            price_cache = get_price_cache()
+            for asset_id in {asset_id for asset_id, _ in new_prices}:
+                price_cache.invalidate(asset_id)
+
+        Transaction.objects.bulk_create(
+            Transaction(
+                investment_id=investments[asset_id], transaction_type=record.transaction_type,
+                transaction_date=local_date(record.date), share_price_id=prices[(asset_id, record.date)],
+                exchange_rate=record.exchange_rate, volume=record.volume, content_hash=content_hash,
+            )
+            for content_hash, (asset_id, record) in pending.items()
+        )
+        result.created += len(pending)
+        # bulk inserts don't send signals, lots of the investments are replayed by their next update
+        reset_lots({investments[asset_id] for asset_id, _ in pending.values()})
+        Portfolio.objects.filter(investment__asset__in=assets).touch()
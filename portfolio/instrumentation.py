@@ -0,0 +1,359 @@
+"""Instrumentation of database queries and latency.
+
+QueryProfile records every query executed within a block, including its duration and the code of the portfolio app
+which issued it, and reveals duplicate and similar queries, the typical symptom of N+1 problems. The instrument
+decorator profiles functions and the opt-in QueryInstrumentationMiddleware profiles requests. Both add their profiles
+to per-view statistics and log profiles exceeding configurable thresholds to the logger portfolio.instrumentation.
+
+Statistics are kept per process. If a Django cache backend is configured, every process periodically publishes its
+statistics, so the instrumentation_stats management command can dump percentiles aggregated over all processes.
+
+The instrumentation is configured by the optional setting PORTFOLIO_INSTRUMENTATION, a dictionary with the keys
+SLOW_REQUEST (seconds), MAX_QUERIES, MAX_DUPLICATES (number of repeated identical queries), SAMPLES (samples kept per
+view), BACKEND (alias of a Django cache or None), FLUSH_INTERVAL (seconds between publications) and SERVER_TIMING
+(add a Server-Timing header to responses).
+"""
+import collections
+import contextlib
+import functools
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'SLOW_REQUEST': 1.0,
+    'MAX_QUERIES': 50,
+    'MAX_DUPLICATES': 5,
+    'SAMPLES': 1000,
+    'BACKEND': None,
+    'FLUSH_INTERVAL': 60,
+    'SERVER_TIMING': False,
+}
+
+_THIS_FILE = os.path.abspath(__file__)
+_PACKAGE_DIRECTORY = os.path.dirname(_THIS_FILE)
+_INDEX_KEY = 'portfolio:instrumentation:index'
+
+
+def get_options():
+    """Returns the instrumentation options merged with their defaults.
+
+    :return: dictionary of options
+    """
+    return dict(DEFAULTS, **getattr(settings, 'PORTFOLIO_INSTRUMENTATION', {}))
+
+
+def _origin():
+    """Returns the innermost code location of the portfolio app on the call stack.
+
+    :return: string of the form file:line function or None if the portfolio app isn't on the stack
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_PACKAGE_DIRECTORY) and filename != _THIS_FILE:
+            return '{}:{} {}'.format(
+                os.path.relpath(filename, os.path.dirname(_PACKAGE_DIRECTORY)), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+class Query:
+    """A query recorded by a QueryProfile.
+
+    :ivar sql: SQL statement with placeholders
+    :ivar params: representation of the parameters
+    :ivar duration: execution time in seconds
+    :ivar origin: code of the portfolio app which issued the query or None
+    """
+
+    __slots__ = ('sql', 'params', 'duration', 'origin')
+
+    def __init__(self, sql, params, duration, origin):
+        self.sql = sql
+        self.params = params
+        self.duration = duration
+        self.origin = origin
+
+
+class QueryProfile:
+    """Context manager recording the queries executed on all database connections of the current thread.
+
+    :ivar label: name of the profiled code, e.g. a view name
+    :ivar queries: list of recorded Query objects
+    :ivar duration: wall clock time of the block in seconds
+    """
+
+    def __init__(self, label=None):
+        self.label = label
+        self.queries = []
+        self.duration = None
+        self._stack = None
+        self._start = None
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self._execute))
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._start
+        self._stack.close()
+
+    def _execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(Query(sql, repr(params), time.perf_counter() - start, _origin()))
+
+    @property
+    def db_time(self):
+        """Returns the total execution time of all queries in seconds."""
+        return sum(query.duration for query in self.queries)
+
+    def duplicates(self):
+        """Returns queries executed repeatedly with identical parameters.
+
+        :return: list of (query, count) tuples sorted by descending count, query is the first execution
+        """
+        return self._repeated(lambda query: (query.sql, query.params))
+
+    def similar(self):
+        """Returns queries executed repeatedly with any parameters, e.g. within a loop.
+
+        :return: list of (query, count) tuples sorted by descending count, query is the first execution
+        """
+        return self._repeated(lambda query: query.sql)
+
+    def _repeated(self, key):
+        counts = collections.Counter(key(query) for query in self.queries)
+        first = {}
+        for query in self.queries:
+            first.setdefault(key(query), query)
+        return [(first[value], count) for value, count in counts.most_common() if count > 1]
+
+    def duplicate_count(self):
+        """Returns the number of queries which repeated a previous query with identical parameters."""
+        return sum(count - 1 for _, count in self.duplicates())
+
+    def summary(self):
+        """Returns the key figures of this profile.
+
+        :return: dictionary with the keys label, duration, queries, db_time and duplicates
+        """
+        return {
+            'label': self.label,
+            'duration': self.duration,
+            'queries': len(self.queries),
+            'db_time': self.db_time,
+            'duplicates': self.duplicate_count(),
+        }
+
+    def report(self, limit=5):
+        """Describes the profile and its most frequently repeated queries for logging.
+
+        :param limit: maximum number of repeated queries listed
+        :return: multi-line string
+        """
+        lines = ['{label}: {duration:.3f}s, {queries} queries in {db_time:.3f}s, {duplicates} duplicates'.format(
+            **self.summary())]
+        for query, count in self.similar()[:limit]:
+            lines.append('  {}x {} [{}]'.format(count, query.sql[:200], query.origin or 'unknown origin'))
+        return '\n'.join(lines)
+
+
+class Statistics:
+    """Collects samples of profiles per label and computes percentiles.
+
+    :ivar samples: maximum number of samples kept per label, older samples are discarded
+    :ivar backend: Django cache used to publish the statistics of this process or None
+    :ivar flush_interval: minimum number of seconds between two publications
+    """
+
+    FIELDS = ('duration', 'queries', 'db_time', 'duplicates')
+
+    def __init__(self, samples=1000, backend=None, flush_interval=60):
+        self.samples = samples
+        self.backend = caches[backend] if isinstance(backend, str) else backend
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._data = {}
+        self._last_flush = time.monotonic()
+        self._key = 'portfolio:instrumentation:{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def add(self, profile):
+        """Adds the key figures of a profile.
+
+        :param profile: finished QueryProfile
+        """
+        summary = profile.summary()
+        with self._lock:
+            entry = self._data.get(profile.label)
+            if entry is None:
+                entry = self._data[profile.label] = {
+                    'count': 0, 'samples': collections.deque(maxlen=self.samples)}
+            entry['count'] += 1
+            entry['samples'].append(tuple(summary[field] for field in self.FIELDS))
+            flush = self.backend is not None and time.monotonic() - self._last_flush >= self.flush_interval
+            if flush:
+                self._last_flush = time.monotonic()
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        """Returns a copy of the collected samples.
+
+        :return: dictionary mapping labels to dictionaries with the keys count and samples
+        """
+        with self._lock:
+            return {label: {'count': entry['count'], 'samples': list(entry['samples'])}
+                    for label, entry in self._data.items()}
+
+    def reset(self):
+        """Discards all samples of this process."""
+        with self._lock:
+            self._data.clear()
+
+    def flush(self):
+        """Publishes the samples of this process in the backend."""
+        if self.backend is None:
+            return
+        self.backend.set(self._key, self.snapshot(), None)
+        keys = self.backend.get(_INDEX_KEY, [])
+        if self._key not in keys:
+            self.backend.set(_INDEX_KEY, keys + [self._key], None)
+
+    def collect(self):
+        """Merges the samples published by all processes, including this one.
+
+        :return: dictionary mapping labels to dictionaries with the keys count and samples
+        """
+        if self.backend is None:
+            return self.snapshot()
+        if self._data:
+            self.flush()
+        merged = {}
+        for snapshot in self.backend.get_many(self.backend.get(_INDEX_KEY, [])).values():
+            for label, entry in snapshot.items():
+                target = merged.setdefault(label, {'count': 0, 'samples': []})
+                target['count'] += entry['count']
+                target['samples'].extend(entry['samples'])
+        return merged
+
+    def clear(self):
+        """Discards the samples of this process and all samples published in the backend."""
+        self.reset()
+        if self.backend is not None:
+            self.backend.delete_many(self.backend.get(_INDEX_KEY, []) + [_INDEX_KEY])
+
+    @classmethod
+    def percentiles(cls, collected, percentiles=(50, 90, 99)):
+        """Computes percentiles of collected samples.
+
+        :param collected: samples as returned by snapshot or collect
+        :param percentiles: percentiles to compute
+        :return: dictionary mapping labels to dictionaries with the count and, for each of duration, queries, db_time
+            and duplicates, a dictionary mapping p50, p90, ... and max to values
+        """
+        result = {}
+        for label, entry in collected.items():
+            samples = np.array(entry['samples'], dtype=np.float64).reshape(-1, len(cls.FIELDS))
+            figures = {'count': entry['count']}
+            for column, field in enumerate(cls.FIELDS):
+                values = samples[:, column]
+                figures[field] = {'p{}'.format(p): float(np.percentile(values, p)) if len(values) else None
+                                  for p in percentiles}
+                figures[field]['max'] = float(values.max()) if len(values) else None
+            result[label] = figures
+        return result
+
+
+_statistics = None
+_statistics_lock = threading.Lock()
+
+
+def get_statistics():
+    """Returns the statistics of this process configured by the setting PORTFOLIO_INSTRUMENTATION.
+
+    :return: the shared Statistics instance
+    """
+    global _statistics
+    if _statistics is None:
+        with _statistics_lock:
+            if _statistics is None:
+                options = get_options()
+                _statistics = Statistics(
+                    samples=options['SAMPLES'], backend=options['BACKEND'], flush_interval=options['FLUSH_INTERVAL'])
+    return _statistics
+
+
+def check_thresholds(profile, options=None):
+    """Logs a warning if a profile exceeds the configured thresholds.
+
+    :param profile: finished QueryProfile
+    :param options: instrumentation options, defaults to the configured options
+    :return: whether a threshold was exceeded
+    """
+    options = options or get_options()
+    exceeded = (profile.duration > options['SLOW_REQUEST'] or len(profile.queries) > options['MAX_QUERIES'] or
+                profile.duplicate_count() > options['MAX_DUPLICATES'])
+    if exceeded:
+        logger.warning('Expensive %s', profile.report())
+    return exceeded
+
+
+def instrument(label=None):
+    """Decorator profiling every call of a function.
+
+    :param label: name of the function in the statistics, defaults to its qualified name
+    :return: the decorator
+    """
+    def decorator(function):
+        name = label or '{}.{}'.format(function.__module__, function.__qualname__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with QueryProfile(name) as profile:
+                result = function(*args, **kwargs)
+            get_statistics().add(profile)
+            check_thresholds(profile)
+            return result
+        return wrapper
+    return decorator
+
+
+class QueryInstrumentationMiddleware:
+    """Profiles every request and records it in the statistics of its view.
+
+    Requests are labeled with the name of the resolved view. The duration of streaming responses covers the view only,
+    not the streaming of the content.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = get_options()
+
+    def __call__(self, request):
+        with QueryProfile() as profile:
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        profile.label = match.view_name if match is not None else 'unresolved'
+        get_statistics().add(profile)
+        check_thresholds(profile, self.options)
+        if self.options['SERVER_TIMING']:
+            response['Server-Timing'] = 'db;dur={:.1f};desc="{} queries", total;dur={:.1f}'.format(
+                profile.db_time * 1000, len(profile.queries), profile.duration * 1000)
+        return response
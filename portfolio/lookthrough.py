@@ -0,0 +1,188 @@
+"""Look-through exposure of portfolios to the constituents of the funds they hold.
+
+The fund graph, i.e. which assets each fund holds with which weight, is loaded once into a sparse matrix in coordinate
+form. Market values of the investments of many portfolios are arranged in a dense matrix with one row per portfolio
+and one column per asset. Multiplying the fund columns with the graph matrix moves exposure from funds to their
+constituents, which is repeated for funds of funds. Exposures are finally aggregated by asset, sector or issuer.
+
+Constituent weights come from FundAllocation. Funds without allocations are equally weighted across the stocks and
+bonds referencing them via Stock.funds and Bond.funds.
+"""
+import collections
+import logging
+
+import numpy as np
+
+from portfolio.models import Asset, Bond, FundAllocation, Stock
+from portfolio.valuation import value_portfolios
+
+logger = logging.getLogger(__name__)
+
+# rounding error tolerated in the sum of the weights of a fund
+_TOLERANCE = 1e-9
+
+
+class FundGraph:
+    """Sparse matrix of the weights of the constituents of all funds.
+
+    :ivar asset_ids: ids of all funds and constituents, defining the column index of every asset
+    :ivar rows: index of the fund of each weight
+    :ivar columns: index of the constituent of each weight
+    :ivar weights: weight of the constituent within the fund
+    """
+
+    def __init__(self, edges):
+        asset_ids = sorted({fund_id for fund_id, _, _ in edges} | {asset_id for _, asset_id, _ in edges})
+        self.asset_ids = np.array(asset_ids, dtype=np.int64)
+        self.rows = self.index(np.array([fund_id for fund_id, _, _ in edges], dtype=np.int64))
+        self.columns = self.index(np.array([asset_id for _, asset_id, _ in edges], dtype=np.int64))
+        self.weights = np.array([weight for _, _, weight in edges], dtype=np.float64)
+
+    @classmethod
+    def load(cls):
+        """Loads the constituents of all funds with three queries.
+
+        :return: the fund graph
+        """
+        edges = []
+        weighted = set()
+        for fund_id, asset_id, weight in FundAllocation.objects.values_list('fund_id', 'asset_id', 'weight'):
+            edges.append((fund_id, asset_id, float(weight)))
+            weighted.add(fund_id)
+        totals = collections.Counter()
+        for fund_id, _, weight in edges:
+            totals[fund_id] += weight
+        # weights of over-allocated funds, which bypassed FundAllocation.clean, are scaled to a sum of one
+        excess = {fund_id: total for fund_id, total in totals.items() if total > 1.0 + _TOLERANCE}
+        if excess:
+            logger.warning('Allocations of the funds %s sum up to more than one and are scaled down',
+                           ', '.join(str(fund_id) for fund_id in sorted(excess)))
+            edges = [(fund_id, asset_id, weight / excess.get(fund_id, 1.0)) for fund_id, asset_id, weight in edges]
+        # the remainder of partially allocated funds stays exposure to the fund itself
+        edges.extend((fund_id, fund_id, 1.0 - total) for fund_id, total in totals.items() if total < 1.0 - _TOLERANCE)
+
+        members = collections.defaultdict(list)
+        for model in (Stock, Bond):
+            through = model.funds.through.objects.values_list('fund_id', '{}_id'.format(model._meta.model_name))
+            for fund_id, asset_id in through:
+                if fund_id not in weighted:
+                    members[fund_id].append(asset_id)
+        for fund_id, asset_ids in members.items():
+            edges.extend((fund_id, asset_id, 1.0 / len(asset_ids)) for asset_id in asset_ids)
+        return cls(edges)
+
+    def index(self, asset_ids):
+        """Maps asset ids to column indices, -1 for assets not contained in the graph.
+
+        :param asset_ids: array of asset ids
+        :return: array of indices
+        """
+        if not len(self.asset_ids):
+            return np.full(len(asset_ids), -1, dtype=np.int64)
+        positions = np.clip(np.searchsorted(self.asset_ids, asset_ids), 0, len(self.asset_ids) - 1)
+        return np.where(self.asset_ids[positions] == asset_ids, positions, -1)
+
+    def resolve(self, exposure, max_depth=10):
+        """Moves exposure to funds to their constituents.
+
+        Exposure arriving at a fund is distributed to its constituents again, so funds of funds are resolved up to
+        max_depth levels. Unallocated remainders of funds and exposure beyond max_depth stay with the fund.
+
+        :param exposure: matrix with one row per entity and one column per asset of the graph
+        :param max_depth: maximum nesting depth of funds of funds
+        :return: matrix of the same shape with exposure to constituents instead of funds
+        """
+        is_fund = np.zeros(len(self.asset_ids), dtype=bool)
+        is_fund[self.rows] = True
+        own = self.rows == self.columns
+        remainder = np.zeros(len(self.asset_ids))
+        np.add.at(remainder, self.rows[own], self.weights[own])
+        rows, columns, weights = self.rows[~own], self.columns[~own], self.weights[~own]
+
+        resolved = np.where(is_fund, 0.0, exposure)
+        pending = np.where(is_fund, exposure, 0.0)
+        for _ in range(max_depth):
+            if not pending.any():
+                break
+            resolved += pending * remainder
+            moved = np.zeros_like(pending)
+            np.add.at(moved.T, columns, (pending[:, rows] * weights).T)
+            resolved += np.where(is_fund, 0.0, moved)
+            pending = np.where(is_fund, moved, 0.0)
+        return resolved + pending
+
+
+class Exposure:
+    """Look-through exposure of several portfolios.
+
+    :ivar portfolio_ids: ids of the portfolios, one per row
+    :ivar keys: assets ids, sectors or issuers, one per column
+    :ivar values: matrix of market values exposed to each key
+    :ivar currency: currency code of the market values, None if nothing is held
+    """
+
+    def __init__(self, portfolio_ids, keys, values, currency=None):
+        self.portfolio_ids = portfolio_ids
+        self.keys = keys
+        self.values = values
+        self.currency = currency
+
+    def as_dict(self):
+        """Returns the non zero exposures of every portfolio.
+
+        :return: dictionary mapping portfolio ids to dictionaries mapping keys to market values
+        """
+        return {
+            portfolio_id: {key: float(self.values[row, column]) for column, key in enumerate(self.keys)
+                           if self.values[row, column]}
+            for row, portfolio_id in enumerate(self.portfolio_ids)
+        }
+
+
+def portfolio_exposure(portfolios, by='asset', date=None, graph=None, currency=None):
+    """Computes the look-through exposure of portfolios.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them
+    :param by: aggregation of the exposure, either 'asset', 'sector' or 'issuer', assets without sector are
+        aggregated under an empty sector
+    :param date: date of the valuation, defaults to now
+    :param graph: preloaded FundGraph, which can be shared between several calls
+    :param currency: currency code the market values are converted to, required if they are in several currencies
+    :return: Exposure with one row per portfolio
+    :raises ValueError: if the aggregation is unknown or the market values are in several currencies and no currency
+        is given
+    :raises MissingRateError: if a market value can't be converted to the currency
+    """
+    if by not in ('asset', 'sector', 'issuer'):
+        raise ValueError('Unknown aggregation: {}'.format(by))
+    if graph is None:
+        graph = FundGraph.load()
+    valuation = value_portfolios(portfolios, date, currency)
+    currencies = {value_currency for value_currency, value in zip(valuation.currency, valuation.market_value) if value}
+    if len(currencies) > 1:
+        raise ValueError('Market values in the currencies {} can only be summed up converted to a currency'.format(
+            ', '.join(sorted(currencies))))
+    currency = currency or next(iter(currencies), None)
+    portfolio_ids, rows = np.unique(valuation.portfolio_ids, return_inverse=True)
+
+    # assets held directly but unknown to the graph get additional columns behind the graph's assets
+    columns = graph.index(valuation.asset_ids)
+    direct = np.unique(valuation.asset_ids[columns < 0])
+    asset_ids = np.concatenate([graph.asset_ids, direct])
+    columns[columns < 0] = len(graph.asset_ids) + np.searchsorted(direct, valuation.asset_ids[columns < 0])
+
+    exposure = np.zeros((len(portfolio_ids), len(asset_ids)))
+    np.add.at(exposure, (rows, columns), valuation.market_value)
+    exposure[:, :len(graph.asset_ids)] = graph.resolve(exposure[:, :len(graph.asset_ids)])
+
+    held = exposure.any(axis=0)
+    asset_ids, exposure = asset_ids[held], exposure[:, held]
+    if by == 'asset':
+        return Exposure(portfolio_ids.tolist(), asset_ids.tolist(), exposure, currency)
+
+    field = 'stock__sector' if by == 'sector' else 'issuer'
+    attributes = dict(Asset.objects.filter(pk__in=asset_ids.tolist()).values_list('pk', field))
+    keys, groups = np.unique([attributes.get(asset_id) or '' for asset_id in asset_ids.tolist()], return_inverse=True)
+    values = np.zeros((len(portfolio_ids), len(keys)))
+    np.add.at(values.T, groups, exposure.T)
+    return Exposure(portfolio_ids.tolist(), keys.tolist(), values, currency)
@@ -0,0 +1,280 @@
+"""Lot tracking and realized gains following the FIFO and the average cost method.
+
+The ledger of every investment is applied to its open lots in the order of transaction date and id. Each investment
+has a checkpoint, the latest transaction applied, so update_lots only processes transactions appended after it and
+reports on realized gains read the stored records instead of replaying the ledger. Changes which can't be applied
+incrementally, i.e. changed, deleted or backdated transactions and changed share prices, reset the lots of the
+affected investments (see portfolio.signals), which are then replayed by the next update.
+
+Outflows dispose shares at the share price of the transaction, including depot fees paid in shares.
+"""
+import collections
+import decimal
+import itertools
+
+from django.db import transaction
+from django.db.models import Q
+
+from portfolio.models import (
+    CostMethod, Investment, Lot, LotCheckpoint, RealizedGain, Transaction, TransactionType,
+)
+from portfolio.utils import object_ids
+
+_QUANTUM = decimal.Decimal('0.000001')
+
+
+class LotBook:
+    """Open lots of an investment under one cost method.
+
+    :ivar investment_id: id of the investment
+    :ivar method: cost method, see CostMethod
+    :ivar lots: deque of open lots ordered by acquisition, saved lots have a primary key
+    :ivar closed: saved lots which were fully disposed
+    :ivar gains: unsaved realized gains
+    """
+
+    def __init__(self, investment_id, method, lots=()):
+        self.investment_id = investment_id
+        self.method = method
+        self.lots = collections.deque(lots)
+        self.closed = []
+        self.gains = []
+
+    def apply(self, transaction_id, transaction_type, transaction_date, volume, price):
+        """Applies a transaction to the lots.
+
+        :param transaction_id: id of the transaction
+        :param transaction_type: type of the transaction, see TransactionType
+        :param transaction_date: date of the transaction
+        :param volume: amount of shares of the transaction
+        :param price: price of one share at which the transaction was executed
+        """
+        if transaction_type in TransactionType.INFLOWS:
+            self.lots.append(Lot(
+                investment_id=self.investment_id, method=self.method, transaction_id=transaction_id,
+                acquisition_date=transaction_date, volume=volume, cost_basis=(volume * price).quantize(_QUANTUM)))
+            if self.method == CostMethod.AVERAGE:
+                self._average()
+            return
+
+        remaining = volume
+        while remaining > 0 and self.lots:
+            lot = self.lots[0]
+            disposed = min(remaining, lot.volume)
+            cost = lot.cost_basis if disposed == lot.volume else (lot.cost_basis * disposed / lot.volume).quantize(
+                _QUANTUM)
+            self._realize(transaction_id, transaction_date, lot.acquisition_date, disposed, price, cost)
+            lot.volume -= disposed
+            lot.cost_basis -= cost
+            remaining -= disposed
+            if lot.volume <= 0:
+                self.lots.popleft()
+                if lot.pk is not None:
+                    self.closed.append(lot)
+        if remaining > 0:
+            self._realize(transaction_id, transaction_date, None, remaining, price, decimal.Decimal(0))
+
+    def _average(self):
+        """Spreads the cost basis of all open lots evenly over their shares.
+
+        The lots are kept as acquisition layers, so the holding period of disposed shares is still known.
+        """
+        volume = sum(lot.volume for lot in self.lots)
+        remaining = sum(lot.cost_basis for lot in self.lots)
+        if volume <= 0:
+            return
+        for lot in itertools.islice(self.lots, len(self.lots) - 1):
+            lot.cost_basis = (remaining * lot.volume / volume).quantize(_QUANTUM)
+            remaining -= lot.cost_basis
+            volume -= lot.volume
+        self.lots[-1].cost_basis = remaining
+
+    def _realize(self, transaction_id, date, acquisition_date, volume, price, cost):
+        """Records the disposal of shares of a lot as unsaved realized gain.
+
+        :param transaction_id: id of the outflow
+        :param date: date of the outflow
+        :param acquisition_date: date the disposed shares were acquired, None for shares beyond all lots
+        :param volume: amount of disposed shares
+        :param price: price of one share at which the outflow was executed
+        :param cost: cost basis of the disposed shares
+        """
+        self.gains.append(RealizedGain(
+            investment_id=self.investment_id, method=self.method, transaction_id=transaction_id, date=date,
+            acquisition_date=acquisition_date, volume=volume, proceeds=(volume * price).quantize(_QUANTUM),
+            cost_basis=cost))
+
+
+def _investment_batches(investments, batch_size):
+    """Splits investment ids into batches.
+
+    :param investments: collection of investment ids or None for all investments
+    :param batch_size: number of investments per batch
+    :return: generator yielding lists of investment ids
+    """
+    if investments is None:
+        investments = Investment.objects.order_by('id').values_list('id', flat=True)
+    investments = list(investments)
+    for i in range(0, len(investments), batch_size):
+        yield investments[i:i + batch_size]
+
+
+def _update_batch(investment_ids):
+    """Applies the transactions after the checkpoints of a batch of investments.
+
+    :param investment_ids: list of investment ids
+    :return: number of applied transactions
+    """
+    # serializes concurrent updates of the same investments
+    list(Investment.objects.select_for_update().filter(pk__in=investment_ids).values_list('pk', flat=True))
+    checkpoints = LotCheckpoint.objects.filter(investment__in=investment_ids).values_list(
+        'investment_id', 'transaction__transaction_date', 'transaction_id')
+    checkpoints = {investment_id: (transaction_date, transaction_id)
+                   for investment_id, transaction_date, transaction_id in checkpoints}
+    after = Q(investment__in=[investment_id for investment_id in investment_ids if investment_id not in checkpoints])
+    for investment_id, (transaction_date, transaction_id) in checkpoints.items():
+        after |= Q(investment=investment_id) & (
+            Q(transaction_date__gt=transaction_date) | Q(transaction_date=transaction_date, pk__gt=transaction_id))
+    ledger = Transaction.objects.filter(after).order_by('investment_id', 'transaction_date', 'id').values_list(
+        'investment_id', 'id', 'transaction_type', 'transaction_date', 'volume', 'share_price__price')
+    ledger = list(ledger)
+    if not ledger:
+        return 0
+
+    processed = {row[0] for row in ledger}
+    open_lots = collections.defaultdict(list)
+    for lot in Lot.objects.filter(investment__in=processed).order_by('acquisition_date', 'id'):
+        open_lots[(lot.investment_id, lot.method)].append(lot)
+    books = []
+    last = {}
+    for investment_id, rows in itertools.groupby(ledger, key=lambda row: row[0]):
+        rows = list(rows)
+        for method in CostMethod.ALL:
+            book = LotBook(investment_id, method, open_lots[(investment_id, method)])
+            for row in rows:
+                book.apply(*row[1:])
+            books.append(book)
+        last[investment_id] = rows[-1][1]
+
+    lots = [lot for book in books for lot in book.lots]
+    Lot.objects.filter(pk__in=[lot.pk for book in books for lot in book.closed]).delete()
+    Lot.objects.bulk_update([lot for lot in lots if lot.pk is not None], ['volume', 'cost_basis'])
+    Lot.objects.bulk_create([lot for lot in lots if lot.pk is None])
+    RealizedGain.objects.bulk_create([gain for book in books for gain in book.gains])
+    LotCheckpoint.objects.filter(investment__in=processed).delete()
+    LotCheckpoint.objects.bulk_create(
+        LotCheckpoint(investment_id=investment_id, transaction_id=transaction_id)
+        for investment_id, transaction_id in last.items())
+    return len(ledger)
+
+
+def update_lots(investments=None, batch_size=100):
+    """Applies all transactions appended after the checkpoint of each investment.
+
+    Each batch loads its pending transactions and open lots with one query each and is written in its own database
+    transaction.
+
+    :param investments: investment, investment id or collection / queryset of them, defaults to all investments
+    :param batch_size: number of investments processed at once
+    :return: number of applied transactions
+    """
+    investments = None if investments is None else object_ids(investments)
+    count = 0
+    for batch in _investment_batches(investments, batch_size):
+        with transaction.atomic():
+            count += _update_batch(batch)
+    return count
+
+
+def reset_lots(investments):
+    """Discards the lots, realized gains and checkpoints of investments, so the next update replays their ledgers.
+
+    :param investments: collection of investment ids
+    """
+    investment_ids = set(investments) - {None}
+    with transaction.atomic():
+        for model in (Lot, RealizedGain, LotCheckpoint):
+            model.objects.filter(investment__in=investment_ids).delete()
+
+
+def rebuild_lots(investments=None, batch_size=100):
+    """Replays the ledgers of investments from scratch.
+
+    :param investments: investment, investment id or collection / queryset of them, defaults to all investments
+    :param batch_size: number of investments processed at once
+    :return: number of applied transactions
+    """
+    investments = None if investments is None else object_ids(investments)
+    with transaction.atomic():
+        for model in (Lot, RealizedGain, LotCheckpoint):
+            queryset = model.objects.all()
+            if investments is not None:
+                queryset = queryset.filter(investment__in=investments)
+            queryset.delete()
+    return update_lots(investments, batch_size)
+
+
+def transaction_saved(transaction_obj, created, previous_investment_id=None):
+    """Resets the lots of the investment of a saved transaction unless it was appended after the checkpoint.
+
+    :param transaction_obj: the saved transaction
+    :param created: whether the transaction was newly created
+    :param previous_investment_id: id of the investment the transaction belonged to before it was changed
+    """
+    if created:
+        checkpoint = LotCheckpoint.objects.filter(investment=transaction_obj.investment_id).values_list(
+            'transaction__transaction_date', 'transaction_id').first()
+        if checkpoint is None or (transaction_obj.transaction_date, transaction_obj.pk) > checkpoint:
+            return
+    reset_lots({transaction_obj.investment_id, previous_investment_id})
+
+
+def share_price_changed(share_price_id):
+    """Resets the lots of all investments with transactions executed at a share price.
+
+    :param share_price_id: id of the changed share price
+    """
+    reset_lots(Transaction.objects.filter(share_price_id=share_price_id).values_list(
+        'investment_id', flat=True).distinct())
+
+
+def _year_after(date):
+    """Returns the same day one year later, February 29 becomes March 1."""
+    try:
+        return date.replace(year=date.year + 1)
+    except ValueError:
+        return date.replace(year=date.year + 1, month=3, day=1)
+
+
+def realized_gains(portfolios, start, end, method=CostMethod.FIFO):
+    """Sums the gains realized by the investments of portfolios between two days.
+
+    Pending transactions are applied first, then only the realized gains of the period are read.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them
+    :param start: first day
+    :param end: last day
+    :param method: cost method, see CostMethod
+    :return: list of dictionaries with the keys investment_id, portfolio_id, asset_id, volume, proceeds, cost_basis,
+        gain and long_term_gain ordered by investment, long term gains were realized on shares held for more than a
+        year
+    """
+    investment_ids = list(Investment.objects.filter(portfolio__in=object_ids(portfolios)).values_list('pk', flat=True))
+    update_lots(investment_ids)
+    gains = RealizedGain.objects.filter(
+        investment__in=investment_ids, method=method, date__range=(start, end),
+    ).order_by('investment_id').values_list(
+        'investment_id', 'investment__portfolio_id', 'investment__asset_id', 'date', 'acquisition_date', 'volume',
+        'proceeds', 'cost_basis')
+    report = []
+    for (investment_id, portfolio_id, asset_id), rows in itertools.groupby(gains, key=lambda row: row[:3]):
+        totals = dict.fromkeys(('volume', 'proceeds', 'cost_basis', 'gain', 'long_term_gain'), decimal.Decimal(0))
+        for _, _, _, date, acquisition_date, volume, proceeds, cost_basis in rows:
+            totals['volume'] += volume
+            totals['proceeds'] += proceeds
+            totals['cost_basis'] += cost_basis
+            totals['gain'] += proceeds - cost_basis
+            if acquisition_date is not None and date > _year_after(acquisition_date):
+                totals['long_term_gain'] += proceeds - cost_basis
+        report.append(dict(totals, investment_id=investment_id, portfolio_id=portfolio_id, asset_id=asset_id))
+    return report
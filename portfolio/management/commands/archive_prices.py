@@ -0,0 +1,36 @@
+"""Management command moving old share prices into the price archive."""
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from portfolio.archive import archive_prices, get_archive
+from portfolio.utils import day_start
+
+
+class Command(BaseCommand):
+    """Moves share prices before a cutoff from the database into the archive configured by PORTFOLIO_PRICE_ARCHIVE."""
+
+    help = 'Moves share prices before a cutoff date from the database into the price archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('assets', nargs='*', type=int, metavar='asset', help='id of an asset')
+        cutoff = parser.add_mutually_exclusive_group(required=True)
+        cutoff.add_argument('--before', help='archive prices before this day (YYYY-MM-DD)')
+        cutoff.add_argument('--older-than', type=int, metavar='DAYS', help='archive prices older than DAYS days')
+
+    def handle(self, *args, **options):
+        if get_archive() is None:
+            raise CommandError('The setting PORTFOLIO_PRICE_ARCHIVE has no DIRECTORY.')
+        if options['before']:
+            try:
+                day = parse_date(options['before'])
+            except ValueError:
+                day = None
+            if day is None:
+                raise CommandError('Invalid date: {}'.format(options['before']))
+        else:
+            day = timezone.localdate() - datetime.timedelta(days=options['older_than'])
+        count = archive_prices(day_start(day), options['assets'] or None)
+        self.stdout.write(self.style.SUCCESS('Archived {} share prices before {}.'.format(count, day)))
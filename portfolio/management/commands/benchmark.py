@@ -0,0 +1,97 @@
+"""Management command measuring the performance of the portfolio app on synthetic data."""
+import datetime
+import json
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+
+from portfolio.benchmarks import BENCHMARKS, compare, run_benchmarks
+from portfolio.synthetic import SyntheticData
+
+
+class Command(BaseCommand):
+    """Runs the benchmark suite against a freshly generated synthetic data set.
+
+    The data is generated in a separate test database, which is destroyed afterwards, so the configured database is
+    never modified. Results are written as JSON and can be compared with a previous run.
+    """
+
+    help = 'Benchmarks views, price lookups, imports, valuation and the admin on synthetic data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'benchmarks', nargs='*', metavar='benchmark',
+            help='name of a benchmark to run, defaults to all of: {}'.format(', '.join(BENCHMARKS)))
+        parser.add_argument('--portfolios', type=int, default=10, help='number of portfolios (default: %(default)s)')
+        parser.add_argument('--stocks', type=int, default=40, help='number of stocks (default: %(default)s)')
+        parser.add_argument('--bonds', type=int, default=20, help='number of bonds (default: %(default)s)')
+        parser.add_argument('--funds', type=int, default=10, help='number of funds (default: %(default)s)')
+        parser.add_argument(
+            '--years', type=int, default=3, help='years of daily share prices (default: %(default)s)')
+        parser.add_argument(
+            '--investments', type=int, default=10, help='number of investments per portfolio (default: %(default)s)')
+        parser.add_argument(
+            '--transactions', type=int, default=12,
+            help='number of transactions per investment (default: %(default)s)')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the data generator (default: %(default)s)')
+        parser.add_argument(
+            '--repeat', type=int, default=5, help='measured executions of each benchmark (default: %(default)s)')
+        parser.add_argument('--output', help='file the JSON results are written to, defaults to standard output')
+        parser.add_argument('--compare', metavar='FILE', help='JSON results of a previous run to compare with')
+        parser.add_argument(
+            '--max-slowdown', type=float, default=1.5,
+            help='maximum tolerated ratio of median durations compared to --compare (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        unknown = set(options['benchmarks']).difference(BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare'], encoding='utf-8') as stream:
+                    baseline = json.load(stream)['results']
+            except (OSError, ValueError, KeyError) as error:
+                raise CommandError('Failed to read {}: {}'.format(options['compare'], error))
+
+        generator = SyntheticData(
+            portfolios=options['portfolios'], stocks=options['stocks'], bonds=options['bonds'],
+            funds=options['funds'], years=options['years'], investments=options['investments'],
+            transactions=options['transactions'], seed=options['seed'])
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            data = generator.generate()
+            results = run_benchmarks(options['benchmarks'] or None, repeat=options['repeat'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'created': datetime.datetime.utcnow().isoformat(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'seed': options['seed'],
+            'data': data,
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as stream:
+                stream.write(output)
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            regressions = []
+            for entry in compare(results, baseline, options['max_slowdown']):
+                self.stderr.write(
+                    '{name}: {ratio:.2f}x, {queries} queries (baseline {baseline_queries})'.format(**entry))
+                if entry['regression']:
+                    regressions.append(entry['name'])
+            if regressions:
+                raise CommandError('Performance regressions: {}'.format(', '.join(regressions)))
@@ -0,0 +1,61 @@
+"""Management command exporting transactions or share price histories as CSV or JSON."""
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from portfolio.exports import EXPORT_FORMATS, export_prices, export_transactions
+
+
+def day(value):
+    """Parses a date argument.
+
+    :param value: ISO 8601 formatted date
+    :return: the date
+    :raises ValueError: if the value is not a valid date
+    """
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+class Command(BaseCommand):
+    """Exports transactions or share prices.
+
+    Rows are streamed from the database to the output, so exports of arbitrary size are written with constant memory.
+    """
+
+    help = 'Exports transactions or share prices as CSV or JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('data', choices=('transactions', 'prices'), help='the data to export')
+        parser.add_argument(
+            '--format', choices=EXPORT_FORMATS, default='csv', help='format of the export (default: %(default)s)')
+        parser.add_argument(
+            '--portfolio', type=int, action='append', dest='portfolios',
+            help='id of a portfolio to export, may be repeated')
+        parser.add_argument(
+            '--asset', type=int, action='append', dest='assets', help='id of an asset to export, may be repeated')
+        parser.add_argument('--start', type=day, help='first day to export (YYYY-MM-DD)')
+        parser.add_argument('--end', type=day, help='last day to export (YYYY-MM-DD)')
+        parser.add_argument('--output', help='file to write, defaults to standard output')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='number of rows fetched from the database at once (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        export = export_transactions if options['data'] == 'transactions' else export_prices
+        chunks = export(
+            options['format'], chunk_size=options['chunk_size'], portfolios=options['portfolios'],
+            assets=options['assets'], start=options['start'], end=options['end'])
+        if options['output'] is None:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        try:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as stream:
+                for chunk in chunks:
+                    stream.write(chunk)
+        except OSError as error:
+            raise CommandError('Failed to write {}: {}'.format(options['output'], error))
+        self.stdout.write(self.style.SUCCESS('Exported {} to {}.'.format(options['data'], options['output'])))
@@ -0,0 +1,57 @@
+"""Management command importing share price histories from CSV or JSON files."""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.importers import ImportDataError, ImportMode, PriceImporter, read_csv_prices, read_json_prices
+
+
+class Command(BaseCommand):
+    """Imports share prices from CSV or JSON files.
+
+    Files are streamed and written in batches, so files of arbitrary size can be imported with constant memory. Each
+    batch is committed on its own, so a failing import keeps the batches written before.
+    """
+
+    help = ('Imports share prices from CSV or JSON files. Each batch is committed on its own, an import stopped by an '
+            'error keeps the prices of the batches written before.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', metavar='file', help='CSV or JSON file containing share prices')
+        parser.add_argument(
+            '--format', choices=('csv', 'json'),
+            help='format of the files, by default it is derived from the file extension')
+        parser.add_argument(
+            '--mode', choices=ImportMode.ALL, default=ImportMode.INSERT,
+            help='how to handle prices which already exist for an asset and date, insert stops at the first '
+                 'existing price (default: %(default)s)')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='number of prices written per database transaction (default: %(default)s)')
+        parser.add_argument(
+            '--currency', default='USD',
+            help='currency of prices without explicit currency (default: %(default)s)')
+        parser.add_argument('--delimiter', default=',', help='field delimiter of CSV files (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        importer = PriceImporter(batch_size=options['batch_size'], mode=options['mode'])
+        for path in options['files']:
+            file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+            if file_format in ('json', 'jsonl', 'ndjson'):
+                reader = read_json_prices
+                reader_options = {}
+            elif file_format == 'csv':
+                reader = read_csv_prices
+                reader_options = {'delimiter': options['delimiter']}
+            else:
+                raise CommandError('Unable to determine format of {}, use --format'.format(path))
+
+            try:
+                with open(path, newline='', encoding='utf-8') as stream:
+                    result = importer.run(reader(stream, default_currency=options['currency'], **reader_options))
+            except (OSError, ImportDataError) as error:
+                raise CommandError('Failed to import {}: {}'.format(path, error))
+
+            self.stdout.write(self.style.SUCCESS('{}: {}'.format(path, result)))
+            if result.unknown_isins:
+                self.stderr.write('Unknown ISINs: {}'.format(', '.join(sorted(result.unknown_isins))))
@@ -0,0 +1,63 @@
+"""Management command importing transactions from CSV or JSON broker statements."""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.importers import ImportDataError, TransactionImporter, read_csv_transactions, read_json_transactions
+from portfolio.models import Portfolio
+
+
+class Command(BaseCommand):
+    """Imports the transactions of a portfolio from broker statements.
+
+    Transactions imported before are recognized by their content hash and skipped, so statements can be imported
+    repeatedly.
+    """
+
+    help = 'Imports the transactions of a portfolio from CSV or JSON broker statements.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('portfolio', type=int, help='id of the portfolio the transactions belong to')
+        parser.add_argument('files', nargs='+', metavar='file', help='CSV or JSON file containing transactions')
+        parser.add_argument(
+            '--format', choices=('csv', 'json'),
+            help='format of the files, by default it is derived from the file extension')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='number of transactions written per database transaction (default: %(default)s)')
+        parser.add_argument(
+            '--currency', default='USD',
+            help='currency of prices without explicit currency (default: %(default)s)')
+        parser.add_argument('--delimiter', default=',', help='field delimiter of CSV files (default: %(default)s)')
+        parser.add_argument(
+            '--dry-run', action='store_true', help='report what would be imported without changing the database')
+
+    def handle(self, *args, **options):
+        if not Portfolio.objects.filter(pk=options['portfolio']).exists():
+            raise CommandError('Unknown portfolio: {}'.format(options['portfolio']))
+        importer = TransactionImporter(
+            options['portfolio'], batch_size=options['batch_size'], dry_run=options['dry_run'])
+        for path in options['files']:
+            file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+            if file_format in ('json', 'jsonl', 'ndjson'):
+                reader = read_json_transactions
+                reader_options = {}
+            elif file_format == 'csv':
+                reader = read_csv_transactions
+                reader_options = {'delimiter': options['delimiter']}
+            else:
+                raise CommandError('Unable to determine format of {}, use --format'.format(path))
+
+            try:
+                with open(path, newline='', encoding='utf-8') as stream:
+                    result = importer.run(reader(stream, default_currency=options['currency'], **reader_options))
+            except (OSError, ImportDataError) as error:
+                raise CommandError('Failed to import {}: {}'.format(path, error))
+
+            prefix = '{} (dry run)'.format(path) if options['dry_run'] else path
+            self.stdout.write(self.style.SUCCESS('{}: {}'.format(prefix, result)))
+            if result.unknown_isins:
+                self.stderr.write('Unknown ISINs: {}'.format(', '.join(sorted(result.unknown_isins))))
+            if result.price_mismatches:
+                self.stderr.write('Prices differing from the stored share price: {}'.format(', '.join(
+                    '{} at {}'.format(isin, date.isoformat()) for isin, date in sorted(result.price_mismatches))))
@@ -0,0 +1,37 @@
+"""Management command dumping the query and latency statistics collected by the instrumentation."""
+import json
+
+from django.core.management.base import BaseCommand
+
+from portfolio.instrumentation import get_statistics
+
+
+class Command(BaseCommand):
+    """Dumps percentiles of the request durations, query counts, database time and duplicate queries per view.
+
+    Statistics of other processes are only available if the instrumentation publishes them in a shared cache backend
+    (see the setting PORTFOLIO_INSTRUMENTATION).
+    """
+
+    help = 'Dumps percentiles of the durations and queries recorded by the portfolio instrumentation.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=('text', 'json'), default='text', help='output format (default: %(default)s)')
+        parser.add_argument('--reset', action='store_true', help='discard all statistics after dumping them')
+
+    def handle(self, *args, **options):
+        statistics = get_statistics()
+        percentiles = statistics.percentiles(statistics.collect())
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps(percentiles, indent=2, sort_keys=True))
+        else:
+            self.stdout.write('{:<50} {:>8} {:>10} {:>10} {:>8} {:>8} {:>10}'.format(
+                'view', 'count', 'p50 ms', 'p99 ms', 'p50 q', 'p99 q', 'p99 dup'))
+            for label, figures in sorted(percentiles.items(), key=lambda item: -item[1]['duration']['p99']):
+                self.stdout.write('{:<50} {:>8} {:>10.1f} {:>10.1f} {:>8.0f} {:>8.0f} {:>10.0f}'.format(
+                    label[:50], figures['count'], figures['duration']['p50'] * 1000,
+                    figures['duration']['p99'] * 1000, figures['queries']['p50'], figures['queries']['p99'],
+                    figures['duplicates']['p99']))
+        if options['reset']:
+            statistics.clear()
@@ -0,0 +1,33 @@
+"""Management command reporting the gains realized within a tax year."""
+import csv
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from portfolio.lots import realized_gains
+from portfolio.models import CostMethod, Portfolio
+
+METHODS = {'fifo': CostMethod.FIFO, 'average': CostMethod.AVERAGE}
+
+
+class Command(BaseCommand):
+    """Writes the realized gains of every investment within a year as CSV."""
+
+    help = 'Reports the gains realized by all or selected portfolios within a year as CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int, help='tax year')
+        parser.add_argument('portfolios', nargs='*', type=int, metavar='portfolio', help='id of a portfolio')
+        parser.add_argument(
+            '--method', choices=sorted(METHODS), default='fifo', help='cost method (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        portfolios = options['portfolios'] or Portfolio.objects.all()
+        year = options['year']
+        report = realized_gains(
+            portfolios, datetime.date(year, 1, 1), datetime.date(year, 12, 31), METHODS[options['method']])
+        fields = ['portfolio_id', 'investment_id', 'asset_id', 'volume', 'proceeds', 'cost_basis', 'gain',
+                  'long_term_gain']
+        writer = csv.DictWriter(self.stdout, fields, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(report)
@@ -0,0 +1,37 @@
+"""Management command recomputing the holdings snapshot table from the transaction ledger."""
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.holdings import rebuild_holdings
+
+
+class Command(BaseCommand):
+    """Recomputes holdings in bulk or verifies that they are consistent with the transaction ledger."""
+
+    help = 'Recomputes the holdings of all or selected portfolios from their transactions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('portfolios', nargs='*', type=int, metavar='portfolio', help='id of a portfolio')
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='only check that the stored holdings match the transactions without changing them')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='number of portfolios processed at once (default: %(default)s)')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.001,
+            help='maximum difference tolerated by --verify (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        portfolios = options['portfolios'] or None
+        if not options['verify']:
+            count = rebuild_holdings(portfolios, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS('Rebuilt {} holdings.'.format(count)))
+            return
+
+        mismatches = rebuild_holdings(
+            portfolios, batch_size=options['batch_size'], verify=True, tolerance=options['tolerance'])
+        for mismatch in mismatches:
+            self.stderr.write(str(mismatch))
+        if mismatches:
+            raise CommandError('{} holdings are inconsistent with their transactions.'.format(len(mismatches)))
+        self.stdout.write(self.style.SUCCESS('All holdings are consistent.'))
@@ -0,0 +1,19 @@
+"""Management command recomputing the price bar rollups from the share prices."""
+from django.core.management.base import BaseCommand
+
+from portfolio.rollups import rebuild_bars
+
+
+class Command(BaseCommand):
+    """Recomputes the daily, weekly and monthly price bars of all or selected assets."""
+
+    help = 'Recomputes the price bars of all or selected assets from their share prices.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('assets', nargs='*', type=int, metavar='asset', help='id of an asset')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000, help='number of bars written at once (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        count = rebuild_bars(options['assets'] or None, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt {} price bars.'.format(count)))
@@ -0,0 +1,27 @@
+"""Management command applying new transactions to the lots and realized gains."""
+from django.core.management.base import BaseCommand
+
+from portfolio.lots import rebuild_lots, update_lots
+from portfolio.models import Investment
+
+
+class Command(BaseCommand):
+    """Applies transactions after the checkpoint of each investment or replays whole ledgers."""
+
+    help = 'Applies new transactions of all or selected portfolios to their lots and realized gains.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('portfolios', nargs='*', type=int, metavar='portfolio', help='id of a portfolio')
+        parser.add_argument(
+            '--rebuild', action='store_true', help='discard all lots and replay the ledgers from the beginning')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='number of investments processed at once (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        investments = None
+        if options['portfolios']:
+            investments = Investment.objects.filter(portfolio__in=options['portfolios'])
+        function = rebuild_lots if options['rebuild'] else update_lots
+        count = function(investments, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Applied {} transactions.'.format(count)))
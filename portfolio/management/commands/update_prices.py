@@ -0,0 +1,51 @@
+"""Management command fetching the latest share prices of held assets from a price provider."""
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.importers import ImportMode
+from portfolio.providers import FileProvider, PriceUpdater, get_provider
+
+
+class Command(BaseCommand):
+    """Fetches the latest share prices of all held assets concurrently and writes them in batches."""
+
+    help = 'Fetches the latest share prices of held assets from a price provider.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('assets', nargs='*', type=int, metavar='asset', help='id of an asset to update')
+        parser.add_argument(
+            '--provider', default='default',
+            help='name of a provider configured in PORTFOLIO_PRICE_PROVIDERS (default: %(default)s)')
+        parser.add_argument('--file', help='serve quotes from a CSV or JSON file instead of a configured provider')
+        parser.add_argument(
+            '--workers', type=int, default=8, help='maximum number of concurrent requests (default: %(default)s)')
+        parser.add_argument(
+            '--retries', type=int, default=3,
+            help='number of retries of a failed request (default: %(default)s)')
+        parser.add_argument(
+            '--mode', choices=ImportMode.ALL, default=ImportMode.REPLACE,
+            help='how to handle prices which already exist for an asset and date (default: %(default)s)')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='number of prices written per database transaction (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        try:
+            provider = FileProvider(options['file']) if options['file'] else get_provider(options['provider'])
+        except ImproperlyConfigured as error:
+            raise CommandError(error)
+        updater = PriceUpdater(
+            provider, workers=options['workers'], retries=options['retries'], batch_size=options['batch_size'],
+            mode=options['mode'])
+        try:
+            result = updater.run(updater.held_isins(options['assets'] or None))
+        finally:
+            provider.close()
+
+        if result.requested and len(result.failed_isins) == result.requested:
+            raise CommandError('Failed to fetch any share price')
+        self.stdout.write(self.style.SUCCESS(str(result)))
+        if result.failed_isins:
+            self.stderr.write('Failed ISINs: {}'.format(', '.join(sorted(result.failed_isins))))
+        if result.unknown_isins:
+            self.stderr.write('Unknown ISINs: {}'.format(', '.join(sorted(result.unknown_isins))))
@@ -0,0 +1,41 @@
+# Generated by Django 2.2 on 2026-10-16 20:30
+
+from django.db import migrations, models
+
+
+def merge_duplicate_share_prices(apps, schema_editor):
+    """Merges share prices of the same asset and date.
+
+    The oldest share price of each (asset, date) pair is kept and the transactions executed at its duplicates are moved
+    to it before the duplicates are deleted.
+    """
+    SharePrice = apps.get_model('portfolio', 'SharePrice')
+    Transaction = apps.get_model('portfolio', 'Transaction')
+    db_alias = schema_editor.connection.alias
+
+    duplicates = SharePrice.objects.using(db_alias).values('asset_id', 'date').annotate(
+        count=models.Count('id')).filter(count__gt=1).values_list('asset_id', 'date')
+    for asset_id, date in list(duplicates):
+        keep, *others = SharePrice.objects.using(db_alias).filter(asset=asset_id, date=date).order_by(
+            'id').values_list('id', flat=True)
+        Transaction.objects.using(db_alias).filter(share_price__in=others).update(share_price=keep)
+        SharePrice.objects.using(db_alias).filter(pk__in=others).delete()
+
+    if schema_editor.connection.vendor == 'postgresql':
+        # check deferred foreign keys now, tables with pending trigger events can't be altered
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0006_alter_transaction_field_types'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_share_prices, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='shareprice',
+            unique_together={('asset', 'date')},
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 2.2 on 2026-10-16 21:05
+
+import decimal
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# transaction types adding shares to an investment, buys and reinvestments
+INFLOWS = ('BUY', 'REI')
+
+
+def apply_transaction(holding, transaction_type, transaction_date, volume, price):
+    """Applies a single transaction to a holding following the average cost method.
+
+    :param holding: holding to update, it isn't saved
+    :param transaction_type: type of the transaction
+    :param transaction_date: date of the transaction
+    :param volume: amount of shares of the transaction
+    :param price: price of one share at which the transaction was executed
+    """
+    if transaction_type in INFLOWS:
+        holding.volume += volume
+        holding.cost_basis += volume * price
+    elif holding.volume > 0:
+        holding.cost_basis -= holding.cost_basis * min(volume, holding.volume) / holding.volume
+        holding.volume -= volume
+    else:
+        holding.volume -= volume
+    if holding.volume <= 0:
+        holding.cost_basis = decimal.Decimal(0)
+    holding.cost_basis = holding.cost_basis.quantize(decimal.Decimal('0.000001'))
+    if holding.last_transaction_date is None or transaction_date > holding.last_transaction_date:
+        holding.last_transaction_date = transaction_date
+
+
+def create_holdings(apps, schema_editor):
+    """Creates the holding of every existing investment from its ledger.
+
+    The transactions of all investments are streamed ordered by investment and date and applied with the average cost
+    method, the same way portfolio.holdings maintains them, and the holdings are written in batches.
+    """
+    Investment = apps.get_model('portfolio', 'Investment')
+    Transaction = apps.get_model('portfolio', 'Transaction')
+    Holding = apps.get_model('portfolio', 'Holding')
+    db_alias = schema_editor.connection.alias
+
+    holdings = {
+        investment_id: Holding(investment_id=investment_id)
+        for investment_id in Investment.objects.using(db_alias).values_list('pk', flat=True)
+    }
+    ledger = Transaction.objects.using(db_alias).order_by('investment_id', 'transaction_date', 'id').values_list(
+        'investment_id', 'transaction_type', 'transaction_date', 'volume', 'share_price__price')
+    for investment_id, *row in ledger.iterator():
+        apply_transaction(holdings[investment_id], *row)
+    Holding.objects.using(db_alias).bulk_create(holdings.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0007_add_share_price_asset_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holding',
+            fields=[
+                ('investment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='holding', serialize=False, to='portfolio.Investment', verbose_name='investment')),
+                ('volume', models.DecimalField(decimal_places=6, default=0, max_digits=15, verbose_name='volume')),
+                ('cost_basis', models.DecimalField(decimal_places=6, default=0, max_digits=18, verbose_name='cost basis')),
+                ('last_transaction_date', models.DateField(blank=True, null=True, verbose_name='last transaction date')),
+            ],
+            options={
+                'verbose_name': 'holding',
+                'verbose_name_plural': 'holdings',
+            },
+        ),
+        migrations.RunPython(create_holdings, migrations.RunPython.noop),
+    ]
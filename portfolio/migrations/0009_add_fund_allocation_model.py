@@ -0,0 +1,28 @@
+# Generated by Django 2.2 on 2026-10-16 22:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0008_add_holding_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FundAllocation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weight', models.DecimalField(decimal_places=6, max_digits=7, verbose_name='weight')),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.Asset', verbose_name='asset')),
+                ('fund', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='portfolio.Fund', verbose_name='fund')),
+            ],
+            options={
+                'verbose_name': 'fund allocation',
+                'verbose_name_plural': 'fund allocations',
+                'unique_together': {('fund', 'asset')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2 on 2026-10-16 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0009_add_fund_allocation_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base_currency', models.CharField(max_length=3, verbose_name='base currency')),
+                ('quote_currency', models.CharField(max_length=3, verbose_name='quote currency')),
+                ('date', models.DateField(verbose_name='date')),
+                ('rate', models.DecimalField(decimal_places=8, max_digits=18, verbose_name='rate')),
+            ],
+            options={
+                'verbose_name': 'exchange rate',
+                'verbose_name_plural': 'exchange rates',
+                'unique_together': {('base_currency', 'quote_currency', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,123 @@
+# Generated by Django 2.2 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+def move_references(queryset, field, keep, others, unique_with):
+    """Moves rows referencing duplicates of an asset to the kept asset.
+
+    Rows of a duplicate are dropped if the kept asset already has a row with the same value of unique_with.
+
+    :param queryset: queryset of the referencing rows
+    :param field: name of the foreign key referencing the assets
+    :param keep: id of the kept asset
+    :param others: ids of the duplicates
+    :param unique_with: name of the field which is unique together with field
+    """
+    existing = set(queryset.filter(**{field: keep}).values_list(unique_with, flat=True))
+    for pk, value in queryset.filter(**{'{}__in'.format(field): others}).order_by('pk').values_list('pk', unique_with):
+        if value in existing:
+            queryset.filter(pk=pk).delete()
+        else:
+            queryset.filter(pk=pk).update(**{field: keep})
+            existing.add(value)
+
+
+def merge_duplicate_assets(apps, schema_editor):
+    """Merges assets sharing an ISIN and clears national identifiers used by several assets.
+
+    The oldest asset of each ISIN is kept, preferring assets which are funds, bonds or stocks over plain assets, so the
+    kept asset doesn't lose its type. Assets of different types sharing an ISIN can't be merged and abort the
+    migration. Investments, share prices, fund allocations and fund memberships of the duplicates are moved to the kept
+    asset unless it already has a share price of the same date respectively the same allocation or membership, then
+    the transactions are moved to the share price of the kept asset and the duplicate rows are dropped. WKNs, CUSIPs and
+    VALORs are kept by the oldest asset using them.
+    """
+    Asset = apps.get_model('portfolio', 'Asset')
+    Investment = apps.get_model('portfolio', 'Investment')
+    SharePrice = apps.get_model('portfolio', 'SharePrice')
+    Transaction = apps.get_model('portfolio', 'Transaction')
+    FundAllocation = apps.get_model('portfolio', 'FundAllocation')
+    subclasses = {name: apps.get_model('portfolio', name) for name in ('Fund', 'Bond', 'Stock')}
+    db_alias = schema_editor.connection.alias
+
+    duplicates = Asset.objects.using(db_alias).values('isin').annotate(
+        count=models.Count('id')).filter(count__gt=1).values_list('isin', flat=True)
+    for isin in list(duplicates):
+        ids = list(Asset.objects.using(db_alias).filter(isin=isin).order_by('id').values_list('id', flat=True))
+        types = {
+            name: list(model.objects.using(db_alias).filter(pk__in=ids).order_by('pk').values_list('pk', flat=True))
+            for name, model in subclasses.items()
+        }
+        types = {name: typed for name, typed in types.items() if typed}
+        if len(types) > 1:
+            raise ValueError('The assets {} share the ISIN {} but are of different types ({}), merge them before '
+                             'migrating.'.format(', '.join(map(str, ids)), isin, ', '.join(sorted(types))))
+        keep = next(iter(types.values()))[0] if types else ids[0]
+        others = [asset_id for asset_id in ids if asset_id != keep]
+        Investment.objects.using(db_alias).filter(asset__in=others).update(asset=keep)
+
+        dates = dict(SharePrice.objects.using(db_alias).filter(asset=keep).values_list('date', 'id'))
+        for share_price_id, date in SharePrice.objects.using(db_alias).filter(asset__in=others).order_by(
+                'asset_id').values_list('id', 'date'):
+            if date in dates:
+                Transaction.objects.using(db_alias).filter(share_price=share_price_id).update(share_price=dates[date])
+                SharePrice.objects.using(db_alias).filter(pk=share_price_id).delete()
+            else:
+                SharePrice.objects.using(db_alias).filter(pk=share_price_id).update(asset=keep)
+                dates[date] = share_price_id
+
+        allocations = FundAllocation.objects.using(db_alias)
+        move_references(allocations, 'asset_id', keep, others, 'fund_id')
+        if 'Fund' in types:
+            move_references(allocations, 'fund_id', keep, others, 'asset_id')
+            allocations.filter(fund=keep, asset=keep).delete()
+        for name in ('Bond', 'Stock'):
+            rows = subclasses[name].funds.through.objects.using(db_alias)
+            member = '{}_id'.format(name.lower())
+            if 'Fund' in types:
+                move_references(rows, 'fund_id', keep, others, member)
+            if name in types:
+                move_references(rows, member, keep, others, 'fund_id')
+        Asset.objects.using(db_alias).filter(pk__in=others).delete()
+
+    for field, empty in (('wkn', ''), ('cusip', ''), ('valor', None)):
+        seen = set()
+        rows = Asset.objects.using(db_alias).exclude(**{field: empty}).order_by('id').values_list('id', field)
+        for asset_id, value in rows:
+            if value in seen:
+                Asset.objects.using(db_alias).filter(pk=asset_id).update(**{field: empty})
+            seen.add(value)
+
+    if schema_editor.connection.vendor == 'postgresql':
+        # check deferred foreign keys now, tables with pending trigger events can't be altered
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0010_add_exchange_rate_model'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_assets, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='asset',
+            name='isin',
+            field=models.CharField(max_length=12, unique=True, verbose_name='ISIN'),
+        ),
+        migrations.AlterField(
+            model_name='asset',
+            name='valor',
+            field=models.PositiveIntegerField(blank=True, null=True, unique=True, verbose_name='VALOR'),
+        ),
+        migrations.AddConstraint(
+            model_name='asset',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, cusip=''), fields=('cusip',), name='portfolio_asset_cusip'),
+        ),
+        migrations.AddConstraint(
+            model_name='asset',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, wkn=''), fields=('wkn',), name='portfolio_asset_wkn'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2 on 2026-10-16 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0011_add_asset_identifier_constraints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shareprice',
+            name='date',
+            field=models.DateTimeField(db_index=True, verbose_name='date'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['investment', 'transaction_date'], name='portfolio_tx_investment_date'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_date'], name='portfolio_tx_date'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2 on 2026-10-16 23:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0012_add_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='modified'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='portfolio',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='version'),
+        ),
+    ]
@@ -0,0 +1,97 @@
+# Generated by Django 2.2 on 2026-10-17 00:30
+
+import datetime
+import itertools
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+# resolutions of price bars, daily, weekly and monthly
+RESOLUTIONS = ('D', 'W', 'M')
+
+
+def period_start(resolution, date):
+    """Returns the first day of the period of a resolution containing a date.
+
+    :param resolution: resolution of the period
+    :param date: any day of the period
+    :return: the first day of the period, weeks start on Monday
+    """
+    if resolution == 'W':
+        return date - datetime.timedelta(days=date.weekday())
+    if resolution == 'M':
+        return date.replace(day=1)
+    return date
+
+
+def build_price_bars(apps, schema_editor):
+    """Builds the price bars of all existing share prices.
+
+    The share prices are streamed ordered by asset and date and the bars of every resolution are written in batches,
+    the same way portfolio.rollups.rebuild_bars rebuilds them.
+    """
+    SharePrice = apps.get_model('portfolio', 'SharePrice')
+    PriceBar = apps.get_model('portfolio', 'PriceBar')
+    db_alias = schema_editor.connection.alias
+
+    rows = SharePrice.objects.using(db_alias).order_by('asset_id', 'date').values_list(
+        'asset_id', 'date', 'price', 'price_currency')
+    bars = []
+    for asset_id, prices in itertools.groupby(rows.iterator(), key=lambda row: row[0]):
+        current = {}
+        for _, date, amount, currency in prices:
+            day = (timezone.localtime(date) if timezone.is_aware(date) else date).date()
+            for resolution in RESOLUTIONS:
+                start = period_start(resolution, day)
+                bar = current.get(resolution)
+                if bar is not None and bar.period_start == start:
+                    # prices are ordered by date, so each price closes the bar
+                    bar.high = max(bar.high, amount)
+                    bar.low = min(bar.low, amount)
+                    bar.close, bar.close_date, bar.currency = amount, date, currency
+                    bar.count += 1
+                    continue
+                if bar is not None:
+                    bars.append(bar)
+                current[resolution] = PriceBar(
+                    asset_id=asset_id, resolution=resolution, period_start=start, open=amount, high=amount,
+                    low=amount, close=amount, currency=currency, open_date=date, close_date=date, count=1)
+        bars.extend(current.values())
+        if len(bars) >= 5000:
+            PriceBar.objects.using(db_alias).bulk_create(bars)
+            bars = []
+    PriceBar.objects.using(db_alias).bulk_create(bars)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0013_add_portfolio_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceBar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('D', 'Day'), ('W', 'Week'), ('M', 'Month')], max_length=1, verbose_name='resolution')),
+                ('period_start', models.DateField(verbose_name='period start')),
+                ('open', models.DecimalField(decimal_places=6, max_digits=12, verbose_name='open')),
+                ('high', models.DecimalField(decimal_places=6, max_digits=12, verbose_name='high')),
+                ('low', models.DecimalField(decimal_places=6, max_digits=12, verbose_name='low')),
+                ('close', models.DecimalField(decimal_places=6, max_digits=12, verbose_name='close')),
+                ('currency', models.CharField(max_length=3, verbose_name='currency')),
+                ('open_date', models.DateTimeField(verbose_name='open date')),
+                ('close_date', models.DateTimeField(verbose_name='close date')),
+                ('count', models.PositiveIntegerField(verbose_name='count')),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.Asset', verbose_name='asset')),
+            ],
+            options={
+                'verbose_name': 'price bar',
+                'verbose_name_plural': 'price bars',
+                'unique_together': {('asset', 'resolution', 'period_start')},
+            },
+        ),
+        migrations.RunPython(build_price_bars, migrations.RunPython.noop),
+    ]
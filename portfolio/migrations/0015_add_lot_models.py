@@ -0,0 +1,71 @@
+# Generated by Django 2.2 on 2026-10-17 09:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0014_add_price_bar_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(choices=[('FIF', 'First in, first out'), ('AVG', 'Average cost')], max_length=3, verbose_name='cost method')),
+                ('acquisition_date', models.DateField(verbose_name='acquisition date')),
+                ('volume', models.DecimalField(decimal_places=6, max_digits=15, verbose_name='volume')),
+                ('cost_basis', models.DecimalField(decimal_places=6, max_digits=18, verbose_name='cost basis')),
+                ('investment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='portfolio.Investment', verbose_name='investment')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.Transaction', verbose_name='transaction')),
+            ],
+            options={
+                'verbose_name': 'lot',
+                'verbose_name_plural': 'lots',
+            },
+        ),
+        migrations.CreateModel(
+            name='RealizedGain',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(choices=[('FIF', 'First in, first out'), ('AVG', 'Average cost')], max_length=3, verbose_name='cost method')),
+                ('date', models.DateField(verbose_name='date')),
+                ('acquisition_date', models.DateField(blank=True, null=True, verbose_name='acquisition date')),
+                ('volume', models.DecimalField(decimal_places=6, max_digits=15, verbose_name='volume')),
+                ('proceeds', models.DecimalField(decimal_places=6, max_digits=18, verbose_name='proceeds')),
+                ('cost_basis', models.DecimalField(decimal_places=6, max_digits=18, verbose_name='cost basis')),
+                ('investment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='realized_gains', to='portfolio.Investment', verbose_name='investment')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.Transaction', verbose_name='transaction')),
+            ],
+            options={
+                'verbose_name': 'realized gain',
+                'verbose_name_plural': 'realized gains',
+            },
+        ),
+        migrations.CreateModel(
+            name='LotCheckpoint',
+            fields=[
+                ('investment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='lot_checkpoint', serialize=False, to='portfolio.Investment', verbose_name='investment')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.Transaction', verbose_name='last transaction')),
+            ],
+            options={
+                'verbose_name': 'lot checkpoint',
+                'verbose_name_plural': 'lot checkpoints',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='lot',
+            index=models.Index(fields=['investment', 'method'], name='portfolio_lot_investment'),
+        ),
+        migrations.AddIndex(
+            model_name='realizedgain',
+            index=models.Index(fields=['method', 'date'], name='portfolio_gain_method_date'),
+        ),
+        migrations.AddIndex(
+            model_name='realizedgain',
+            index=models.Index(fields=['investment', 'method', 'date'], name='portfolio_gain_investment'),
+        ),
+    ]
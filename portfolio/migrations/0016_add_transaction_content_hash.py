@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-17 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0015_add_lot_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='content_hash',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True, verbose_name='content hash'),
+        ),
+    ]
@@ -1,18 +1,50 @@
 """Simple portfolio data model supporting investments in stocks."""
-from django.db import models
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import connections, models
+from django.db.models.query import ModelIterable
+from django.dispatch import Signal
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 import djmoney.models.fields as money_fields
 
+# sent by PortfolioQuerySet.touch after the version of at least one portfolio was incremented
+portfolios_touched = Signal()
+
+
+class PortfolioQuerySet(models.QuerySet):
+    """Custom queryset of portfolios."""
+
+    def touch(self):
+        """Increments the version of the selected portfolios to mark their data as changed.
+
+        :return: number of touched portfolios
+        """
+        count = self.update(version=models.F('version') + 1, modified=timezone.now())
+        if count:
+            portfolios_touched.send(sender=self.model)
+        return count
+
 
 class Portfolio(models.Model):
     """Represents a collection of investments.
 
-    A portfolio is the top level entity of the portfolio data model which collects several investments.
+    A portfolio is the top level entity of the portfolio data model which collects several investments. Its version
+    is incremented whenever the portfolio, one of its investments, their transactions or the share prices of their
+    assets change (see portfolio.signals), so clients can cheaply detect whether any data of the portfolio changed.
 
     :cvar name: name of the portfolio
+    :cvar version: number of changes of the data of the portfolio
+    :cvar modified: time of the latest change of the data of the portfolio
     """
 
     name = models.CharField(_('name'), max_length=50, default=_('Untitled'))
+    version = models.PositiveIntegerField(_('version'), default=0, editable=False)
+    modified = models.DateTimeField(_('modified'), auto_now=True)
+
+    objects = PortfolioQuerySet.as_manager()
 
     def __str__(self):
         """Returns a nicely printable string representation of this Portfolio object.
@@ -26,6 +58,53 @@ class Portfolio(models.Model):
         verbose_name_plural = _('portfolios')
 
 
+class PolymorphicModelIterable(ModelIterable):
+    """Yields model instances downcast to the subclass stored in their subclass table."""
+
+    def __iter__(self):
+        accessors = self.queryset.subclass_accessors()
+        for obj in super().__iter__():
+            for accessor in accessors:
+                try:
+                    obj = getattr(obj, accessor)
+                    break
+                except ObjectDoesNotExist:
+                    continue
+            yield obj
+
+
+class AssetQuerySet(models.QuerySet):
+    """Provides queries on assets."""
+
+    def subclass_accessors(self):
+        """Returns the names of the relations from the queried model to its multi-table subclasses.
+
+        :return: list of accessor names, e.g. fund, bond and stock for assets
+        """
+        return [
+            relation.get_accessor_name() for relation in self.model._meta.related_objects
+            if relation.one_to_one and getattr(relation.field.remote_field, 'parent_link', False)
+        ]
+
+    def polymorphic(self):
+        """Returns Fund, Bond and Stock instances instead of plain assets.
+
+        The subclass tables are joined to the asset table, so an arbitrary queryset of assets is downcast within the
+        same single query. Assets of a foreign key can be downcast with one additional query using
+        prefetch_related(Prefetch('asset', queryset=Asset.objects.polymorphic())).
+
+        Querysets of models without subclasses, e.g. of stocks, are returned unchanged.
+
+        :return: queryset yielding instances of the most specific subclass of each asset
+        """
+        accessors = self.subclass_accessors()
+        if not accessors:
+            return self._chain()
+        clone = self.select_related(*accessors)
+        clone._iterable_class = PolymorphicModelIterable
+        return clone
+
+
 class Asset(models.Model):
     """Represents an economic resource.
 
@@ -41,11 +120,13 @@ class Asset(models.Model):
     """
 
     name = models.CharField(_('name'), max_length=200)
-    isin = models.CharField(_('ISIN'), max_length=12)
+    isin = models.CharField(_('ISIN'), max_length=12, unique=True)
     issuer = models.CharField(_('issuer'), max_length=50)
     cusip = models.CharField(_('CUSIP'), max_length=9, blank=True, default='')
     wkn = models.CharField(_('WKN'), max_length=6, blank=True, default='')
-    valor = models.PositiveIntegerField(_('VALOR'), blank=True, null=True)
+    valor = models.PositiveIntegerField(_('VALOR'), blank=True, null=True, unique=True)
+
+    objects = AssetQuerySet.as_manager()
 
     def __str__(self):
         """Returns a nicely printable string representation of an Asset object.
@@ -57,6 +138,10 @@ class Asset(models.Model):
     class Meta:
         verbose_name = _('asset')
         verbose_name_plural = _('assets')
+        constraints = [
+            models.UniqueConstraint(fields=['cusip'], condition=~models.Q(cusip=''), name='portfolio_asset_cusip'),
+            models.UniqueConstraint(fields=['wkn'], condition=~models.Q(wkn=''), name='portfolio_asset_wkn'),
+        ]
 
 
 class Fund(Asset):
@@ -107,6 +192,37 @@ class Stock(Asset):
         verbose_name_plural = _('stocks')
 
 
+class SharePriceQuerySet(models.QuerySet):
+    """Provides queries on share prices."""
+
+    def as_of(self, assets, date):
+        """Returns the latest share price of each asset on or before a certain date.
+
+        All prices are fetched in a single query. Backends supporting DISTINCT ON use it, all others fall back to a
+        correlated subquery. Both variants are answered by the (asset, date) index. Archived prices are missed, see
+        portfolio.archive.latest_prices.
+
+        :param assets: asset, asset id or collection / queryset of assets or asset ids
+        :param date: date or datetime, dates include all prices of that day
+        :return: queryset containing at most one share price per asset
+        """
+        if isinstance(assets, (Asset, int)):
+            assets = [assets]
+        if isinstance(date, datetime.datetime):
+            history = self.filter(date__lte=date)
+        else:
+            end = datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time())
+            if settings.USE_TZ:
+                end = timezone.make_aware(end)
+            history = self.filter(date__lt=end)
+        prices = history.filter(asset__in=assets)
+
+        if connections[self.db].features.can_distinct_on_fields:
+            return prices.order_by('asset_id', '-date').distinct('asset_id')
+        latest = history.filter(asset=models.OuterRef('asset')).order_by('-date').values('pk')[:1]
+        return prices.filter(pk=models.Subquery(latest))
+
+
 class SharePrice(models.Model):
     """Represents the price of a share.
 
@@ -118,9 +234,11 @@ class SharePrice(models.Model):
     """
 
     asset = models.ForeignKey(Asset, verbose_name=_('asset'), on_delete=models.CASCADE)
-    date = models.DateTimeField(_('date'))
+    date = models.DateTimeField(_('date'), db_index=True)
     price = money_fields.MoneyField(_('price'), max_digits=12, decimal_places=6, default_currency='USD')
 
+    objects = SharePriceQuerySet.as_manager()
+
     def __str__(self):
         """Returns a nicely printable string representation of this SharePrice object.
 
@@ -131,6 +249,7 @@ class SharePrice(models.Model):
     class Meta:
         verbose_name = _('share price')
         verbose_name_plural = _('share prices')
+        unique_together = (('asset', 'date'),)
 
 
 class Investment(models.Model):
@@ -166,6 +285,10 @@ class TransactionType:
     REDEMPTION = 'RED'
     DEPOT_FEE = 'DPF'
 
+    # transaction types increasing respectively decreasing the volume of an investment
+    INFLOWS = (BUY, REINVESTMENT)
+    OUTFLOWS = (SALE, REDEMPTION, DEPOT_FEE)
+
 
 class Transaction(models.Model):
     """Represents a business agreement to exchange a stock for payment.
@@ -179,6 +302,7 @@ class Transaction(models.Model):
     :cvar share_price: price of one share at which transaction was executed
     :cvar exchange_rate: exchange rate in force of transaction
     :cvar volume: amount of shares
+    :cvar content_hash: hash identifying an imported transaction to skip it on re-import (see portfolio.importers)
     """
 
     investment = models.ForeignKey(Investment, on_delete=models.CASCADE)
@@ -198,6 +322,7 @@ class Transaction(models.Model):
     share_price = models.ForeignKey(SharePrice, verbose_name=_('share price'), on_delete=models.PROTECT)
     exchange_rate = models.DecimalField(_('exchange rate'), max_digits=12, decimal_places=6, blank=True, null=True)
     volume = models.DecimalField(_('volume'), max_digits=15, decimal_places=6)
+    content_hash = models.CharField(_('content hash'), max_length=64, unique=True, null=True, editable=False)
 
     def __str__(self):
         """Returns a nicely printable string representation of this Transaction object.
@@ -209,3 +334,363 @@ class Transaction(models.Model):
     class Meta:
         verbose_name = _('transaction')
         verbose_name_plural = _('transactions')
+        indexes = [
+            models.Index(fields=['investment', 'transaction_date'], name='portfolio_tx_investment_date'),
+            models.Index(fields=['transaction_date'], name='portfolio_tx_date'),
+        ]
+
+
+class Holding(models.Model):
+    """Represents the current position of an investment.
+
+    A holding is a snapshot of the ledger of an investment which is maintained incrementally whenever a transaction is
+    saved or deleted, so the current position doesn't need to be aggregated from all transactions. The cost basis
+    follows the average cost method and is expressed in the currency of the share prices.
+
+    :cvar investment: investment the holding belongs to
+    :cvar volume: amount of shares currently held
+    :cvar cost_basis: average cost basis of the shares currently held
+    :cvar last_transaction_date: date of the latest transaction of the investment
+    """
+
+    investment = models.OneToOneField(
+        Investment, verbose_name=_('investment'), on_delete=models.CASCADE, primary_key=True, related_name='holding')
+    volume = models.DecimalField(_('volume'), max_digits=15, decimal_places=6, default=0)
+    cost_basis = models.DecimalField(_('cost basis'), max_digits=18, decimal_places=6, default=0)
+    last_transaction_date = models.DateField(_('last transaction date'), blank=True, null=True)
+
+    def __str__(self):
+        """Returns a nicely printable string representation of this Holding object.
+
+        :return: a string representation of this holding
+        """
+        return '{} ({})'.format(self.investment_id, self.volume)
+
+    class Meta:
+        verbose_name = _('holding')
+        verbose_name_plural = _('holdings')
+
+
+class FundAllocation(models.Model):
+    """Represents the weight of an asset within the holdings of a fund.
+
+    Allocations refine the constituents recorded by Stock.funds and Bond.funds. Funds without any allocation are
+    assumed to be equally weighted across their constituents. Weights of a fund may sum up to less than but not more
+    than one, the remainder is treated as exposure to the fund itself.
+
+    :cvar fund: fund holding the asset
+    :cvar asset: asset held by the fund, which might be another fund
+    :cvar weight: fraction of the fund's assets invested in the asset
+    """
+
+    fund = models.ForeignKey(Fund, verbose_name=_('fund'), on_delete=models.CASCADE, related_name='allocations')
+    asset = models.ForeignKey(Asset, verbose_name=_('asset'), on_delete=models.CASCADE, related_name='+')
+    weight = models.DecimalField(_('weight'), max_digits=7, decimal_places=6)
+
+    def __str__(self):
+        """Returns a nicely printable string representation of this FundAllocation object.
+
+        :return: a string representation of this fund allocation
+        """
+        return '{} ({})'.format(self.asset_id, self.weight)
+
+    def clean(self):
+        """Validates the weight, the weights of all allocations of a fund must not sum up to more than one.
+
+        :raises ValidationError: if the weight is out of range or the fund is allocated to itself
+        """
+        if self.fund_id is not None and self.fund_id == self.asset_id:
+            raise ValidationError({'asset': _("A fund can't hold itself.")})
+        if self.weight is None:
+            return
+        if not 0 < self.weight <= 1:
+            raise ValidationError({'weight': _('The weight must be greater than zero and at most one.')})
+        if self.fund_id is not None:
+            allocated = FundAllocation.objects.filter(fund=self.fund_id).exclude(pk=self.pk).aggregate(
+                total=models.Sum('weight'))['total'] or 0
+            if allocated + self.weight > 1:
+                raise ValidationError({'weight': _(
+                    'The weights of all allocations of a fund must not exceed one, %(available)s are left.') % {
+                        'available': 1 - allocated}})
+
+    class Meta:
+        verbose_name = _('fund allocation')
+        verbose_name_plural = _('fund allocations')
+        unique_together = (('fund', 'asset'),)
+
+
+class ExchangeRate(models.Model):
+    """Represents the exchange rate of two currencies.
+
+    The rate states how many units of the quote currency one unit of the base currency is worth at a certain day.
+
+    :cvar base_currency: currency code of the base currency
+    :cvar quote_currency: currency code of the quote currency
+    :cvar date: day the rate is valid for
+    :cvar rate: price of one unit of the base currency in the quote currency
+    """
+
+    base_currency = models.CharField(_('base currency'), max_length=3)
+    quote_currency = models.CharField(_('quote currency'), max_length=3)
+    date = models.DateField(_('date'))
+    rate = models.DecimalField(_('rate'), max_digits=18, decimal_places=8)
+
+    def __str__(self):
+        """Returns a nicely printable string representation of this ExchangeRate object.
+
+        :return: a string representation of this exchange rate
+        """
+        return '{}/{} {} ({})'.format(self.base_currency, self.quote_currency, self.rate, self.date)
+
+    class Meta:
+        verbose_name = _('exchange rate')
+        verbose_name_plural = _('exchange rates')
+        unique_together = (('base_currency', 'quote_currency', 'date'),)
+
+
+class Resolution:
+    """Collection of valid resolutions of price bars, ordered from finest to coarsest."""
+
+    DAY = 'D'
+    WEEK = 'W'
+    MONTH = 'M'
+
+    ALL = (DAY, WEEK, MONTH)
+
+    # approximate number of days covered by one bar
+    DAYS = {DAY: 1, WEEK: 7, MONTH: 30.44}
+
+    @staticmethod
+    def choose(start, end, points):
+        """Returns the finest resolution covering the days between start and end with at most a number of bars.
+
+        :param start: first day
+        :param end: last day
+        :param points: maximum number of bars
+        :return: the resolution, the coarsest resolution if all resolutions exceed points
+        """
+        days = (end - start).days + 1
+        return next((resolution for resolution in Resolution.ALL if days / Resolution.DAYS[resolution] <= points),
+                    Resolution.ALL[-1])
+
+    @staticmethod
+    def period_start(resolution, date):
+        """Returns the first day of the period of a resolution containing a date.
+
+        :param resolution: resolution of the period
+        :param date: any day of the period
+        :return: the first day of the period
+        """
+        if resolution == Resolution.WEEK:
+            return date - datetime.timedelta(days=date.weekday())
+        if resolution == Resolution.MONTH:
+            return date.replace(day=1)
+        return date
+
+
+class PriceBarQuerySet(models.QuerySet):
+    """Provides queries on price bars."""
+
+    def series(self, asset, start, end, points=500):
+        """Returns the price bars of an asset between two days in the finest resolution fitting a number of bars.
+
+        :param asset: asset or asset id
+        :param start: first day of the series
+        :param end: last day of the series
+        :param points: maximum number of bars, the coarsest resolution is used if even it exceeds this number
+        :return: queryset of price bars ordered by date
+        """
+        resolution = Resolution.choose(start, end, points)
+        return self.filter(
+            asset=asset, resolution=resolution, period_start__range=(Resolution.period_start(resolution, start), end),
+        ).order_by('period_start')
+
+
+class PriceBar(models.Model):
+    """Represents the open, high, low and close prices of an asset within a day, week or month.
+
+    Price bars are rollups of share prices maintained whenever prices are saved, deleted or imported (see
+    portfolio.rollups), so price charts over long periods don't need to read every share price.
+
+    :cvar asset: asset the prices belong to
+    :cvar resolution: length of the period, see Resolution
+    :cvar period_start: first day of the period
+    :cvar open: first price within the period
+    :cvar high: highest price within the period
+    :cvar low: lowest price within the period
+    :cvar close: last price within the period
+    :cvar currency: currency code of the prices
+    :cvar open_date: date of the first price
+    :cvar close_date: date of the last price
+    :cvar count: number of prices within the period
+    """
+
+    asset = models.ForeignKey(Asset, verbose_name=_('asset'), on_delete=models.CASCADE, related_name='+')
+    resolution = models.CharField(
+        _('resolution'),
+        max_length=1,
+        choices=(
+            (Resolution.DAY, _('Day')),
+            (Resolution.WEEK, _('Week')),
+            (Resolution.MONTH, _('Month')),
+        ),
+    )
+    period_start = models.DateField(_('period start'))
+    open = models.DecimalField(_('open'), max_digits=12, decimal_places=6)
+    high = models.DecimalField(_('high'), max_digits=12, decimal_places=6)
+    low = models.DecimalField(_('low'), max_digits=12, decimal_places=6)
+    close = models.DecimalField(_('close'), max_digits=12, decimal_places=6)
+    currency = models.CharField(_('currency'), max_length=3)
+    open_date = models.DateTimeField(_('open date'))
+    close_date = models.DateTimeField(_('close date'))
+    count = models.PositiveIntegerField(_('count'))
+
+    objects = PriceBarQuerySet.as_manager()
+
+    def __str__(self):
+        """Returns a nicely printable string representation of this PriceBar object.
+
+        :return: a string representation of this price bar
+        """
+        return '{} {} {} ({}-{})'.format(self.resolution, self.period_start, self.close, self.low, self.high)
+
+    class Meta:
+        verbose_name = _('price bar')
+        verbose_name_plural = _('price bars')
+        unique_together = (('asset', 'resolution', 'period_start'),)
+
+
+class CostMethod:
+    """Collection of valid methods matching outflows with the lots whose shares they dispose."""
+
+    FIFO = 'FIF'
+    AVERAGE = 'AVG'
+
+    ALL = (FIFO, AVERAGE)
+
+
+class Lot(models.Model):
+    """Represents shares of an investment acquired together which haven't been disposed yet.
+
+    Every inflow opens a lot and outflows reduce the oldest lots first. Under the average cost method the cost basis
+    of all open lots of an investment is spread evenly over their shares whenever shares are acquired, so outflows are
+    valued at the average cost while the acquisition dates still determine the holding period. Lots are maintained
+    from the transaction ledger by portfolio.lots.
+
+    :cvar investment: investment the shares belong to
+    :cvar method: cost method the lot is tracked under, see CostMethod
+    :cvar transaction: inflow which opened the lot
+    :cvar acquisition_date: date the shares were acquired
+    :cvar volume: amount of shares left
+    :cvar cost_basis: cost of the shares left
+    """
+
+    investment = models.ForeignKey(
+        Investment, verbose_name=_('investment'), on_delete=models.CASCADE, related_name='lots')
+    method = models.CharField(
+        _('cost method'),
+        max_length=3,
+        choices=(
+            (CostMethod.FIFO, _('First in, first out')),
+            (CostMethod.AVERAGE, _('Average cost')),
+        ),
+    )
+    transaction = models.ForeignKey(
+        Transaction, verbose_name=_('transaction'), on_delete=models.CASCADE, related_name='+')
+    acquisition_date = models.DateField(_('acquisition date'))
+    volume = models.DecimalField(_('volume'), max_digits=15, decimal_places=6)
+    cost_basis = models.DecimalField(_('cost basis'), max_digits=18, decimal_places=6)
+
+    def __str__(self):
+        """Returns a nicely printable string representation of this Lot object.
+
+        :return: a string representation of this lot
+        """
+        return '{} {} ({})'.format(self.method, self.acquisition_date, self.volume)
+
+    class Meta:
+        verbose_name = _('lot')
+        verbose_name_plural = _('lots')
+        indexes = [
+            models.Index(fields=['investment', 'method'], name='portfolio_lot_investment'),
+        ]
+
+
+class RealizedGain(models.Model):
+    """Represents the disposal of shares of a lot by an outflow.
+
+    Outflows spanning several lots are split into one realized gain per lot, so the holding period of every part is
+    known. Shares disposed beyond the volume of all lots have no cost basis and acquisition date.
+
+    :cvar investment: investment the shares belong to
+    :cvar method: cost method the gain was realized under, see CostMethod
+    :cvar transaction: outflow which disposed the shares
+    :cvar date: date of the outflow
+    :cvar acquisition_date: date the disposed shares were acquired
+    :cvar volume: amount of disposed shares
+    :cvar proceeds: value of the disposed shares at the share price of the outflow
+    :cvar cost_basis: cost of the disposed shares
+    """
+
+    investment = models.ForeignKey(
+        Investment, verbose_name=_('investment'), on_delete=models.CASCADE, related_name='realized_gains')
+    method = models.CharField(
+        _('cost method'),
+        max_length=3,
+        choices=(
+            (CostMethod.FIFO, _('First in, first out')),
+            (CostMethod.AVERAGE, _('Average cost')),
+        ),
+    )
+    transaction = models.ForeignKey(
+        Transaction, verbose_name=_('transaction'), on_delete=models.CASCADE, related_name='+')
+    date = models.DateField(_('date'))
+    acquisition_date = models.DateField(_('acquisition date'), blank=True, null=True)
+    volume = models.DecimalField(_('volume'), max_digits=15, decimal_places=6)
+    proceeds = models.DecimalField(_('proceeds'), max_digits=18, decimal_places=6)
+    cost_basis = models.DecimalField(_('cost basis'), max_digits=18, decimal_places=6)
+
+    @property
+    def gain(self):
+        """Returns the realized gain, negative for losses."""
+        return self.proceeds - self.cost_basis
+
+    def __str__(self):
+        """Returns a nicely printable string representation of this RealizedGain object.
+
+        :return: a string representation of this realized gain
+        """
+        return '{} {} ({})'.format(self.method, self.date, self.gain)
+
+    class Meta:
+        verbose_name = _('realized gain')
+        verbose_name_plural = _('realized gains')
+        indexes = [
+            models.Index(fields=['method', 'date'], name='portfolio_gain_method_date'),
+            models.Index(fields=['investment', 'method', 'date'], name='portfolio_gain_investment'),
+        ]
+
+
+class LotCheckpoint(models.Model):
+    """Represents the latest transaction of an investment applied to its lots and realized gains.
+
+    :cvar investment: investment whose ledger was processed
+    :cvar transaction: latest processed transaction in the order of transaction date and id
+    """
+
+    investment = models.OneToOneField(
+        Investment, verbose_name=_('investment'), on_delete=models.CASCADE, primary_key=True,
+        related_name='lot_checkpoint')
+    transaction = models.ForeignKey(
+        Transaction, verbose_name=_('last transaction'), on_delete=models.CASCADE, related_name='+')
+
+    def __str__(self):
+        """Returns a nicely printable string representation of this LotCheckpoint object.
+
+        :return: a string representation of this checkpoint
+        """
+        return '{} ({})'.format(self.investment_id, self.transaction_id)
+
+    class Meta:
+        verbose_name = _('lot checkpoint')
+        verbose_name_plural = _('lot checkpoints')
@@ -0,0 +1,84 @@
+"""Caching of rendered portfolio pages keyed by the versions of the data they show.
+
+Pages are cached in two layers. Complete responses are keyed by a generation stored in the cache backend, which is
+replaced whenever the version of any portfolio is incremented (see PortfolioQuerySet.touch and portfolio.signals), so
+repeated requests of unchanged data are answered from the cache without any database query. Once anything changed,
+the page is rendered again, but the fragment of every portfolio is keyed by the version of that portfolio and only the
+fragments of changed portfolios are rendered and priced.
+
+As the generation has to be shared by all processes, caching is disabled unless a shared Django cache is configured by
+the optional setting PORTFOLIO_PAGE_CACHE, a dictionary with the keys BACKEND (alias of a Django cache or None) and
+TIMEOUT (seconds pages and fragments are kept).
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+DEFAULTS = {
+    'BACKEND': None,
+    'TIMEOUT': 3600,
+}
+
+_GENERATION_KEY = 'portfolio:page-generation'
+
+
+def get_options():
+    """Returns the page cache options merged with their defaults.
+
+    :return: dictionary of options
+    """
+    return dict(DEFAULTS, **getattr(settings, 'PORTFOLIO_PAGE_CACHE', {}))
+
+
+def get_backend():
+    """Returns the Django cache storing pages.
+
+    :return: the cache or None if page caching is disabled
+    """
+    alias = get_options()['BACKEND']
+    return None if alias is None else caches[alias]
+
+
+def generation(backend):
+    """Returns the current generation of the cached pages, creating it if necessary.
+
+    :param backend: Django cache storing pages
+    :return: the generation
+    """
+    value = backend.get(_GENERATION_KEY)
+    if value is None:
+        value = uuid.uuid4().hex
+        if not backend.add(_GENERATION_KEY, value, None):
+            value = backend.get(_GENERATION_KEY, value)
+    return value
+
+
+def invalidate_pages():
+    """Discards all cached pages by starting a new generation.
+
+    The generation is replaced immediately and again once the surrounding transaction commits, so pages rendered from
+    uncommitted data in the meantime are discarded as well.
+    """
+    backend = get_backend()
+    if backend is None:
+        return
+
+    def replace():
+        backend.set(_GENERATION_KEY, uuid.uuid4().hex, None)
+    replace()
+    transaction.on_commit(replace)
+
+
+def page_key(backend, name, *vary_on):
+    """Returns the key of a cached page of the current generation.
+
+    :param backend: Django cache storing pages
+    :param name: name of the page
+    :param vary_on: further values the page depends on, e.g. its path
+    :return: the cache key
+    """
+    digest = hashlib.md5(':'.join(str(value) for value in vary_on).encode()).hexdigest()
+    return 'portfolio:page:{}:{}:{}'.format(name, generation(backend), digest)
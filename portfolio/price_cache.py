@@ -0,0 +1,262 @@
+"""Cache of the latest share prices of assets.
+
+Prices are cached per asset and day in a size bounded in-process LRU cache and optionally in a Django cache backend
+shared between processes. Entries of an asset are invalidated whenever one of its share prices is saved or deleted
+(see portfolio.signals) and again once the change is committed. Entries in the shared backend are versioned per asset,
+so invalidation is a single write. As signals only reach the local cache of the process changing a price, local
+entries expire after a timeout.
+
+The cache is configured by the optional setting PORTFOLIO_PRICE_CACHE, a dictionary with the keys MAX_SIZE (number of
+local entries), TIMEOUT (seconds local entries are valid), BACKEND (alias of a Django cache or None) and
+BACKEND_TIMEOUT (seconds entries are kept in the backend).
+"""
+import collections
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from djmoney.money import Money
+
+from portfolio.archive import latest_prices
+
+# marker cached for assets without any price at a certain date
+_NO_PRICE = 'none'
+
+
+class PriceCache:
+    """Caches the latest share price of assets on or before a day.
+
+    :ivar max_size: maximum number of entries of the local cache
+    :ivar timeout: number of seconds local entries are valid
+    :ivar backend: Django cache used as second tier or None
+    :ivar backend_timeout: number of seconds entries are kept in the backend
+    """
+
+    def __init__(self, max_size=10000, timeout=300, backend=None, backend_timeout=3600):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.backend = caches[backend] if isinstance(backend, str) else backend
+        self.backend_timeout = backend_timeout
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._days_by_asset = collections.defaultdict(set)
+        self._generations = collections.defaultdict(int)
+        self._stats = collections.Counter()
+
+    def get_prices(self, assets, date=None):
+        """Returns the latest price of each asset on or before a day.
+
+        :param assets: collection of assets or asset ids
+        :param date: day of the prices, defaults to today
+        :return: dictionary mapping asset ids to Money objects, assets without price are omitted
+        """
+        date = date or timezone.localdate()
+        asset_ids = {getattr(asset, 'pk', asset) for asset in assets}
+        found = {}
+        missing = self._get_local(asset_ids, date, found)
+        if missing and self.backend is not None:
+            versions = self._backend_versions(missing)
+            missing = self._get_backend(missing, date, versions, found)
+        else:
+            versions = None
+        if missing:
+            self._load(missing, date, versions, found)
+        return {asset_id: price for asset_id, price in found.items() if price is not None}
+
+    def get_price(self, asset, date=None):
+        """Returns the latest price of an asset on or before a day.
+
+        :param asset: asset or asset id
+        :param date: day of the price, defaults to today
+        :return: price as Money object or None if the asset has no price
+        """
+        asset_id = getattr(asset, 'pk', asset)
+        return self.get_prices([asset_id], date).get(asset_id)
+
+    def invalidate(self, asset):
+        """Removes all cached prices of an asset.
+
+        The prices are removed immediately and again once the surrounding transaction commits, so prices cached by
+        readers which didn't see the uncommitted change in the meantime are discarded as well.
+
+        :param asset: asset or asset id
+        """
+        asset_id = getattr(asset, 'pk', asset)
+        with self._lock:
+            self._stats['invalidations'] += 1
+        self._discard(asset_id)
+        transaction.on_commit(lambda: self._discard(asset_id))
+
+    def clear(self):
+        """Removes all entries from the local cache."""
+        with self._lock:
+            self._entries.clear()
+            self._days_by_asset.clear()
+            for asset_id in self._generations:
+                self._generations[asset_id] += 1
+
+    def stats(self):
+        """Returns counters for monitoring the cache.
+
+        :return: dictionary with the number of local hits, backend hits, misses, evictions, invalidations and the
+            current number of local entries
+        """
+        with self._lock:
+            stats = {key: self._stats[key] for key in ('hits', 'backend_hits', 'misses', 'evictions', 'invalidations')}
+            stats['size'] = len(self._entries)
+        return stats
+
+    def reset_stats(self):
+        """Resets all counters to zero."""
+        with self._lock:
+            self._stats.clear()
+
+    def _discard(self, asset_id):
+        """Removes all cached prices of an asset from the local cache and starts a new version in the backend.
+
+        :param asset_id: id of the asset
+        """
+        with self._lock:
+            self._generations[asset_id] += 1
+            for date in self._days_by_asset.pop(asset_id, ()):
+                self._entries.pop((asset_id, date), None)
+        if self.backend is not None:
+            self.backend.set(self._version_key(asset_id), uuid.uuid4().hex, None)
+
+    def _get_local(self, asset_ids, date, found):
+        """Looks up prices in the local cache.
+
+        :param asset_ids: set of asset ids
+        :param date: day of the prices
+        :param found: dictionary receiving the found prices
+        :return: set of asset ids which aren't cached locally
+        """
+        now = time.monotonic()
+        missing = set()
+        with self._lock:
+            for asset_id in asset_ids:
+                entry = self._entries.get((asset_id, date))
+                if entry is None or entry[0] < now:
+                    missing.add(asset_id)
+                    continue
+                self._entries.move_to_end((asset_id, date))
+                found[asset_id] = entry[1]
+            self._stats['hits'] += len(asset_ids) - len(missing)
+        return missing
+
+    def _store_local(self, prices, date, generations):
+        """Stores prices in the local cache evicting the least recently used entries.
+
+        :param prices: dictionary mapping asset ids to prices or None
+        :param date: day of the prices
+        :param generations: generation of each asset when its price was looked up, prices of assets invalidated in the
+            meantime are not stored
+        """
+        expires = time.monotonic() + self.timeout
+        with self._lock:
+            for asset_id, price in prices.items():
+                if self._generations[asset_id] != generations[asset_id]:
+                    continue
+                self._entries[(asset_id, date)] = (expires, price)
+                self._entries.move_to_end((asset_id, date))
+                self._days_by_asset[asset_id].add(date)
+            while len(self._entries) > self.max_size:
+                (asset_id, day), _ = self._entries.popitem(last=False)
+                self._days_by_asset[asset_id].discard(day)
+                if not self._days_by_asset[asset_id]:
+                    del self._days_by_asset[asset_id]
+                self._stats['evictions'] += 1
+
+    @staticmethod
+    def _version_key(asset_id):
+        return 'portfolio:price-version:{}'.format(asset_id)
+
+    @staticmethod
+    def _price_key(asset_id, version, date):
+        return 'portfolio:price:{}:{}:{}'.format(asset_id, version, date.isoformat())
+
+    def _backend_versions(self, asset_ids):
+        """Returns the current version of each asset in the backend, creating missing versions.
+
+        :param asset_ids: set of asset ids
+        :return: dictionary mapping asset ids to versions
+        """
+        keys = {self._version_key(asset_id): asset_id for asset_id in asset_ids}
+        versions = {keys[key]: version for key, version in self.backend.get_many(list(keys)).items()}
+        for asset_id in asset_ids.difference(versions):
+            version = uuid.uuid4().hex
+            if not self.backend.add(self._version_key(asset_id), version, None):
+                version = self.backend.get(self._version_key(asset_id), version)
+            versions[asset_id] = version
+        return versions
+
+    def _get_backend(self, asset_ids, date, versions, found):
+        """Looks up prices in the backend and copies them to the local cache.
+
+        :param asset_ids: set of asset ids
+        :param date: day of the prices
+        :param versions: dictionary mapping asset ids to backend versions
+        :param found: dictionary receiving the found prices
+        :return: set of asset ids which aren't cached in the backend
+        """
+        with self._lock:
+            generations = {asset_id: self._generations[asset_id] for asset_id in asset_ids}
+        keys = {self._price_key(asset_id, versions[asset_id], date): asset_id for asset_id in asset_ids}
+        cached = {}
+        for key, value in self.backend.get_many(list(keys)).items():
+            cached[keys[key]] = None if value == _NO_PRICE else Money(*value)
+        found.update(cached)
+        self._store_local(cached, date, generations)
+        with self._lock:
+            self._stats['backend_hits'] += len(cached)
+        return asset_ids.difference(cached)
+
+    def _load(self, asset_ids, date, versions, found):
+        """Loads prices from the database with a single query and from the archive and stores them in all cache tiers.
+
+        :param asset_ids: set of asset ids
+        :param date: day of the prices
+        :param versions: dictionary mapping asset ids to backend versions or None without backend
+        :param found: dictionary receiving the loaded prices
+        """
+        with self._lock:
+            generations = {asset_id: self._generations[asset_id] for asset_id in asset_ids}
+            self._stats['misses'] += len(asset_ids)
+        prices = dict.fromkeys(asset_ids)
+        for asset_id, (amount, currency) in latest_prices(asset_ids, date).items():
+            prices[asset_id] = Money(amount, currency)
+        found.update(prices)
+        self._store_local(prices, date, generations)
+        if versions is not None:
+            self.backend.set_many({
+                self._price_key(asset_id, versions[asset_id], date):
+                    _NO_PRICE if price is None else (price.amount, str(price.currency))
+                for asset_id, price in prices.items()
+            }, self.backend_timeout)
+
+
+_price_cache = None
+_price_cache_lock = threading.Lock()
+
+
+def get_price_cache():
+    """Returns the price cache of this process configured by the setting PORTFOLIO_PRICE_CACHE.
+
+    :return: the shared PriceCache instance
+    """
+    global _price_cache
+    if _price_cache is None:
+        with _price_cache_lock:
+            if _price_cache is None:
+                options = getattr(settings, 'PORTFOLIO_PRICE_CACHE', {})
+                _price_cache = PriceCache(
+                    max_size=options.get('MAX_SIZE', 10000),
+                    timeout=options.get('TIMEOUT', 300),
+                    backend=options.get('BACKEND'),
+                    backend_timeout=options.get('BACKEND_TIMEOUT', 3600),
+                )
+    return _price_cache
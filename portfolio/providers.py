@@ -0,0 +1,311 @@
+"""Price providers and the concurrent updater fetching the latest share prices of held assets.
+
+A provider fetches quotes of a batch of ISINs and returns PriceRecord objects. The PriceUpdater splits the held assets
+into batches, fetches them in a bounded pool of threads while respecting the rate limit of the provider, retries
+failed batches with exponential backoff and writes the received prices with a PriceImporter in the calling thread.
+Thus fetching doesn't touch the database and writes are batched independently of the provider's batch size.
+
+Providers are plugins configured by the optional setting PORTFOLIO_PRICE_PROVIDERS, a dictionary mapping provider
+names to dictionaries with the keys CLASS (dotted path of a PriceProvider subclass) and OPTIONS (keyword arguments of
+the class). FileProvider and HttpProvider are included, the former serves quotes from a local file for tests and
+development.
+"""
+import concurrent.futures
+import http.client
+import io
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from portfolio.importers import (
+    ImportDataError, ImportMode, ImportResult, PriceImporter, chunked, read_csv_prices, read_json_prices,
+)
+from portfolio.models import Asset
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """Raised if a provider fails to fetch quotes.
+
+    :ivar retryable: whether the request may succeed if it is repeated, e.g. after a timeout
+    """
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of requests of all threads sharing it.
+
+    :ivar rate: number of requests per second
+    :ivar burst: number of requests which may be sent at once after a pause
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class PriceProvider:
+    """Base class of price providers.
+
+    Subclasses implement fetch, which is called concurrently by several threads and must be thread-safe.
+
+    :cvar batch_size: maximum number of ISINs fetched with one request
+    :ivar limiter: RateLimiter shared by all threads using this provider or None
+    """
+
+    batch_size = 100
+
+    def __init__(self, rate=None, burst=1, batch_size=None):
+        """Initializes the provider.
+
+        :param rate: maximum number of requests per second, by default requests aren't limited
+        :param burst: number of requests which may be sent at once after a pause
+        :param batch_size: maximum number of ISINs per request, defaults to the batch size of the class
+        """
+        self.limiter = RateLimiter(rate, burst) if rate else None
+        if batch_size:
+            self.batch_size = batch_size
+
+    def fetch(self, isins):
+        """Fetches the latest quotes of assets.
+
+        :param isins: list of ISINs
+        :return: list of PriceRecord objects, ISINs without quote are omitted
+        :raises ProviderError: if the quotes can't be fetched
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the resources of the provider, e.g. open connections."""
+
+
+class FileProvider(PriceProvider):
+    """Serves the latest quote of each ISIN contained in a CSV or JSON file.
+
+    The file has the format of the import_prices command and is read once on first use.
+
+    :ivar path: path of the file
+    :ivar default_currency: currency of quotes without explicit currency
+    """
+
+    batch_size = 1000
+
+    def __init__(self, path, default_currency='USD', **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.default_currency = default_currency
+        self._quotes = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._quotes is None:
+                reader = read_csv_prices if os.path.splitext(self.path)[1].lower() == '.csv' else read_json_prices
+                quotes = {}
+                try:
+                    with open(self.path, newline='', encoding='utf-8') as stream:
+                        for record in reader(stream, default_currency=self.default_currency):
+                            if record.isin not in quotes or record.date >= quotes[record.isin].date:
+                                quotes[record.isin] = record
+                except (OSError, ImportDataError) as error:
+                    raise ProviderError('Failed to read {}: {}'.format(self.path, error))
+                self._quotes = quotes
+            return self._quotes
+
+    def fetch(self, isins):
+        quotes = self._load()
+        return [quotes[isin] for isin in isins if isin in quotes]
+
+
+class HttpProvider(PriceProvider):
+    """Fetches quotes from an HTTP endpoint.
+
+    The ISINs of a batch are sent as repeated query parameter isin with a GET request to url. The endpoint answers with
+    a JSON array or JSON lines of objects with the keys isin, date, price and optionally currency. Every thread keeps
+    its connection open between requests. Connection errors, timeouts, 429 and 5xx responses are retryable.
+
+    :ivar url: URL of the endpoint
+    :ivar headers: dictionary of headers sent with every request, e.g. an API key
+    :ivar timeout: seconds to wait for a response
+    :ivar default_currency: currency of quotes without explicit currency
+    """
+
+    def __init__(self, url, headers=None, timeout=10, default_currency='USD', **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.default_currency = default_currency
+        self._parts = urllib.parse.urlsplit(url)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            cls = http.client.HTTPSConnection if self._parts.scheme == 'https' else http.client.HTTPConnection
+            connection = self._local.connection = cls(self._parts.netloc, timeout=self.timeout)
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def fetch(self, isins):
+        query = urllib.parse.urlencode([('isin', isin) for isin in isins])
+        if self._parts.query:
+            query = self._parts.query + '&' + query
+        connection = self._connection()
+        try:
+            connection.request('GET', '{}?{}'.format(self._parts.path or '/', query), headers=self.headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as error:
+            connection.close()
+            raise ProviderError('Request to {} failed: {}'.format(self._parts.netloc, error), retryable=True)
+        if response.status != 200:
+            raise ProviderError('{} answered {} {}'.format(self._parts.netloc, response.status, response.reason),
+                                retryable=response.status == 429 or response.status >= 500)
+        try:
+            return list(read_json_prices(io.StringIO(body.decode('utf-8')), default_currency=self.default_currency))
+        except (UnicodeDecodeError, ImportDataError) as error:
+            raise ProviderError('Invalid response of {}: {}'.format(self._parts.netloc, error))
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def get_provider(name='default'):
+    """Creates a provider configured by the setting PORTFOLIO_PRICE_PROVIDERS.
+
+    :param name: name of the provider
+    :return: PriceProvider instance
+    :raises ImproperlyConfigured: if no provider of that name is configured
+    """
+    providers = getattr(settings, 'PORTFOLIO_PRICE_PROVIDERS', {})
+    if name not in providers:
+        raise ImproperlyConfigured('The price provider {} is not configured in PORTFOLIO_PRICE_PROVIDERS.'.format(name))
+    return import_string(providers[name]['CLASS'])(**providers[name].get('OPTIONS', {}))
+
+
+class UpdateResult(ImportResult):
+    """Collects statistics of an update run.
+
+    :ivar requested: number of ISINs requested from the provider
+    :ivar failed_isins: set of ISINs whose batch couldn't be fetched
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.requested = 0
+        self.failed_isins = set()
+
+    def __str__(self):
+        """Returns a nicely printable summary of this update run.
+
+        :return: a string representation of the update statistics
+        """
+        return '{} requested, {} failed, {}'.format(self.requested, len(self.failed_isins), super().__str__())
+
+
+class PriceUpdater:
+    """Fetches quotes of assets concurrently and writes them into the database.
+
+    :ivar provider: PriceProvider to fetch from
+    :ivar workers: maximum number of concurrent requests
+    :ivar retries: number of times a retryable failure of a batch is repeated
+    :ivar backoff: seconds to wait before the first retry, doubled for every further retry
+    :ivar importer: PriceImporter writing the quotes
+    """
+
+    def __init__(self, provider, workers=8, retries=3, backoff=1.0, batch_size=5000, mode=ImportMode.REPLACE):
+        self.provider = provider
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.importer = PriceImporter(batch_size=batch_size, mode=mode)
+
+    @staticmethod
+    def held_isins(assets=None):
+        """Returns the ISINs of all assets currently held in any portfolio.
+
+        :param assets: collection of asset ids to restrict the assets to
+        :return: sorted list of ISINs
+        """
+        queryset = Asset.objects.filter(investment__holding__volume__gt=0)
+        if assets is not None:
+            queryset = queryset.filter(pk__in=assets)
+        return sorted(set(queryset.values_list('isin', flat=True)))
+
+    def fetch(self, isins):
+        """Fetches one batch of quotes respecting the rate limit and retrying retryable failures.
+
+        :param isins: list of ISINs
+        :return: list of PriceRecord objects
+        :raises ProviderError: if the batch failed permanently
+        """
+        for attempt in range(self.retries + 1):
+            if self.provider.limiter is not None:
+                self.provider.limiter.acquire()
+            try:
+                return self.provider.fetch(isins)
+            except ProviderError as error:
+                if not error.retryable or attempt == self.retries:
+                    raise
+                logger.info('Retrying %d quotes after error: %s', len(isins), error)
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def run(self, isins=None):
+        """Fetches and writes the quotes of assets.
+
+        Quotes are written in batches while further batches are still fetched.
+
+        :param isins: ISINs to update, defaults to all held assets
+        :return: UpdateResult with statistics of this run
+        """
+        isins = self.held_isins() if isins is None else list(isins)
+        result = UpdateResult()
+        result.requested = len(isins)
+        records = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch, batch): batch for batch in chunked(isins, self.provider.batch_size)}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    records.extend(future.result())
+                except ProviderError as error:
+                    logger.warning('Failed to fetch %d quotes: %s', len(futures[future]), error)
+                    result.failed_isins.update(futures[future])
+                if len(records) >= self.importer.batch_size:
+                    self.importer.run(records, result)
+                    records = []
+        self.importer.run(records, result)
+        return result
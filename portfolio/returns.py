@@ -0,0 +1,192 @@
+"""Time-weighted and money-weighted returns of investments and portfolios.
+
+Market values and external cash flows of all investments are loaded once as daily matrices (see
+portfolio.valuation.value_history). Returns of any number of investments or portfolios over any number of periods are
+then evaluated with vectorized NumPy operations without further database access.
+
+The time-weighted return (TWR) chains daily returns (V[t] - F[t]) / V[t - 1], where V is the market value at the end of
+a day and F the external cash flow on that day. The money-weighted return is the annualized internal rate of return
+(XIRR) of the value at the beginning of the period, the cash flows within the period and the value at its end.
+"""
+import numpy as np
+
+from portfolio.utils import local_date
+from portfolio.valuation import value_history
+
+DAYS_PER_YEAR = 365.0
+
+
+def time_weighted_returns(values, flows, starts, ends):
+    """Computes time-weighted returns for several rows and periods at once.
+
+    :param values: matrix of daily market values with one row per entity
+    :param flows: matrix of daily external cash flows aligned with values
+    :param starts: day index of the beginning of each period, the period starts at the end of this day
+    :param ends: day index of the end of each period
+    :return: matrix of returns with one row per entity and one column per period, NaN if never invested
+    """
+    previous = values[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = np.where(previous > 0, (values[:, 1:] - flows[:, 1:]) / previous, 1.0)
+        log_growth = np.log(np.clip(growth, 1e-12, None))
+    cumulative = np.zeros(values.shape)
+    np.cumsum(log_growth, axis=1, out=cumulative[:, 1:])
+    returns = np.expm1(cumulative[:, ends] - cumulative[:, starts])
+
+    # entities without any market value within a period have no meaningful return
+    invested = np.zeros(values.shape)
+    np.cumsum(values > 0, axis=1, out=invested)
+    exposure = invested[:, ends] - invested[:, starts] + (values[:, starts] > 0)
+    returns[exposure == 0] = np.nan
+    return returns
+
+
+def solve_xirr(problem, times, amounts, count, tolerance=1e-10, max_iterations=100, bounds=(-10.0, 10.0)):
+    """Solves many internal rate of return problems simultaneously.
+
+    Each problem is defined by the cash flows whose problem index equals the problem's number. The continuously
+    compounded rate x is searched within bounds using Newton's method, falling back to bisection whenever a Newton step
+    leaves the current bracket. The net present value of a problem is sum(amount * exp(-time * x)).
+
+    :param problem: problem index of each cash flow
+    :param times: time of each cash flow in years since the beginning of its problem
+    :param amounts: amount of each cash flow from the investor's point of view, negative for payments
+    :param count: number of problems
+    :param tolerance: convergence tolerance of the rate
+    :param max_iterations: maximum number of iterations
+    :param bounds: bracket of the continuously compounded rate
+    :return: array of annual rates, NaN for problems without a root within bounds
+    """
+
+    def npv(rates):
+        with np.errstate(over='ignore', invalid='ignore'):
+            discounted = amounts * np.exp(-times * rates[problem])
+            value = np.bincount(problem, weights=discounted, minlength=count)
+            derivative = -np.bincount(problem, weights=times * discounted, minlength=count)
+        return value, derivative
+
+    low = np.full(count, bounds[0])
+    high = np.full(count, bounds[1])
+    low_value = npv(low)[0]
+    high_value = npv(high)[0]
+    solvable = np.isfinite(low_value) & np.isfinite(high_value) & (np.sign(low_value) * np.sign(high_value) < 0)
+
+    rates = np.zeros(count)
+    for _ in range(max_iterations):
+        value, derivative = npv(rates)
+        # shrink the bracket around the root
+        below = np.sign(value) == np.sign(low_value)
+        low = np.where(below, rates, low)
+        low_value = np.where(below, value, low_value)
+        high = np.where(below, high, rates)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidate = rates - value / derivative
+        bisect = ~np.isfinite(candidate) | (candidate <= np.minimum(low, high)) | (candidate >= np.maximum(low, high))
+        candidate = np.where(bisect, (low + high) / 2, candidate)
+        done = np.abs(candidate - rates) < tolerance
+        rates = candidate
+        if done[solvable].all():
+            break
+
+    result = np.expm1(rates)
+    result[~solvable] = np.nan
+    return result
+
+
+def money_weighted_returns(values, flows, days, starts, ends):
+    """Computes annualized money-weighted returns (XIRR) for several rows and periods at once.
+
+    :param values: matrix of daily market values with one row per entity
+    :param flows: matrix of daily external cash flows aligned with values
+    :param days: day number of each column, e.g. days since the epoch
+    :param starts: day index of the beginning of each period, the period starts at the end of this day
+    :param ends: day index of the end of each period
+    :return: matrix of returns with one row per entity and one column per period
+    """
+    entities = values.shape[0]
+    flow_rows, flow_days = np.nonzero(flows)
+    problems, times, amounts = [], [], []
+    for period, (start, end) in enumerate(zip(starts, ends)):
+        offset = period * entities
+        # the value at the beginning is invested, flows within the period are paid and the final value is received
+        rows = np.arange(entities)
+        problems.append(offset + rows)
+        times.append(np.zeros(entities))
+        amounts.append(-values[:, start])
+
+        within = (flow_days > start) & (flow_days <= end)
+        problems.append(offset + flow_rows[within])
+        times.append((days[flow_days[within]] - days[start]) / DAYS_PER_YEAR)
+        amounts.append(-flows[flow_rows[within], flow_days[within]])
+
+        problems.append(offset + rows)
+        times.append(np.full(entities, (days[end] - days[start]) / DAYS_PER_YEAR))
+        amounts.append(values[:, end])
+
+    rates = solve_xirr(
+        np.concatenate(problems), np.concatenate(times), np.concatenate(amounts), entities * len(starts))
+    return rates.reshape(len(starts), entities).T
+
+
+class Returns:
+    """Returns of several investments or portfolios over several periods.
+
+    :ivar ids: ids of the investments or portfolios, one per row
+    :ivar periods: list of (start, end) dates, one per column
+    :ivar twr: matrix of time-weighted returns
+    :ivar xirr: matrix of annualized money-weighted returns
+    """
+
+    def __init__(self, ids, periods, twr, xirr):
+        self.ids = ids
+        self.periods = periods
+        self.twr = twr
+        self.xirr = xirr
+
+    def as_dict(self):
+        """Returns the returns per id and period.
+
+        :return: dictionary mapping ids to lists of dictionaries with the keys start, end, twr and xirr
+        """
+        return {
+            entity_id: [
+                {'start': start, 'end': end, 'twr': self.twr[row, column], 'xirr': self.xirr[row, column]}
+                for column, (start, end) in enumerate(self.periods)
+            ]
+            for row, entity_id in enumerate(self.ids)
+        }
+
+
+def compute_returns(portfolios, periods, by_investment=False, currency=None):
+    """Computes time-weighted and money-weighted returns of portfolios or their investments.
+
+    All data is loaded with four queries regardless of the number of portfolios and periods.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them
+    :param periods: list of (start, end) tuples of dates, a period covers the changes after start until end
+    :param by_investment: compute returns of each investment instead of each portfolio
+    :param currency: currency code values and cash flows are converted to before computing returns, which is required
+        for portfolios investing in assets priced in different currencies
+    :return: Returns object with one row per portfolio or investment and one column per period
+    """
+    periods = [(local_date(start), local_date(end)) for start, end in periods]
+    if any(start > end for start, end in periods):
+        raise ValueError('Periods must not end before they start')
+    if not periods:
+        raise ValueError('At least one period is required')
+    first = min(start for start, _ in periods)
+    history = value_history(portfolios, first, max(end for _, end in periods), currency=currency)
+
+    if by_investment:
+        ids, values, flows = history.investment_ids, history.values, history.flows
+    else:
+        ids, values = history.aggregate(history.values)
+        flows = history.aggregate(history.flows)[1]
+    starts = np.array([(start - first).days for start, _ in periods], dtype=np.int64)
+    ends = np.array([(end - first).days for _, end in periods], dtype=np.int64)
+    days = (history.dates - history.dates[0]).astype(np.float64)
+
+    twr = time_weighted_returns(values, flows, starts, ends)
+    xirr = money_weighted_returns(values, flows, days, starts, ends)
+    return Returns(ids.tolist(), periods, twr, xirr)
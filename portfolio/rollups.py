@@ -0,0 +1,189 @@
+"""Maintenance of the open, high, low and close price bars of assets.
+
+New share prices are added to the daily, weekly and monthly bars containing them incrementally. Changes which can't
+be applied incrementally, i.e. changed or deleted prices, rebuild the affected bars from the share prices. Bars of
+whole periods are rebuilt by streaming the share prices, including archived ones (see portfolio.archive), ordered by
+asset and date. Rebuilds triggered by single share prices are deferred until the surrounding transaction is committed
+and combined per asset, so deleting an asset or many of its prices at once rebuilds its bars only once.
+"""
+import datetime
+import itertools
+import threading
+
+from django.db import transaction
+
+from portfolio.archive import merge_rows
+from portfolio.models import Asset, PriceBar, Resolution, SharePrice
+from portfolio.utils import day_start, local_date
+
+_FIELDS = ('open', 'high', 'low', 'close', 'currency', 'open_date', 'close_date', 'count')
+
+# days of the pending rebuilds of the current thread by asset id
+_pending = threading.local()
+
+
+def _new_bar(asset_id, resolution, period_start, date, amount, currency):
+    """Creates an unsaved bar containing a single price."""
+    return PriceBar(
+        asset_id=asset_id, resolution=resolution, period_start=period_start, open=amount, high=amount, low=amount,
+        close=amount, currency=currency, open_date=date, close_date=date, count=1)
+
+
+def _apply(bar, date, amount, currency):
+    """Adds a single price to a bar.
+
+    :param bar: bar to update, it isn't saved
+    :param date: date of the price
+    :param amount: the price
+    :param currency: currency code of the price
+    """
+    if date < bar.open_date:
+        bar.open = amount
+        bar.open_date = date
+    if date >= bar.close_date:
+        bar.close = amount
+        bar.close_date = date
+        bar.currency = currency
+    bar.high = max(bar.high, amount)
+    bar.low = min(bar.low, amount)
+    bar.count += 1
+
+
+def add_prices(prices):
+    """Adds newly created share prices to the bars of all resolutions.
+
+    All affected bars are loaded with a single query and written with one bulk insert and one bulk update.
+
+    :param prices: iterable of (asset id, date, amount, currency) tuples of prices which weren't added before
+    """
+    updates = {}
+    for asset_id, date, amount, currency in prices:
+        day = local_date(date)
+        for resolution in Resolution.ALL:
+            key = (asset_id, resolution, Resolution.period_start(resolution, day))
+            updates.setdefault(key, []).append((date, amount, currency))
+    if not updates:
+        return
+
+    first = min(period_start for _, _, period_start in updates)
+    last = max(period_start for _, _, period_start in updates)
+    existing = {
+        (bar.asset_id, bar.resolution, bar.period_start): bar
+        for bar in PriceBar.objects.filter(
+            asset__in={asset_id for asset_id, _, _ in updates}, period_start__range=(first, last))
+    }
+    created, changed = [], []
+    for key, values in updates.items():
+        values.sort(key=lambda value: value[0])
+        bar = existing.get(key)
+        if bar is None:
+            bar = _new_bar(*key, *values[0])
+            values = values[1:]
+            created.append(bar)
+        else:
+            changed.append(bar)
+        for value in values:
+            _apply(bar, *value)
+    with transaction.atomic():
+        PriceBar.objects.bulk_create(created)
+        PriceBar.objects.bulk_update(changed, _FIELDS)
+
+
+def _compute_bars(prices):
+    """Computes the bars of share prices ordered by asset and date.
+
+    :param prices: iterable of (asset id, date, amount, currency) tuples ordered by asset and date
+    :return: generator yielding unsaved bars
+    """
+    for asset_id, rows in itertools.groupby(prices, key=lambda row: row[0]):
+        current = {}
+        for _, date, amount, currency in rows:
+            day = local_date(date)
+            for resolution in Resolution.ALL:
+                period_start = Resolution.period_start(resolution, day)
+                bar = current.get(resolution)
+                if bar is not None and bar.period_start == period_start:
+                    _apply(bar, date, amount, currency)
+                    continue
+                if bar is not None:
+                    yield bar
+                current[resolution] = _new_bar(asset_id, resolution, period_start, date, amount, currency)
+        yield from current.values()
+
+
+def rebuild_bars(assets=None, start=None, end=None, batch_size=5000):
+    """Recomputes the bars of assets from their share prices.
+
+    If start or end are given, only the bars of periods overlapping the days between start and end are rebuilt.
+
+    :param assets: collection of asset ids, defaults to all assets
+    :param start: first day whose bars are rebuilt or None for all days before end
+    :param end: last day whose bars are rebuilt or None for all days after start
+    :param batch_size: number of bars written at once
+    :return: number of rebuilt bars
+    """
+    prices = SharePrice.objects.all()
+    bars = PriceBar.objects.all()
+    archive_start = archive_end = None
+    if assets is not None:
+        prices = prices.filter(asset__in=assets)
+        bars = bars.filter(asset__in=assets)
+    lower = upper = None
+    if start is not None:
+        # the first periods of all resolutions overlapping start
+        lower = min(Resolution.period_start(resolution, start) for resolution in Resolution.ALL)
+        archive_start = day_start(lower)
+        prices = prices.filter(date__gte=archive_start)
+        bars = bars.filter(period_start__gte=lower)
+    if end is not None:
+        # prices until the end of the last periods of all resolutions overlapping end
+        next_month = (end.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        next_week = Resolution.period_start(Resolution.WEEK, end) + datetime.timedelta(days=7)
+        upper = end
+        archive_end = day_start(max(next_month, next_week))
+        prices = prices.filter(date__lt=archive_end)
+        bars = bars.filter(period_start__lte=end)
+
+    rows = prices.order_by('asset_id', 'date').values_list('asset_id', 'date', 'price', 'price_currency')
+    rows = merge_rows(rows.iterator(), assets, archive_start, archive_end)
+    # bars of periods starting before lower are incomplete, those starting after upper are kept
+    computed = (bar for bar in _compute_bars(rows)
+                if (lower is None or bar.period_start >= lower) and (upper is None or bar.period_start <= upper))
+    count = 0
+    with transaction.atomic():
+        bars.delete()
+        while True:
+            chunk = list(itertools.islice(computed, batch_size))
+            if not chunk:
+                break
+            PriceBar.objects.bulk_create(chunk)
+            count += len(chunk)
+    return count
+
+
+def schedule_rebuild(asset_id, day):
+    """Rebuilds the bars of an asset containing a day once the current transaction is committed.
+
+    Rebuilds scheduled before the commit are combined into one rebuild per asset covering the days from the first to
+    the last scheduled day. Assets deleted in the meantime are skipped, their bars are deleted with them.
+
+    :param asset_id: id of the asset
+    :param day: the day whose bars are rebuilt
+    """
+    days = getattr(_pending, 'days', None)
+    if days is None:
+        days = _pending.days = {}
+    first, last = days.get(asset_id, (day, day))
+    days[asset_id] = (min(first, day), max(last, day))
+    # registered for every call, a rolled back savepoint discards its callbacks but not the collected days
+    transaction.on_commit(_rebuild_pending)
+
+
+def _rebuild_pending():
+    """Runs the rebuilds collected by schedule_rebuild."""
+    days = getattr(_pending, 'days', None)
+    _pending.days = None
+    if not days:
+        return
+    for asset_id in Asset.objects.filter(pk__in=list(days)).order_by('pk').values_list('pk', flat=True):
+        rebuild_bars([asset_id], *days[asset_id])
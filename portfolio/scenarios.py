@@ -0,0 +1,191 @@
+"""NumPy kernels evaluating rebalancing scenarios of a portfolio.
+
+The kernels operate on plain arrays batched over scenarios and don't import Django, so the worker processes of a
+process pool can import them without a configured project (see portfolio.simulation).
+
+Arrays follow these conventions: holdings and trades have one row per scenario and one column per asset, prices have
+one row per asset and one column per day, membership is a matrix with one row per asset and one column per group
+containing 1 for the group of the asset, targets contain the weight of each group. Assets without a known price are
+valued at zero and can't be traded.
+"""
+import numpy as np
+
+FREQUENCIES = ('never', 'daily', 'weekly', 'monthly', 'quarterly', 'yearly')
+
+
+def schedule(dates, frequency):
+    """Returns the days on which a periodic rebalancing is due.
+
+    Rebalancing is due on the first day of each period within dates, except for the first day itself.
+
+    :param dates: days as datetime64[D]
+    :param frequency: one of FREQUENCIES
+    :return: boolean array aligned with dates
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError('Unknown frequency: {}'.format(frequency))
+    due = np.zeros(len(dates), dtype=bool)
+    if frequency == 'never' or not len(dates):
+        return due
+    if frequency == 'daily':
+        periods = dates
+    elif frequency == 'weekly':
+        # datetime64 weeks start on Thursday, shift them to start on Monday
+        periods = (dates - np.timedelta64(4, 'D')).astype('datetime64[W]')
+    elif frequency == 'monthly':
+        periods = dates.astype('datetime64[M]')
+    elif frequency == 'quarterly':
+        periods = dates.astype('datetime64[M]').astype(np.int64) // 3
+    else:
+        periods = dates.astype('datetime64[Y]')
+    due[1:] = periods[1:] != periods[:-1]
+    return due
+
+
+def group_weights(values, membership, totals):
+    """Computes the weight of each group.
+
+    :param values: matrix of market values with one row per scenario and one column per asset
+    :param membership: membership matrix of the assets
+    :param totals: total value of each scenario including cash
+    :return: matrix of weights with one row per scenario and one column per group, zero for empty scenarios
+    """
+    weights = np.zeros((len(values), membership.shape[1]))
+    np.divide(values @ membership, totals[:, np.newaxis], out=weights, where=totals[:, np.newaxis] > 0)
+    return weights
+
+
+def drift(weights, target):
+    """Computes the distance between allocations and the target, i.e. the fraction of the value in the wrong group.
+
+    :param weights: matrix of group weights with one row per scenario
+    :param target: target weight of each group
+    :return: array of distances between 0 and 1
+    """
+    return np.abs(weights - target).sum(axis=-1) / 2
+
+
+def rebalance(holdings, totals, prices, membership, target):
+    """Computes the holdings matching the target allocation.
+
+    The target weight of a group is split among its assets in proportion to their current value, equally if the group
+    has no value yet. Weight of groups without a tradable asset is kept in cash.
+
+    :param holdings: matrix of holdings with one row per scenario and one column per asset
+    :param totals: total value of each scenario including cash
+    :param prices: price of each asset, NaN if unknown
+    :param membership: membership matrix of the assets
+    :param target: target weight of each group
+    :return: tuple of (matrix of new holdings, traded value of each scenario)
+    """
+    tradable = ~np.isnan(prices)
+    prices = np.where(tradable, prices, 0.0)
+    values = holdings * prices
+    group_values = (values @ membership) @ membership.T
+    counts = (tradable @ membership) @ membership.T
+    equal = np.zeros(len(prices))
+    np.divide(tradable, counts, out=equal, where=counts > 0)
+    shares = np.broadcast_to(equal, values.shape).copy()
+    np.divide(values, group_values, out=shares, where=group_values > 0)
+    weights = shares * (target @ membership.T)
+
+    rebalanced = holdings.copy()
+    np.divide(weights * totals[:, np.newaxis], prices, out=rebalanced, where=tradable)
+    return rebalanced, (np.abs(rebalanced - holdings) * prices).sum(axis=1)
+
+
+def evaluate_trades(holdings, prices, trades, membership, target=None, cost=0.0):
+    """Evaluates candidate trade sets executed at the same prices.
+
+    :param holdings: current holding of each asset
+    :param prices: price of each asset, NaN if unknown
+    :param trades: matrix of traded volumes with one row per scenario and one column per asset, negative for sales
+    :param membership: membership matrix of the assets
+    :param target: target weight of each group, by default the drift isn't computed
+    :param cost: transaction costs as fraction of the traded value
+    :return: dictionary of arrays with one entry per scenario: market_value, cash (net cash flow of the trades and
+        costs, negative if money has to be paid in), turnover, costs, feasible (no short positions and no trades of
+        assets without price), weights (matrix of group weights) and drift if a target is given
+    """
+    tradable = ~np.isnan(prices)
+    prices = np.where(tradable, prices, 0.0)
+    volume = holdings + trades
+    values = volume * prices
+    market_value = values.sum(axis=1)
+    turnover = (np.abs(trades) * prices).sum(axis=1)
+    costs = turnover * cost
+    result = {
+        'market_value': market_value,
+        'cash': -(trades @ prices) - costs,
+        'turnover': turnover,
+        'costs': costs,
+        'feasible': (volume >= 0).all(axis=1) & (trades[:, ~tradable] == 0).all(axis=1),
+        'weights': group_weights(values, membership, market_value),
+    }
+    if target is not None:
+        result['drift'] = drift(result['weights'], target)
+    return result
+
+
+def simulate(holdings, prices, membership, target, due, thresholds, cost=0.0):
+    """Simulates rebalancing schedules over the price history.
+
+    The portfolio starts with the given holdings and no cash. On every due day of a scenario whose drift exceeds its
+    threshold the holdings are rebalanced to the target, transaction costs are paid from the cash. Days are processed
+    one after another, all scenarios at once.
+
+    :param holdings: holding of each asset at the first day
+    :param prices: matrix of daily prices with one row per asset, NaN for days before the first known price
+    :param membership: membership matrix of the assets
+    :param target: target weight of each group
+    :param due: boolean matrix with one row per scenario and one column per day marking the days to rebalance on
+    :param thresholds: minimum drift of each scenario triggering a rebalancing on a due day
+    :param cost: transaction costs as fraction of the traded value
+    :return: dictionary of arrays with one entry per scenario: values (matrix of daily total values including cash),
+        cash (final cash), rebalances (number of rebalancings), turnover, costs and weights (final group weights)
+    """
+    count, days = due.shape
+    holdings = np.tile(np.asarray(holdings, dtype=np.float64), (count, 1))
+    cash = np.zeros(count)
+    values = np.zeros((count, days))
+    rebalances = np.zeros(count, dtype=np.int64)
+    turnover = np.zeros(count)
+    costs = np.zeros(count)
+    totals = cash
+    for day in range(days):
+        day_prices = prices[:, day]
+        valued = np.where(np.isnan(day_prices), 0.0, day_prices)
+        totals = holdings @ valued + cash
+        if due[:, day].any():
+            rebalanced = due[:, day] & (
+                drift(group_weights(holdings * valued, membership, totals), target) > thresholds)
+            if rebalanced.any():
+                new_holdings, traded = rebalance(
+                    holdings[rebalanced], totals[rebalanced], day_prices, membership, target)
+                holdings[rebalanced] = new_holdings
+                cash[rebalanced] = totals[rebalanced] - new_holdings @ valued - traded * cost
+                rebalances[rebalanced] += 1
+                turnover[rebalanced] += traded
+                costs[rebalanced] += traded * cost
+                totals = holdings @ valued + cash
+        values[:, day] = totals
+    last = prices[:, -1] if days else np.zeros(len(prices))
+    last = np.where(np.isnan(last), 0.0, last)
+    return {
+        'values': values,
+        'cash': cash,
+        'rebalances': rebalances,
+        'turnover': turnover,
+        'costs': costs,
+        'weights': group_weights(holdings * last, membership, totals),
+    }
+
+
+def run_chunk(arguments):
+    """Calls a kernel in a worker process.
+
+    :param arguments: tuple of the kernel function and its positional arguments
+    :return: the result of the kernel
+    """
+    function, args = arguments
+    return function(*args)
@@ -0,0 +1,172 @@
+"""Signal receivers keeping derived data of the portfolio app up to date."""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from portfolio import holdings, lots, rollups
+from portfolio.archive import get_archive
+from portfolio.models import (
+    Asset, Bond, Fund, Holding, Investment, Portfolio, SharePrice, Stock, Transaction, portfolios_touched,
+)
+from portfolio.page_cache import invalidate_pages
+from portfolio.price_cache import get_price_cache
+from portfolio.utils import local_date
+
+
+@receiver(post_save, sender=Investment, dispatch_uid='portfolio_create_holding')
+def create_holding(sender, instance, created, raw=False, **kwargs):
+    """Creates an empty holding for every new investment."""
+    if created and not raw:
+        Holding.objects.get_or_create(investment=instance)
+
+
+@receiver(pre_save, sender=Transaction, dispatch_uid='portfolio_remember_transaction_investment')
+def remember_transaction_investment(sender, instance, raw=False, **kwargs):
+    """Remembers the investment a transaction belonged to before it is changed."""
+    if instance.pk is not None and not raw:
+        instance._previous_investment_id = Transaction.objects.filter(pk=instance.pk).values_list(
+            'investment_id', flat=True).first()
+
+
+@receiver(post_save, sender=Transaction, dispatch_uid='portfolio_update_holding')
+def update_holding(sender, instance, created, raw=False, **kwargs):
+    """Updates the holding of the investment of a saved transaction."""
+    if raw:
+        return
+    holdings.transaction_saved(instance, created)
+    previous_investment_id = getattr(instance, '_previous_investment_id', None)
+    if previous_investment_id not in (None, instance.investment_id):
+        holdings.recompute_holdings([previous_investment_id])
+
+
+@receiver(post_delete, sender=Transaction, dispatch_uid='portfolio_revert_holding')
+def revert_holding(sender, instance, **kwargs):
+    """Recomputes the holding of the investment of a deleted transaction.
+
+    The recomputation is deferred until the surrounding transaction commits, because the investment itself might be
+    deleted in the same cascade.
+    """
+    investment_id = instance.investment_id
+    transaction.on_commit(lambda: holdings.recompute_holdings([investment_id]))
+
+
+@receiver(post_save, sender=Transaction, dispatch_uid='portfolio_update_lots')
+def update_lots(sender, instance, created, raw=False, **kwargs):
+    """Resets the lots of the investment of a saved transaction unless it was appended to the ledger."""
+    if not raw:
+        lots.transaction_saved(instance, created, getattr(instance, '_previous_investment_id', None))
+
+
+@receiver(post_delete, sender=Transaction, dispatch_uid='portfolio_reset_lots')
+def reset_lots(sender, instance, **kwargs):
+    """Resets the lots of the investment of a deleted transaction."""
+    lots.reset_lots([instance.investment_id])
+
+
+@receiver(post_save, sender=SharePrice, dispatch_uid='portfolio_reprice_holdings')
+def reprice_holdings(sender, instance, created, raw=False, **kwargs):
+    """Recomputes the holdings whose cost basis depends on a changed share price."""
+    if not created and not raw:
+        holdings.share_price_changed(instance.pk)
+
+
+@receiver(post_save, sender=SharePrice, dispatch_uid='portfolio_reprice_lots')
+def reprice_lots(sender, instance, created, raw=False, **kwargs):
+    """Resets the lots whose cost basis or realized gains depend on a changed share price."""
+    if not created and not raw:
+        lots.share_price_changed(instance.pk)
+
+
+@receiver(post_save, sender=SharePrice, dispatch_uid='portfolio_invalidate_saved_price')
+@receiver(post_delete, sender=SharePrice, dispatch_uid='portfolio_invalidate_deleted_price')
+def invalidate_price(sender, instance, **kwargs):
+    """Removes the cached prices of the asset of a saved or deleted share price."""
+    get_price_cache().invalidate(instance.asset_id)
+
+
+@receiver(post_save, sender=Investment, dispatch_uid='portfolio_touch_saved_investment')
+@receiver(post_delete, sender=Investment, dispatch_uid='portfolio_touch_deleted_investment')
+def touch_investment_portfolio(sender, instance, raw=False, **kwargs):
+    """Increments the version of the portfolio of a saved or deleted investment."""
+    if not raw:
+        Portfolio.objects.filter(pk=instance.portfolio_id).touch()
+
+
+@receiver(post_save, sender=Portfolio, dispatch_uid='portfolio_touch_saved_portfolio')
+def touch_portfolio(sender, instance, created, raw=False, **kwargs):
+    """Increments the version of a changed portfolio."""
+    if not created and not raw:
+        Portfolio.objects.filter(pk=instance.pk).touch()
+
+
+@receiver(portfolios_touched, sender=Portfolio, dispatch_uid='portfolio_invalidate_touched_portfolios')
+def invalidate_touched_portfolio_pages(sender, **kwargs):
+    """Discards the cached pages showing portfolios whose version was incremented."""
+    invalidate_pages()
+
+
+@receiver(post_delete, sender=Portfolio, dispatch_uid='portfolio_invalidate_deleted_portfolio')
+def invalidate_portfolio_pages(sender, instance, **kwargs):
+    """Discards the cached pages showing a deleted portfolio."""
+    invalidate_pages()
+
+
+@receiver(post_save, sender=Asset, dispatch_uid='portfolio_touch_saved_asset')
+@receiver(post_save, sender=Stock, dispatch_uid='portfolio_touch_saved_stock')
+@receiver(post_save, sender=Bond, dispatch_uid='portfolio_touch_saved_bond')
+@receiver(post_save, sender=Fund, dispatch_uid='portfolio_touch_saved_fund')
+def touch_asset_portfolios(sender, instance, created, raw=False, **kwargs):
+    """Increments the version of the portfolios invested in a changed asset."""
+    if not created and not raw:
+        Portfolio.objects.filter(investment__asset=instance.pk).touch()
+
+
+@receiver(post_save, sender=Transaction, dispatch_uid='portfolio_touch_saved_transaction')
+@receiver(post_delete, sender=Transaction, dispatch_uid='portfolio_touch_deleted_transaction')
+def touch_transaction_portfolio(sender, instance, raw=False, **kwargs):
+    """Increments the version of the portfolios of a saved or deleted transaction."""
+    if not raw:
+        investment_ids = {instance.investment_id, getattr(instance, '_previous_investment_id', None)} - {None}
+        Portfolio.objects.filter(investment__in=investment_ids).touch()
+
+
+@receiver(post_save, sender=SharePrice, dispatch_uid='portfolio_touch_saved_price')
+@receiver(post_delete, sender=SharePrice, dispatch_uid='portfolio_touch_deleted_price')
+def touch_price_portfolios(sender, instance, raw=False, **kwargs):
+    """Increments the version of the portfolios invested in the asset of a saved or deleted share price."""
+    if not raw:
+        Portfolio.objects.filter(investment__asset=instance.asset_id).touch()
+
+
+@receiver(pre_save, sender=SharePrice, dispatch_uid='portfolio_remember_price_date')
+def remember_price_date(sender, instance, raw=False, **kwargs):
+    """Remembers the asset and date of a share price before it is changed."""
+    if instance.pk is not None and not raw:
+        instance._previous_price = SharePrice.objects.filter(pk=instance.pk).values_list('asset_id', 'date').first()
+
+
+@receiver(post_save, sender=SharePrice, dispatch_uid='portfolio_update_saved_price_bars')
+def update_price_bars(sender, instance, created, raw=False, **kwargs):
+    """Adds a new share price to the price bars or rebuilds the bars containing a changed one after the commit."""
+    if raw:
+        return
+    if created:
+        rollups.add_prices([(instance.asset_id, instance.date, instance.price.amount, str(instance.price.currency))])
+        return
+    for asset_id, date in {(instance.asset_id, instance.date), getattr(instance, '_previous_price', None)} - {None}:
+        rollups.schedule_rebuild(asset_id, local_date(date))
+
+
+@receiver(post_delete, sender=SharePrice, dispatch_uid='portfolio_update_deleted_price_bars')
+def remove_price_from_bars(sender, instance, **kwargs):
+    """Rebuilds the price bars which contained a deleted share price once the deletion is committed."""
+    rollups.schedule_rebuild(instance.asset_id, local_date(instance.date))
+
+
+@receiver(post_delete, sender=Asset, dispatch_uid='portfolio_delete_archived_prices')
+def delete_archived_prices(sender, instance, **kwargs):
+    """Removes the archived prices of a deleted asset once the deletion is committed."""
+    archive = get_archive()
+    if archive is not None:
+        asset_id = instance.pk
+        transaction.on_commit(lambda: archive.delete(asset_id))
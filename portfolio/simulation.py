@@ -0,0 +1,258 @@
+"""Vectorized rebalancing and what-if simulations of portfolios.
+
+A Universe loads the holdings of portfolios at a day and the daily prices of their assets once with a constant number
+of queries. Afterwards any number of candidate trade sets or historical rebalancing schedules are evaluated on these
+arrays with the kernels of portfolio.scenarios, batched over all scenarios instead of walking the ledger per scenario.
+Large scenario sets may be split into chunks computed by a pool of worker processes.
+
+Allocations are measured per asset, per sector of stocks or per asset class (see Grouping). Simulations of schedules
+start with the holdings at the first day and ignore later transactions, i.e. they answer what would have happened if
+the portfolio had only been rebalanced.
+"""
+import concurrent.futures
+
+import numpy as np
+
+from portfolio import scenarios
+from portfolio.fx import RateTable
+from portfolio.models import Asset
+from portfolio.utils import local_date, object_ids
+from portfolio.valuation import Ledger, price_matrix
+
+
+class Grouping:
+    """Collection of the ways assets are grouped into allocation targets."""
+
+    ASSET = 'asset'
+    SECTOR = 'sector'
+    TYPE = 'type'
+
+    ALL = (ASSET, SECTOR, TYPE)
+
+
+def _labels(asset_ids, grouping):
+    """Returns the group label of each asset with one query.
+
+    Assets are labeled by their id, the sector of stocks (an empty string for other assets) respectively their asset
+    class (stock, bond, fund or asset).
+
+    :param asset_ids: list of asset ids
+    :param grouping: see Grouping
+    :return: list of labels aligned with asset_ids
+    """
+    if grouping == Grouping.ASSET:
+        return list(asset_ids)
+    rows = Asset.objects.filter(pk__in=asset_ids).values_list('pk', 'stock__sector', 'stock', 'bond', 'fund')
+    labels = {}
+    for asset_id, sector, stock, bond, fund in rows:
+        if grouping == Grouping.SECTOR:
+            labels[asset_id] = sector or ''
+        else:
+            labels[asset_id] = 'stock' if stock else 'bond' if bond else 'fund' if fund else 'asset'
+    return [labels[asset_id] for asset_id in asset_ids]
+
+
+class TradeEvaluation:
+    """Key figures of candidate trade sets.
+
+    :ivar groups: labels of the groups
+    :ivar market_value: market value of each scenario after its trades
+    :ivar cash: net cash flow of each scenario including costs, negative if money has to be paid in
+    :ivar turnover: traded value of each scenario
+    :ivar costs: transaction costs of each scenario
+    :ivar feasible: whether a scenario neither sells more shares than held nor trades assets without price
+    :ivar weights: matrix of group weights with one row per scenario
+    :ivar drift: distance of each scenario's allocation from the target or None without target
+    """
+
+    def __init__(self, groups, result):
+        self.groups = groups
+        self.market_value = result['market_value']
+        self.cash = result['cash']
+        self.turnover = result['turnover']
+        self.costs = result['costs']
+        self.feasible = result['feasible']
+        self.weights = result['weights']
+        self.drift = result.get('drift')
+
+
+class SimulationResult:
+    """Outcome of rebalancing schedules over the price history.
+
+    :ivar dates: days of the simulation as datetime64[D]
+    :ivar groups: labels of the groups
+    :ivar values: matrix of daily total values including cash with one row per scenario
+    :ivar cash: cash of each scenario at the end
+    :ivar rebalances: number of rebalancings of each scenario
+    :ivar turnover: traded value of each scenario
+    :ivar costs: transaction costs of each scenario
+    :ivar weights: matrix of group weights at the end with one row per scenario
+    """
+
+    def __init__(self, dates, groups, result):
+        self.dates = dates
+        self.groups = groups
+        self.values = result['values']
+        self.cash = result['cash']
+        self.rebalances = result['rebalances']
+        self.turnover = result['turnover']
+        self.costs = result['costs']
+        self.weights = result['weights']
+
+    @property
+    def total_return(self):
+        """Returns the return of each scenario over the whole simulation.
+
+        :return: array of returns, NaN for scenarios without value at the first day
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.values[:, 0] > 0, self.values[:, -1] / self.values[:, 0] - 1, np.nan)
+
+
+class Universe:
+    """Holdings and daily prices of the assets of portfolios loaded once for any number of scenarios.
+
+    :ivar asset_ids: sorted array of asset ids, one column per asset
+    :ivar holdings: number of shares of each asset held at the first day
+    :ivar dates: days of the price history as datetime64[D]
+    :ivar prices: matrix of daily prices with one row per asset, NaN before the first known price
+    :ivar groups: sorted labels of the groups
+    :ivar membership: matrix with one row per asset and one column per group, 1 for the group of the asset
+    """
+
+    def __init__(self, asset_ids, labels, holdings, dates, prices):
+        self.asset_ids = np.asarray(asset_ids, dtype=np.int64)
+        self.holdings = np.asarray(holdings, dtype=np.float64)
+        self.dates = dates
+        self.prices = prices
+        self.groups = sorted(set(labels))
+        column = {label: i for i, label in enumerate(self.groups)}
+        self.membership = np.zeros((len(labels), len(self.groups)))
+        self.membership[np.arange(len(labels)), [column[label] for label in labels]] = 1
+
+    @classmethod
+    def load(cls, portfolios, start, end, grouping=Grouping.ASSET, assets=(), currency=None):
+        """Loads holdings at the first day and daily prices with at most five queries.
+
+        :param portfolios: portfolio, portfolio id or collection / queryset of them
+        :param start: first day of the price history, holdings are taken at the end of this day
+        :param end: last day of the price history
+        :param grouping: how assets are grouped into allocation targets, see Grouping
+        :param assets: ids of further assets which may be bought
+        :param currency: currency code all prices are converted to, by default prices are not converted
+        :return: the loaded universe
+        """
+        if grouping not in Grouping.ALL:
+            raise ValueError('Unknown grouping: {}'.format(grouping))
+        start, end = local_date(start), local_date(end)
+        ledger = Ledger.load(portfolios, until=start)
+        asset_ids = np.array(sorted(set(ledger.asset_ids.tolist()) | set(object_ids(assets))), dtype=np.int64)
+        volume, _ = ledger.final_positions()
+        holdings = np.zeros(len(asset_ids))
+        np.add.at(holdings, np.searchsorted(asset_ids, ledger.asset_ids), volume)
+        rates = RateTable.load(currency, None, start, end) if currency is not None else None
+        dates, prices = price_matrix(asset_ids.tolist(), start, end, rates)
+        return cls(asset_ids, _labels(asset_ids.tolist(), grouping), holdings, dates, prices)
+
+    def target_vector(self, target):
+        """Converts a target allocation into group weights.
+
+        :param target: dictionary mapping group labels to weights, weights are normalized to a sum of one
+        :return: array of weights aligned with groups
+        :raises ValueError: if a label isn't a group of this universe or no weight is positive
+        """
+        unknown = set(target).difference(self.groups)
+        if unknown:
+            raise ValueError('Unknown groups: {}'.format(', '.join(sorted(map(str, unknown)))))
+        weights = np.array([float(target.get(label, 0)) for label in self.groups])
+        if (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError('Target weights must be non-negative with a positive sum')
+        return weights / weights.sum()
+
+    def day(self, date=None):
+        """Returns the column of a day in the price history.
+
+        :param date: date or datetime, defaults to the last day
+        :return: column index
+        :raises ValueError: if the day is outside of the price history
+        """
+        if date is None:
+            return len(self.dates) - 1
+        index = int(np.searchsorted(self.dates, np.datetime64(local_date(date), 'D')))
+        if index == len(self.dates) or self.dates[index] != np.datetime64(local_date(date), 'D'):
+            raise ValueError('{} is outside of the price history'.format(date))
+        return index
+
+    def rebalancing_trades(self, target, date=None):
+        """Computes the trades rebalancing the current holdings to a target allocation.
+
+        :param target: dictionary mapping group labels to weights
+        :param date: day whose prices are used, defaults to the last day
+        :return: array of traded volumes aligned with asset_ids, negative for sales
+        """
+        prices = self.prices[:, self.day(date)]
+        holdings = self.holdings[np.newaxis]
+        totals = np.nan_to_num(holdings * prices).sum(axis=1)
+        rebalanced, _ = scenarios.rebalance(holdings, totals, prices, self.membership, self.target_vector(target))
+        return rebalanced[0] - self.holdings
+
+    def evaluate_trades(self, trades, date=None, target=None, cost=0.0, workers=None, chunk_size=10000):
+        """Evaluates candidate trade sets executed at the prices of a day.
+
+        :param trades: matrix of traded volumes with one row per scenario and one column per asset, negative for sales
+        :param date: day whose prices are used, defaults to the last day
+        :param target: dictionary mapping group labels to weights, by default the drift isn't computed
+        :param cost: transaction costs as fraction of the traded value
+        :param workers: number of worker processes, by default all scenarios are evaluated in this process
+        :param chunk_size: number of scenarios per worker task
+        :return: TradeEvaluation of all scenarios
+        """
+        trades = np.asarray(trades, dtype=np.float64).reshape(-1, len(self.asset_ids))
+        prices = self.prices[:, self.day(date)]
+        target = None if target is None else self.target_vector(target)
+        result = _map(
+            scenarios.evaluate_trades, len(trades), workers, chunk_size,
+            lambda chunk: (self.holdings, prices, trades[chunk], self.membership, target, cost))
+        return TradeEvaluation(self.groups, result)
+
+    def simulate(self, target, schedules, thresholds=0.0, cost=0.0, workers=None, chunk_size=1000):
+        """Simulates rebalancing schedules over the price history.
+
+        :param target: dictionary mapping group labels to weights
+        :param schedules: sequence of frequencies (see portfolio.scenarios.FREQUENCIES) or boolean matrix with one row
+            per scenario and one column per day marking the days to rebalance on
+        :param thresholds: minimum drift triggering a rebalancing on a due day, scalar or one per scenario
+        :param cost: transaction costs as fraction of the traded value
+        :param workers: number of worker processes, by default all scenarios are simulated in this process
+        :param chunk_size: number of scenarios per worker task
+        :return: SimulationResult of all scenarios
+        """
+        if len(schedules) and isinstance(schedules[0], str):
+            due = np.array([scenarios.schedule(self.dates, frequency) for frequency in schedules], dtype=bool)
+        else:
+            due = np.asarray(schedules, dtype=bool)
+        due = due.reshape(-1, len(self.dates))
+        thresholds = np.broadcast_to(np.asarray(thresholds, dtype=np.float64), len(due))
+        target = self.target_vector(target)
+        result = _map(
+            scenarios.simulate, len(due), workers, chunk_size,
+            lambda chunk: (self.holdings, self.prices, self.membership, target, due[chunk], thresholds[chunk], cost))
+        return SimulationResult(self.dates, self.groups, result)
+
+
+def _map(kernel, count, workers, chunk_size, arguments):
+    """Applies a kernel to chunks of scenarios and concatenates the results.
+
+    :param kernel: kernel function of portfolio.scenarios returning a dictionary of arrays
+    :param count: number of scenarios
+    :param workers: number of worker processes or None to compute all chunks in this process
+    :param chunk_size: number of scenarios per chunk
+    :param arguments: function returning the kernel arguments of a slice of scenarios
+    :return: dictionary of concatenated arrays
+    """
+    if not workers or count <= chunk_size:
+        return kernel(*arguments(slice(0, count)))
+    tasks = [(kernel, arguments(slice(i, i + chunk_size))) for i in range(0, count, chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(scenarios.run_chunk, tasks))
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
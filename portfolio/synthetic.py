@@ -0,0 +1,206 @@
+"""Generator of synthetic portfolio data for benchmarks and load tests.
+
+Assets of every subclass, daily share prices following geometric random walks, portfolios, investments and their
+transactions are written with bulk inserts. Holdings and price bars are rebuilt afterwards, as bulk inserts don't send
+the signals maintaining them. The generated data only depends on the seed, so runs with the same parameters are
+comparable.
+
+The generator writes into the default database and is meant to be run against an empty test database.
+"""
+import datetime
+import decimal
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+from djmoney.money import Money
+
+from portfolio.holdings import rebuild_holdings
+from portfolio.identifiers import isin_check_digit
+from portfolio.importers import chunked
+from portfolio.models import (
+    Asset, Bond, Fund, Investment, Portfolio, SharePrice, Stock, Transaction, TransactionType,
+)
+from portfolio.price_cache import get_price_cache
+from portfolio.rollups import rebuild_bars
+from portfolio.utils import day_start, local_date
+
+SECTORS = ('Energy', 'Financials', 'Health Care', 'Industrials', 'Information Technology', 'Utilities')
+
+
+class SyntheticData:
+    """Generates a reproducible data set of a configurable size.
+
+    :ivar portfolios: number of portfolios
+    :ivar stocks: number of stocks
+    :ivar bonds: number of bonds
+    :ivar funds: number of funds
+    :ivar years: number of years of daily share prices ending yesterday
+    :ivar investments: number of investments per portfolio, at most the number of assets
+    :ivar transactions: number of transactions per investment
+    :ivar currency: currency of all share prices
+    :ivar batch_size: number of rows per bulk insert
+    :ivar random: random number generator seeded with the seed
+    """
+
+    def __init__(self, portfolios=10, stocks=40, bonds=20, funds=10, years=3, investments=10, transactions=12,
+                 currency='EUR', seed=0, batch_size=5000):
+        self.portfolios = portfolios
+        self.stocks = stocks
+        self.bonds = bonds
+        self.funds = funds
+        self.years = years
+        self.investments = min(investments, stocks + bonds + funds)
+        self.transactions = transactions
+        self.currency = currency
+        self.batch_size = batch_size
+        self.random = np.random.RandomState(seed)
+
+    def generate(self):
+        """Writes the data set into the database.
+
+        :return: dictionary with the number of created rows per model
+        """
+        with transaction.atomic():
+            asset_ids = self.create_assets()
+            days, price_ids, prices = self.create_prices(asset_ids)
+            investments = self.create_investments(asset_ids)
+            transaction_count = self.create_transactions(investments, days, price_ids, prices)
+        rebuild_holdings()
+        rebuild_bars()
+        get_price_cache().clear()
+        return {
+            'assets': len(asset_ids),
+            'share_prices': int(price_ids.size),
+            'portfolios': self.portfolios,
+            'investments': len(investments),
+            'transactions': transaction_count,
+        }
+
+    def create_assets(self):
+        """Creates stocks, bonds and funds with valid ISINs.
+
+        Multi-table inheritance rules out bulk inserts for subclasses, so assets are created one by one.
+
+        :return: list of asset ids
+        """
+        first = Asset.objects.count()
+        funds = [
+            Fund.objects.create(
+                name='Fund {}'.format(i), isin=self.isin(first + i), issuer='Issuer {}'.format(i % 7),
+                ter=decimal.Decimal(self.random.randint(5, 200)) / 100)
+            for i in range(self.funds)
+        ]
+        first += self.funds
+        assets = [fund.pk for fund in funds]
+        for i in range(self.stocks):
+            stock = Stock.objects.create(
+                name='Stock {}'.format(i), isin=self.isin(first + i), issuer='Issuer {}'.format(i % 13),
+                sector=SECTORS[i % len(SECTORS)])
+            if funds:
+                stock.funds.set(self.random.choice(funds, size=min(len(funds), 2), replace=False).tolist())
+            assets.append(stock.pk)
+        first += self.stocks
+        for i in range(self.bonds):
+            assets.append(Bond.objects.create(
+                name='Bond {}'.format(i), isin=self.isin(first + i), issuer='Issuer {}'.format(i % 5)).pk)
+        return assets
+
+    @staticmethod
+    def isin(number):
+        """Returns a valid ISIN of a synthetic security.
+
+        :param number: running number of the security
+        :return: the ISIN
+        """
+        body = 'XS{:09d}'.format(number)
+        return body + isin_check_digit(body)
+
+    def create_prices(self, asset_ids):
+        """Creates a daily share price on every business day for every asset.
+
+        :param asset_ids: list of asset ids
+        :return: tuple of the array of business days, a matrix of share price ids and a matrix of prices, both with
+            one row per asset and one column per day
+        """
+        end = local_date(timezone.now()) - datetime.timedelta(days=1)
+        start = end - datetime.timedelta(days=int(365.25 * self.years))
+        days = np.arange(np.datetime64(start), np.datetime64(end) + 1)
+        days = days[np.is_busday(days)]
+        returns = self.random.normal(0.0003, 0.015, size=(len(asset_ids), len(days)))
+        initial = self.random.uniform(10, 200, size=(len(asset_ids), 1))
+        prices = np.round(initial * np.exp(np.cumsum(returns, axis=1)), 2)
+
+        dates = [day_start(day.item()) for day in days]
+        share_prices = (
+            SharePrice(asset_id=asset_id, date=date, price=Money(decimal.Decimal(str(price)), self.currency))
+            for asset_id, row in zip(asset_ids, prices.tolist()) for date, price in zip(dates, row)
+        )
+        for chunk in chunked(share_prices, self.batch_size):
+            SharePrice.objects.bulk_create(chunk)
+
+        # bulk inserts don't return primary keys on every database, so read them back
+        rows = {asset_id: row for row, asset_id in enumerate(asset_ids)}
+        columns = {date: column for column, date in enumerate(dates)}
+        price_ids = np.zeros(prices.shape, dtype=np.int64)
+        for price_id, asset_id, date in SharePrice.objects.filter(asset__in=asset_ids).values_list(
+                'id', 'asset_id', 'date').iterator():
+            price_ids[rows[asset_id], columns[date]] = price_id
+        return days, price_ids, prices
+
+    def create_investments(self, asset_ids):
+        """Creates portfolios investing in randomly chosen assets.
+
+        :param asset_ids: list of asset ids
+        :return: list of (investment id, asset index) tuples
+        """
+        first = Portfolio.objects.count()
+        Portfolio.objects.bulk_create(
+            Portfolio(name='Portfolio {}'.format(first + i)) for i in range(self.portfolios))
+        portfolio_ids = Portfolio.objects.order_by('-id').values_list('id', flat=True)[:self.portfolios]
+        Investment.objects.bulk_create(
+            Investment(portfolio_id=portfolio_id, asset_id=asset_ids[index])
+            for portfolio_id in portfolio_ids
+            for index in self.random.choice(len(asset_ids), size=self.investments, replace=False).tolist())
+        positions = {asset_id: index for index, asset_id in enumerate(asset_ids)}
+        return [(investment_id, positions[asset_id]) for investment_id, asset_id in Investment.objects.filter(
+            portfolio__in=list(portfolio_ids)).values_list('id', 'asset_id')]
+
+    def create_transactions(self, investments, days, price_ids, prices):
+        """Creates the transactions of every investment.
+
+        Every ledger starts with a purchase. Further transactions are purchases, sales of a part of the current
+        volume and occasional reinvestments.
+
+        :param investments: list of (investment id, asset index) tuples
+        :param days: array of business days
+        :param price_ids: matrix of share price ids
+        :param prices: matrix of prices
+        :return: number of created transactions
+        """
+        count = 0
+        batch = []
+        for investment_id, row in investments:
+            columns = np.sort(self.random.choice(len(days), size=min(self.transactions, len(days)), replace=False))
+            volume = 0.0
+            for number, column in enumerate(columns.tolist()):
+                draw = self.random.uniform()
+                if number == 0 or draw < 0.6:
+                    transaction_type, amount = TransactionType.BUY, round(1000 / prices[row, column], 3) + 1
+                elif draw < 0.9:
+                    transaction_type, amount = TransactionType.SALE, round(volume * self.random.uniform(0.1, 0.5), 3)
+                else:
+                    transaction_type, amount = TransactionType.REINVESTMENT, round(volume * 0.01, 3)
+                if amount <= 0:
+                    continue
+                volume += amount if transaction_type in TransactionType.INFLOWS else -amount
+                batch.append(Transaction(
+                    investment_id=investment_id, transaction_type=transaction_type,
+                    transaction_date=days[column].item(), share_price_id=int(price_ids[row, column]),
+                    volume=decimal.Decimal(str(amount))))
+            if len(batch) >= self.batch_size:
+                Transaction.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        Transaction.objects.bulk_create(batch)
+        return count + len(batch)
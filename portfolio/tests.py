@@ -1,3 +1,1669 @@
-from django.test import TestCase
+"""Tests of the portfolio app."""
+import datetime
+import decimal
+import http.server
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+import numpy as np
+from djmoney.money import Money
+
+from portfolio.admin import EstimatedCountPaginator
+from portfolio.api import encode_cursor
+from portfolio.archive import archive_prices, price_history
+from portfolio.benchmarks import compare, run_benchmarks
+from portfolio.dashboard import iter_summaries
+from portfolio import holdings
+from portfolio.fx import MissingRateError, RateTable, convert
+from portfolio.identifiers import (
+    AssetResolver, candidate_isins, cusip_check_digit, cusip_to_isin, is_valid_cusip, is_valid_isin, isin_check_digit,
+    national_identifiers, valor_to_isin, wkn_to_isin,
+)
+from portfolio.importers import (
+    ImportDataError, ImportMode, PriceImporter, PriceRecord, import_prices, read_csv_prices, read_json_prices,
+)
+from portfolio.lookthrough import FundGraph, portfolio_exposure
+from portfolio.lots import rebuild_lots, realized_gains, update_lots
+from portfolio.instrumentation import QueryInstrumentationMiddleware, QueryProfile, Statistics
+from portfolio.models import (
+    Asset, Bond, CostMethod, ExchangeRate, Fund, FundAllocation, Holding, Investment, Lot, LotCheckpoint, Portfolio,
+    PriceBar, RealizedGain, Resolution, SharePrice, SharePriceQuerySet, Stock, Transaction, TransactionType,
+)
+from portfolio.price_cache import PriceCache, get_price_cache
+from portfolio.providers import HttpProvider, PriceProvider, PriceUpdater, ProviderError
+from portfolio.returns import compute_returns, money_weighted_returns, solve_xirr, time_weighted_returns
+from portfolio.rollups import rebuild_bars
+from portfolio.simulation import Grouping, Universe
+from portfolio.synthetic import SyntheticData
+from portfolio.utils import day_start
+from portfolio.valuation import (
+    Ledger, average_cost, price_matrix, segmented_cumsum, value_history, value_portfolios,
+)
+from portfolio.views import IndexView
+
+
+def migrate(target):
+    """Migrates the portfolio app forwards or backwards.
+
+    :param target: name of the migration to migrate to
+    :return: the app registry of the historical models at the target
+    """
+    executor = MigrationExecutor(connection)
+    executor.migrate([('portfolio', target)])
+    executor.loader.build_graph()
+    return executor.loader.project_state(('portfolio', target)).apps
+
+
+def create_stock(number):
+    """Creates a stock numbered consecutively with the other test stocks.
+
+    :param number: number of the stock, used for its name and ISIN
+    :return: the created stock
+    """
+    return Stock.objects.create(
+        name='Stock {}'.format(number), isin='DE{:010d}'.format(number), issuer='X', sector='IT')
+
+
+class SharePriceQuerySetTests(TestCase):
+    """Tests of the share price queries."""
+
+    def setUp(self):
+        self.a = Stock.objects.create(name='A', isin='DE0000000000', issuer='X', sector='IT')
+        self.b = Stock.objects.create(name='B', isin='DE0000000001', issuer='X', sector='IT')
+        self.prices = {
+            (asset.pk, date): SharePrice.objects.create(asset=asset, date=date, price=Money(10, 'EUR'))
+            for asset, date in (
+                (self.a, self.date(1, 12)), (self.a, self.date(2, 10)), (self.a, self.date(2, 15)),
+                (self.a, self.date(5, 12)), (self.b, self.date(3, 12)))
+        }
+
+    def date(self, day, hour):
+        return timezone.make_aware(datetime.datetime(2019, 1, day, hour))
+
+    def as_of(self, assets, date):
+        with self.assertNumQueries(1):
+            return sorted((price.asset_id, price.date) for price in SharePrice.objects.as_of(assets, date))
+
+    def test_as_of(self):
+        # dates include all prices of the day
+        self.assertEqual(self.as_of([self.a, self.b], datetime.date(2019, 1, 2)), [(self.a.pk, self.date(2, 15))])
+        self.assertEqual(self.as_of(self.a.pk, self.date(2, 12)), [(self.a.pk, self.date(2, 10))])
+        self.assertEqual(self.as_of(Asset.objects.all(), datetime.date(2019, 1, 10)),
+                         [(self.a.pk, self.date(5, 12)), (self.b.pk, self.date(3, 12))])
+        self.assertEqual(self.as_of(self.b, datetime.date(2019, 1, 1)), [])
+
+    def test_distinct_on(self):
+        with mock.patch.object(connection.features, 'can_distinct_on_fields', True):
+            query = SharePrice.objects.as_of([self.a], datetime.date(2019, 1, 2)).query
+        self.assertEqual(query.distinct_fields, ('asset_id',))
+        self.assertEqual(query.order_by, ('asset_id', '-date'))
+
+
+class AssetQuerySetTests(TestCase):
+    """Tests of the polymorphic asset queries."""
+
+    def test_polymorphic(self):
+        Stock.objects.create(name='Stock', isin='DE0000000001', issuer='X', sector='IT')
+        Bond.objects.create(name='Bond', isin='DE0000000002', issuer='X')
+        Fund.objects.create(name='Fund', isin='DE0000000003', issuer='X', ter=0.5)
+        Asset.objects.create(name='Other', isin='DE0000000004', issuer='X')
+        with self.assertNumQueries(1):
+            assets = list(Asset.objects.polymorphic().order_by('isin'))
+            self.assertEqual([type(asset) for asset in assets], [Stock, Bond, Fund, Asset])
+            self.assertEqual(assets[0].sector, 'IT')
+            self.assertEqual(assets[2].ter, decimal.Decimal('0.50'))
+
+    def test_polymorphic_without_subclasses(self):
+        Stock.objects.create(name='Stock', isin='DE0000000001', issuer='X', sector='IT')
+        # no related objects are joined, neither subclasses nor the relations followed by a bare select_related()
+        self.assertFalse(Stock.objects.polymorphic().query.select_related)
+        self.assertEqual([type(stock) for stock in Stock.objects.polymorphic()], [Stock])
+
+
+class IndexViewTests(TestCase):
+    """Tests of the investment overview."""
+
+    def setUp(self):
+        get_price_cache().clear()
+
+    def create_investments(self, portfolio, count):
+        """Creates investments in stocks, bonds and funds each with a transaction and a share price.
+
+        :param portfolio: portfolio the investments belong to
+        :param count: number of investments per asset class
+        """
+        date = timezone.make_aware(datetime.datetime(2018, 1, 2))
+        offset = Asset.objects.count()
+        for i in range(offset, offset + count):
+            assets = (
+                create_stock(i),
+                Bond.objects.create(name='Bond {}'.format(i), isin='US{:010d}'.format(i), issuer='X'),
+                Fund.objects.create(name='Fund {}'.format(i), isin='LU{:010d}'.format(i), issuer='X', ter=0.5),
+            )
+            for asset in assets:
+                share_price = SharePrice.objects.create(asset=asset, date=date, price=Money(10, 'EUR'))
+                investment = Investment.objects.create(portfolio=portfolio, asset=asset)
+                Transaction.objects.create(
+                    investment=investment, transaction_type=TransactionType.BUY, transaction_date=date.date(),
+                    share_price=share_price, volume=decimal.Decimal(2))
+
+    def render(self, page=None):
+        """Renders the index view.
+
+        :param page: number of the page to render
+        :return: the rendered response
+        """
+        request = RequestFactory().get('/', {'page': page} if page else {})
+        response = IndexView.as_view()(request)
+        # pages served from the page cache are already rendered
+        return response.render() if hasattr(response, 'render') else response
+
+    def test_empty(self):
+        response = self.render()
+        self.assertContains(response, 'No investments are available.')
+
+    def test_grouped_by_portfolio(self):
+        self.create_investments(Portfolio.objects.create(name='Alpha'), 1)
+        self.create_investments(Portfolio.objects.create(name='Beta'), 1)
+        response = self.render()
+        self.assertContains(response, '<h2>Alpha</h2>', count=1)
+        self.assertContains(response, '<h2>Beta</h2>', count=1)
+        self.assertContains(response, 'DE0000000000')
+        self.assertContains(response, '20.00 €')
+        # attributes of the asset subclasses
+        self.assertContains(response, 'IT')
+        self.assertContains(response, '0.50')
+
+    def test_query_count_is_constant(self):
+        portfolio = Portfolio.objects.create(name='Alpha')
+        self.create_investments(portfolio, 2)
+        with self.assertNumQueries(4):
+            self.render()
+        self.create_investments(portfolio, 20)
+        with self.assertNumQueries(4):
+            self.render()
+        with self.assertNumQueries(4):
+            self.render(page=2)
+
+    def test_cached_prices_are_not_queried(self):
+        self.create_investments(Portfolio.objects.create(name='Alpha'), 2)
+        self.render()
+        with self.assertNumQueries(3):
+            self.render()
+
+    @override_settings(PORTFOLIO_PAGE_CACHE={'BACKEND': 'default'})
+    def test_page_cache(self):
+        caches['default'].clear()
+        self.create_investments(Portfolio.objects.create(name='Alpha'), 1)
+        beta = Portfolio.objects.create(name='Beta')
+        self.create_investments(beta, 1)
+        content = self.render().content
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render().content, content)
+
+        # only the investments of the changed portfolio are priced again
+        SharePrice.objects.create(
+            asset=Asset.objects.get(isin='DE0000000003'), date=timezone.now(), price=Money(15, 'EUR'))
+        get_price_cache().clear()
+        get_price_cache().reset_stats()
+        response = self.render()
+        self.assertEqual(get_price_cache().stats()['misses'], 3)
+        self.assertContains(response, '30.00 €')
+        self.assertContains(response, '<h2>Alpha</h2>', count=1)
+
+        beta.name = 'Gamma'
+        beta.save()
+        self.assertContains(self.render(), '<h2>Gamma</h2>', count=1)
+
+        # bulk operations touch portfolios without sending model signals
+        self.render()
+        Portfolio.objects.filter(pk=beta.pk).touch()
+        with CaptureQueriesContext(connection) as queries:
+            self.render()
+        self.assertTrue(queries.captured_queries)
+
+
+class PriceCacheTests(TestCase):
+    """Tests of the latest price cache."""
+
+    def setUp(self):
+        self.asset = Stock.objects.create(name='Stock', isin='DE0000000001', issuer='X', sector='IT')
+        self.date = datetime.date(2018, 1, 3)
+        self.share_price = SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime(2018, 1, 2)), price=Money(10, 'EUR'))
+        get_price_cache().clear()
+        get_price_cache().reset_stats()
+
+    def test_hit_and_miss(self):
+        cache = get_price_cache()
+        self.assertEqual(cache.get_price(self.asset, self.date), Money(10, 'EUR'))
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_price(self.asset, self.date), Money(10, 'EUR'))
+        self.assertEqual(cache.get_price(self.asset, datetime.date(2018, 1, 1)), None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_invalidated_by_signals(self):
+        cache = get_price_cache()
+        cache.get_price(self.asset, self.date)
+        self.share_price.price = Money(12, 'EUR')
+        self.share_price.save()
+        self.assertEqual(cache.get_price(self.asset, self.date), Money(12, 'EUR'))
+        self.share_price.delete()
+        self.assertEqual(cache.get_price(self.asset, self.date), None)
+
+    def test_eviction(self):
+        cache = PriceCache(max_size=2)
+        for day in range(3, 6):
+            cache.get_price(self.asset, datetime.date(2018, 1, day))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+
+class PriceCacheCommitTests(TransactionTestCase):
+    """Tests of the invalidation of the latest price cache by uncommitted changes."""
+
+    def test_invalidated_on_commit(self):
+        asset = create_stock(1)
+        date = datetime.date(2018, 1, 3)
+        SharePrice.objects.create(
+            asset=asset, date=timezone.make_aware(datetime.datetime(2018, 1, 2)), price=Money(10, 'EUR'))
+        cache = PriceCache(backend='default')
+        as_of = SharePriceQuerySet.as_of
+        with mock.patch('portfolio.price_cache._price_cache', cache):
+            with transaction.atomic():
+                change = SharePrice.objects.create(
+                    asset=asset, date=timezone.make_aware(datetime.datetime(2018, 1, 3)), price=Money(12, 'EUR'))
+
+                # a reader not seeing the uncommitted price caches the committed one after the first invalidation
+                def committed_as_of(queryset, assets, day):
+                    return as_of(queryset.exclude(pk=change.pk), assets, day)
+                with mock.patch.object(SharePriceQuerySet, 'as_of', committed_as_of):
+                    self.assertEqual(cache.get_price(asset, date), Money(10, 'EUR'))
+            self.assertEqual(cache.get_price(asset, date), Money(12, 'EUR'))
+            self.assertEqual(PriceCache(backend='default').get_price(asset, date), Money(12, 'EUR'))
+
+
+class AdminTests(TestCase):
+    """Tests of the admin interface."""
+
+    def setUp(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(user)
+        asset = Stock.objects.create(name='Stock', isin='DE0000000001', issuer='X', sector='IT')
+        investment = Investment.objects.create(portfolio=Portfolio.objects.create(name='Alpha'), asset=asset)
+        for day in range(1, 21):
+            share_price = SharePrice.objects.create(
+                asset=asset, date=timezone.make_aware(datetime.datetime(2018, 1, day)), price=Money(10, 'EUR'))
+            Transaction.objects.create(
+                investment=investment, transaction_date=share_price.date.date(), share_price=share_price,
+                volume=decimal.Decimal(1))
+
+    def test_transaction_form_does_not_list_share_prices(self):
+        response = self.client.get(reverse('admin:portfolio_transaction_add'))
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+        self.assertNotContains(response, '2018-01-02')
+
+    def test_transaction_changelist_joins_related_objects(self):
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('admin:portfolio_transaction_changelist'))
+        self.assertContains(response, 'Buy (Stock)', count=20)
+
+    def test_asset_changelist_shows_asset_classes(self):
+        Bond.objects.create(name='Bond', isin='DE0000000002', issuer='X')
+        # the assets are downcast within the query of the changelist
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('admin:portfolio_asset_changelist'))
+        self.assertContains(response, '<td class="field-asset_type">stock</td>', html=True)
+        self.assertContains(response, '<td class="field-asset_type">bond</td>', html=True)
+        self.assertEqual(self.client.get(reverse('admin:portfolio_stock_changelist')).status_code, 200)
+
+    def test_estimated_count_paginator_counts_small_tables_exactly(self):
+        self.assertEqual(EstimatedCountPaginator(SharePrice.objects.order_by('pk'), 5).count, 20)
+
+
+class ExportTests(TestCase):
+    """Tests of the streaming exports."""
+
+    def setUp(self):
+        asset = Stock.objects.create(name='Stock', isin='DE0000000001', issuer='X', sector='IT')
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        investment = Investment.objects.create(portfolio=self.portfolio, asset=asset)
+        for day in (2, 3):
+            share_price = SharePrice.objects.create(
+                asset=asset, date=timezone.make_aware(datetime.datetime(2018, 1, day)), price=Money('10.5', 'EUR'))
+            Transaction.objects.create(
+                investment=investment, transaction_date=datetime.date(2018, 1, day), share_price=share_price,
+                volume=decimal.Decimal(2))
+
+    def test_prices_csv_can_be_imported(self):
+        response = self.client.get(reverse('portfolio:export_prices'), {'start': '2018-01-03'})
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        records = list(read_csv_prices(io.StringIO(content)))
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0].isin, records[0].amount, records[0].currency),
+                         ('DE0000000001', decimal.Decimal('10.5'), 'EUR'))
+        self.assertEqual(records[0].date, timezone.make_aware(datetime.datetime(2018, 1, 3)))
+
+    def test_transactions_json(self):
+        response = self.client.get(
+            reverse('portfolio:export_transactions'), {'format': 'json', 'portfolio': self.portfolio.pk})
+        transactions = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual([transaction['date'] for transaction in transactions], ['2018-01-02', '2018-01-03'])
+        self.assertEqual(transactions[0]['volume'], '2.000000')
+        response = self.client.get(reverse('portfolio:export_transactions'), {'portfolio': self.portfolio.pk + 1})
+        self.assertEqual(b''.join(response.streaming_content).decode().count('\n'), 1)
+
+    def test_invalid_filter(self):
+        response = self.client.get(reverse('portfolio:export_transactions'), {'start': '2018-13-01'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        output = io.StringIO()
+        call_command('export_data', 'transactions', '--end', '2018-01-02', stdout=output)
+        self.assertEqual(output.getvalue().splitlines()[1].split(',')[3:6], ['DE0000000001', 'BUY', '2018-01-02'])
+
+
+class ApiTests(TestCase):
+    """Tests of the JSON API."""
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        self.assets = [create_stock(i) for i in range(5)]
+        for asset in self.assets:
+            Investment.objects.create(portfolio=self.portfolio, asset=asset)
+
+    def test_cursor_pagination(self):
+        url = reverse('portfolio:api_investments', args=[self.portfolio.pk])
+        pages = []
+        parameters = {'limit': 2}
+        while True:
+            payload = self.client.get(url, parameters).json()
+            pages.append([row[2] for row in payload['results']])
+            if payload['next'] is None:
+                break
+            parameters['cursor'] = payload['next']
+        self.assertEqual(payload['fields'], ['id', 'asset', 'isin', 'name'])
+        self.assertEqual(pages, [['DE0000000000', 'DE0000000001'], ['DE0000000002', 'DE0000000003'], ['DE0000000004']])
+
+    def test_compound_cursor(self):
+        for day in (1, 2):
+            for asset in self.assets[:2]:
+                SharePrice.objects.create(
+                    asset=asset, date=timezone.make_aware(datetime.datetime(2018, 1, day, 12, 30, 0, 123456)),
+                    price=Money(10, 'EUR'))
+        url = reverse('portfolio:api_prices', args=[self.portfolio.pk])
+        first = self.client.get(url, {'limit': 3}).json()
+        second = self.client.get(url, {'limit': 3, 'cursor': first['next']}).json()
+        keys = [(row[0], row[1][:10]) for row in first['results'] + second['results']]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), 4)
+        self.assertIsNone(second['next'])
+
+    def test_conditional_get(self):
+        url = reverse('portfolio:api_holdings', args=[self.portfolio.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        share_price = SharePrice.objects.create(
+            asset=self.assets[0], date=timezone.make_aware(datetime.datetime(2018, 1, 2)), price=Money(10, 'EUR'))
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        Transaction.objects.create(
+            investment=self.portfolio.investment_set.first(), transaction_date=datetime.date(2018, 1, 2),
+            share_price=share_price, volume=decimal.Decimal(2))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=changed['ETag']).status_code, 200)
+
+    def test_invalid_requests(self):
+        url = reverse('portfolio:api_investments', args=[self.portfolio.pk])
+        self.assertEqual(self.client.get(url, {'cursor': 'invalid'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cursor': encode_cursor([{}])}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'limit': 0}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('portfolio:api_investments', args=[0])).status_code, 404)
+
+
+class PriceBarTests(TransactionTestCase):
+    """Tests of the price bar rollups, rebuilds of changed prices run once they are committed."""
+
+    def setUp(self):
+        self.asset = Stock.objects.create(name='Stock', isin='DE0000000000', issuer='X', sector='IT')
+
+    def create_price(self, day, amount):
+        return SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime.combine(day, datetime.time(12))),
+            price=Money(amount, 'EUR'))
+
+    def bars(self):
+        return list(PriceBar.objects.order_by('resolution', 'period_start').values_list(
+            'resolution', 'period_start', 'open', 'high', 'low', 'close', 'count'))
+
+    def test_incremental_bars_match_rebuild(self):
+        start = datetime.date(2018, 1, 29)
+        # out of order to update existing bars with earlier prices
+        for offset, amount in ((3, 12), (0, 10), (1, 15), (2, 8), (7, 11)):
+            self.create_price(start + datetime.timedelta(days=offset), amount)
+        incremental = self.bars()
+        self.assertIn((Resolution.WEEK, start, 10, 15, 8, 12, 4), incremental)
+        self.assertIn((Resolution.MONTH, datetime.date(2018, 2, 1), 12, 12, 11, 11, 2), incremental)
+        rebuild_bars()
+        self.assertEqual(self.bars(), incremental)
+
+    def test_changed_and_deleted_prices(self):
+        first = self.create_price(datetime.date(2018, 1, 1), 10)
+        second = self.create_price(datetime.date(2018, 1, 2), 20)
+        second.price = Money(5, 'EUR')
+        second.save()
+        week = PriceBar.objects.get(resolution=Resolution.WEEK)
+        self.assertEqual((week.high, week.low, week.close), (10, 5, 5))
+        first.delete()
+        week = PriceBar.objects.get(resolution=Resolution.WEEK)
+        self.assertEqual((week.open, week.high, week.count), (5, 5, 1))
+        self.assertEqual(PriceBar.objects.filter(period_start=datetime.date(2018, 1, 1), resolution='D').count(), 0)
+
+    def test_rebuilds_are_combined_per_asset(self):
+        for day in range(10):
+            self.create_price(datetime.date(2018, 1, 1) + datetime.timedelta(days=day), 10 + day)
+        other = Stock.objects.create(name='Other', isin='DE0000000001', issuer='X', sector='IT')
+        with mock.patch('portfolio.rollups.rebuild_bars', wraps=rebuild_bars) as rebuild:
+            with transaction.atomic():
+                SharePrice.objects.filter(date__lt=timezone.make_aware(datetime.datetime(2018, 1, 5))).delete()
+                SharePrice.objects.create(
+                    asset=other, date=timezone.make_aware(datetime.datetime(2018, 1, 1, 12)), price=Money(1, 'EUR'))
+                other.delete()
+                self.assertFalse(rebuild.called)
+            rebuild.assert_called_once_with([self.asset.pk], datetime.date(2018, 1, 1), datetime.date(2018, 1, 4))
+        week = PriceBar.objects.get(resolution=Resolution.WEEK, period_start=datetime.date(2018, 1, 1))
+        self.assertEqual((week.open, week.low, week.count), (14, 14, 3))
+
+        with mock.patch('portfolio.rollups.rebuild_bars', wraps=rebuild_bars) as rebuild:
+            self.asset.delete()
+        self.assertFalse(rebuild.called)
+        self.assertFalse(PriceBar.objects.exists())
+
+    def test_chart(self):
+        for day in range(60):
+            self.create_price(datetime.date(2018, 1, 1) + datetime.timedelta(days=day), 10 + day)
+        self.assertEqual(Resolution.choose(datetime.date(2018, 1, 1), datetime.date(2018, 3, 1), 60), Resolution.DAY)
+        self.assertEqual(Resolution.choose(datetime.date(2018, 1, 1), datetime.date(2018, 3, 1), 10), Resolution.WEEK)
+        url = reverse('portfolio:api_chart', args=[self.asset.pk])
+        payload = self.client.get(url, {'start': '2018-01-01', 'end': '2018-03-01', 'points': 2}).json()
+        self.assertEqual(payload['resolution'], Resolution.MONTH)
+        self.assertEqual([row[0] for row in payload['results']], ['2018-01-01', '2018-02-01', '2018-03-01'])
+        self.assertEqual(payload['results'][0][1:5], ['10.000000', '40.000000', '10.000000', '40.000000'])
+        self.assertEqual(self.client.get(url, {'start': 'invalid'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'points': 0}).status_code, 400)
+
+
+class ArchiveTests(TestCase):
+    """Tests of the price archive."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(PORTFOLIO_PRICE_ARCHIVE={'DIRECTORY': directory.name})
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.asset = Stock.objects.create(name='Stock', isin='DE0000000000', issuer='X', sector='IT')
+        portfolio = Portfolio.objects.create(name='Alpha')
+        investment = Investment.objects.create(portfolio=portfolio, asset=self.asset)
+        self.start = datetime.date(2018, 1, 1)
+        self.prices = [
+            SharePrice.objects.create(
+                asset=self.asset, date=self.date(day), price=Money(10 + day, 'EUR'))
+            for day in range(90)
+        ]
+        Transaction.objects.create(
+            investment=investment, transaction_date=self.start + datetime.timedelta(days=9),
+            share_price=self.prices[9], volume=decimal.Decimal(3))
+
+    def date(self, day):
+        return timezone.make_aware(
+            datetime.datetime.combine(self.start + datetime.timedelta(days=day), datetime.time(12)))
+
+    def history(self):
+        return value_history(Portfolio.objects.all(), self.start, datetime.date(2018, 3, 31)).values
+
+    def test_archive_keeps_results(self):
+        values = self.history()
+        bars = list(PriceBar.objects.order_by('pk').values_list('resolution', 'period_start', 'open', 'close', 'count'))
+
+        version = Portfolio.objects.get().version
+        invalidations = get_price_cache().stats()['invalidations']
+
+        # January and February without the referenced price and the latest one before March
+        self.assertEqual(archive_prices(day_start(datetime.date(2018, 3, 1))), 57)
+        self.assertEqual(SharePrice.objects.count(), 33)
+        self.assertTrue(SharePrice.objects.filter(pk__in=[self.prices[9].pk, self.prices[58].pk]).exists())
+        np.testing.assert_array_equal(self.history(), values)
+        self.assertEqual(Portfolio.objects.get().version, version + 1)
+        self.assertEqual(get_price_cache().stats()['invalidations'], invalidations + 1)
+        self.assertEqual(
+            list(PriceBar.objects.order_by('pk').values_list('resolution', 'period_start', 'open', 'close', 'count')),
+            bars)
+        rebuild_bars()
+        self.assertEqual(
+            list(PriceBar.objects.order_by('resolution', 'period_start').values_list(
+                'resolution', 'period_start', 'open', 'close', 'count')),
+            sorted(bars))
+
+    def test_price_history(self):
+        archive_prices(day_start(datetime.date(2018, 3, 1)))
+        history = price_history([self.asset.pk])[self.asset.pk]
+        self.assertEqual(history.prices.tolist(), [10.0 + day for day in range(90)])
+
+        # served from the archive file without copying
+        archived = price_history([self.asset.pk], self.date(2), self.date(5))[self.asset.pk]
+        self.assertIsInstance(archived.prices, np.memmap)
+        self.assertEqual(archived.prices.tolist(), [11.0, 12.0, 13.0, 14.0])
+
+        # prices in the database replace archived prices of the same date
+        SharePrice.objects.create(asset=self.asset, date=self.date(3), price=Money(99, 'EUR'))
+        merged = price_history([self.asset.pk], self.date(2), self.date(5))[self.asset.pk]
+        self.assertEqual(merged.prices.tolist(), [11.0, 12.0, 99.0, 14.0])
+
+    def test_valuation_and_price_cache_before_cutoff(self):
+        portfolio = Portfolio.objects.get()
+        date = self.start + datetime.timedelta(days=30)
+        value = value_portfolios(portfolio, date).by_portfolio()[portfolio.pk]['market_value']
+        self.assertEqual(value, 3 * 40)
+
+        archive_prices(day_start(datetime.date(2018, 3, 1)))
+        # the price referenced by the transaction is older than the archived price of the day
+        self.assertEqual(value_portfolios(portfolio, date).by_portfolio()[portfolio.pk]['market_value'], value)
+        self.assertEqual(value_portfolios(portfolio, self.date(30)).by_portfolio()[portfolio.pk]['market_value'], value)
+        self.assertEqual(PriceCache().get_price(self.asset, date), Money(40, 'EUR'))
+        self.assertEqual(PriceCache().get_price(self.asset, datetime.date(2018, 3, 31)), Money(99, 'EUR'))
+
+    def test_export_and_api_include_archived_prices(self):
+        archive_prices(day_start(datetime.date(2018, 3, 1)))
+        response = self.client.get(reverse('portfolio:export_prices'), {'start': '2018-01-02', 'end': '2018-01-05'})
+        records = list(read_csv_prices(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([record.amount for record in records], [11, 12, 13, 14])
+        self.assertEqual({record.isin for record in records}, {self.asset.isin})
+
+        url = reverse('portfolio:api_prices', args=[Portfolio.objects.get().pk])
+        prices, parameters = [], {'limit': 40}
+        while True:
+            payload = self.client.get(url, parameters).json()
+            prices.extend(decimal.Decimal(row[2]) for row in payload['results'])
+            if payload['next'] is None:
+                break
+            parameters['cursor'] = payload['next']
+        self.assertEqual(prices, [10 + day for day in range(90)])
+
+    def test_command(self):
+        output = io.StringIO()
+        call_command('archive_prices', str(self.asset.pk), '--before=2018-02-01', stdout=output)
+        self.assertIn('Archived 29 share prices', output.getvalue())
+        self.assertEqual(len(price_history([self.asset.pk])[self.asset.pk]), 90)
+
+
+class DashboardTests(TransactionTestCase):
+    """Tests of the concurrent dashboard, worker threads only see committed data."""
+
+    def setUp(self):
+        self.portfolios = [Portfolio.objects.create(name='Portfolio {}'.format(i)) for i in range(3)]
+        for i, portfolio in enumerate(self.portfolios):
+            asset = create_stock(i)
+            investment = Investment.objects.create(portfolio=portfolio, asset=asset)
+            share_price = SharePrice.objects.create(
+                asset=asset, date=timezone.now() - datetime.timedelta(days=30), price=Money(10, 'EUR'))
+            SharePrice.objects.create(asset=asset, date=timezone.now() - datetime.timedelta(days=1),
+                                      price=Money(12 + i, 'EUR'))
+            Transaction.objects.create(
+                investment=investment, transaction_date=timezone.localdate() - datetime.timedelta(days=30),
+                share_price=share_price, volume=decimal.Decimal(10))
+
+    def test_streams_summaries(self):
+        response = self.client.get(reverse('portfolio:dashboard'))
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(sorted(line['name'] for line in lines), ['Portfolio 0', 'Portfolio 1', 'Portfolio 2'])
+        expected = value_portfolios(self.portfolios).by_portfolio()
+        for line in lines:
+            self.assertEqual(line['status'], 'ok')
+            self.assertAlmostEqual(line['market_value'], expected[line['id']]['market_value'])
+            self.assertAlmostEqual(line['gain'], line['market_value'] - 100)
+        self.assertEqual(self.client.get(reverse('portfolio:dashboard'), {'currency': 'EURO'}).status_code, 400)
+
+    def test_timeout_and_errors(self):
+        slow, failing = self.portfolios[0].pk, self.portfolios[1].pk
+
+        def summarize(portfolio_id, date, currency=None):
+            if portfolio_id == slow:
+                time.sleep(2)
+            if portfolio_id == failing:
+                raise ValueError('broken')
+            return {'market_value': 1.0}
+
+        with mock.patch('portfolio.dashboard.summarize', summarize), self.assertLogs('portfolio.dashboard', 'ERROR'):
+            start = time.monotonic()
+            statuses = {summary['id']: summary['status'] for summary in iter_summaries(timeout=0.2, workers=3)}
+            self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(statuses, {slow: 'timeout', failing: 'error', self.portfolios[2].pk: 'ok'})
+
+
+class LotTests(TestCase):
+    """Tests of the lot tracking."""
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        self.asset = Stock.objects.create(name='Stock', isin='DE0000000000', issuer='X', sector='IT')
+        self.investment = Investment.objects.create(portfolio=self.portfolio, asset=self.asset)
+        self.trade(TransactionType.BUY, datetime.date(2017, 1, 2), 10, 10)
+        self.trade(TransactionType.BUY, datetime.date(2018, 6, 1), 10, 20)
+        self.trade(TransactionType.SALE, datetime.date(2019, 3, 1), 15, 30)
+
+    def trade(self, transaction_type, date, volume, price):
+        share_price = SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime.combine(date, datetime.time(12))),
+            price=Money(price, 'EUR'))
+        return Transaction.objects.create(
+            investment=self.investment, transaction_type=transaction_type, transaction_date=date,
+            share_price=share_price, volume=decimal.Decimal(volume))
+
+    def gains(self, method):
+        return list(RealizedGain.objects.filter(method=method).order_by('id').values_list(
+            'acquisition_date', 'volume', 'proceeds', 'cost_basis'))
+
+    def test_methods(self):
+        self.assertEqual(update_lots(), 3)
+        self.assertEqual(self.gains(CostMethod.FIFO), [
+            (datetime.date(2017, 1, 2), 10, 300, 100), (datetime.date(2018, 6, 1), 5, 150, 100)])
+        # shares are disposed at the average cost of 15 but keep their acquisition dates
+        self.assertEqual(self.gains(CostMethod.AVERAGE), [
+            (datetime.date(2017, 1, 2), 10, 300, 150), (datetime.date(2018, 6, 1), 5, 150, 75)])
+        self.assertEqual(
+            list(Lot.objects.order_by('method').values_list('method', 'acquisition_date', 'volume', 'cost_basis')),
+            [(CostMethod.AVERAGE, datetime.date(2018, 6, 1), 5, 75),
+             (CostMethod.FIFO, datetime.date(2018, 6, 1), 5, 100)])
+
+    def test_incremental_updates(self):
+        update_lots()
+        self.trade(TransactionType.SALE, datetime.date(2019, 4, 1), 5, 40)
+        # only the new transaction is loaded and applied
+        with self.assertNumQueries(11):
+            self.assertEqual(update_lots(), 1)
+        self.assertFalse(Lot.objects.exists())
+        incremental = self.gains(CostMethod.FIFO)
+
+        # backdated transactions reset the lots, which are replayed by the next update
+        self.trade(TransactionType.BUY, datetime.date(2016, 1, 4), 1, 5)
+        self.assertFalse(LotCheckpoint.objects.exists())
+        self.assertEqual(update_lots(), 5)
+        replayed = self.gains(CostMethod.FIFO)
+        self.assertEqual(replayed[0], (datetime.date(2016, 1, 4), 1, 30, 5))
+        rebuild_lots()
+        self.assertEqual(self.gains(CostMethod.FIFO), replayed)
+        self.assertNotEqual(incremental, replayed)
+
+    def test_realized_gains(self):
+        report = realized_gains(self.portfolio, datetime.date(2019, 1, 1), datetime.date(2019, 12, 31))
+        self.assertEqual(len(report), 1)
+        self.assertEqual((report[0]['gain'], report[0]['long_term_gain']), (250, 200))
+        self.assertEqual(realized_gains(self.portfolio, datetime.date(2018, 1, 1), datetime.date(2018, 12, 31)), [])
+
+        output = io.StringIO()
+        call_command('realized_gains', '2019', '--method', 'average', stdout=output)
+        self.assertEqual(output.getvalue().splitlines()[1].split(',')[-2:], ['225.000000', '150.000000'])
+
+
+class ProviderTests(TestCase):
+    """Tests of the price providers and the concurrent updater."""
+
+    def setUp(self):
+        portfolio = Portfolio.objects.create(name='Alpha')
+        self.isins = []
+        for i in range(3):
+            asset = create_stock(i)
+            share_price = SharePrice.objects.create(
+                asset=asset, date=timezone.now() - datetime.timedelta(days=10), price=Money(10, 'EUR'))
+            if i < 2:
+                investment = Investment.objects.create(portfolio=portfolio, asset=asset)
+                Transaction.objects.create(
+                    investment=investment, transaction_date=timezone.localdate() - datetime.timedelta(days=10),
+                    share_price=share_price, volume=decimal.Decimal(5))
+                self.isins.append(asset.isin)
+
+    def quotes(self, isins):
+        return [{'isin': isin, 'date': '2030-01-02', 'price': 20, 'currency': 'EUR'} for isin in isins]
+
+    def test_file_provider(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'quotes.json')
+        with open(path, 'w') as stream:
+            json.dump(self.quotes(['DE0000000000', 'DE0000000001', 'DE0000000002']), stream)
+
+        output = io.StringIO()
+        call_command('update_prices', '--file', path, stdout=output)
+        self.assertIn('2 requested, 0 failed, 2 created', output.getvalue())
+        self.assertEqual(sorted(SharePrice.objects.filter(price=20).values_list('asset__isin', flat=True)), self.isins)
+
+    def test_retries(self):
+        calls = []
+
+        class FlakyProvider(PriceProvider):
+            batch_size = 1
+
+            def fetch(provider, isins):
+                calls.append(isins[0])
+                if isins[0] == 'DE0000000001':
+                    raise ProviderError('not found')
+                if calls.count(isins[0]) < 3:
+                    raise ProviderError('timeout', retryable=True)
+                return [PriceRecord(isin, day_start(datetime.date(2030, 1, 2)), 20, 'EUR') for isin in isins]
+
+        provider = FlakyProvider(rate=50, burst=1)
+        with self.assertLogs('portfolio.providers', 'WARNING'):
+            start = time.monotonic()
+            result = PriceUpdater(provider, workers=2, backoff=0).run()
+        # four requests at 50 per second after the initial burst
+        self.assertGreaterEqual(time.monotonic() - start, 0.06)
+        self.assertEqual((result.created, result.failed_isins), (1, {'DE0000000001'}))
+        self.assertEqual(sorted(calls), ['DE0000000000'] * 3 + ['DE0000000001'])
+
+    def test_http_provider(self):
+        quotes = self.quotes
+        connections = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                body = json.dumps(quotes(self.path.split('isin=')[1:])).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        provider = HttpProvider('http://127.0.0.1:{}/quotes'.format(server.server_address[1]), batch_size=1)
+        try:
+            result = PriceUpdater(provider, workers=1).run()
+        finally:
+            provider.close()
+        self.assertEqual(result.created, 2)
+        # both requests were sent over the same connection
+        self.assertEqual(len(connections), 1)
+
+
+class TransactionImportTests(TestCase):
+    """Tests of the broker statement import."""
+
+    statement = (
+        'isin,type,date,volume,price,currency,reference\n'
+        'DE0000000000,buy,2019-01-02,10,20,EUR,\n'
+        'DE0000000000,buy,2019-01-02,10,20,EUR,\n'
+        'DE0000000001,BUY,2019-01-03T10:00:00,5,30,EUR,A-1\n'
+        'DE0000000000,sale,2019-02-01,4,25,EUR,\n'
+        'XX0000000000,buy,2019-02-01,1,1,EUR,\n'
+    )
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        self.stocks = [create_stock(i) for i in range(2)]
+        self.price = SharePrice.objects.create(
+            asset=self.stocks[1], date=timezone.make_aware(datetime.datetime(2019, 1, 3, 10)), price=Money(30, 'EUR'))
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'statement.csv')
+        with open(self.path, 'w') as stream:
+            stream.write(self.statement)
+
+    def import_statement(self, *args):
+        output = io.StringIO()
+        call_command('import_transactions', str(self.portfolio.pk), self.path, *args, stdout=output,
+                     stderr=io.StringIO())
+        return output.getvalue()
+
+    def test_import_is_idempotent(self):
+        self.assertIn('4 created, 0 duplicates, 1 with unknown asset, 2 new investments, 2 new share prices',
+                      self.import_statement('--dry-run'))
+        self.assertFalse(Transaction.objects.exists())
+
+        # a constant number of queries per chunk and for rebuilding the holdings
+        with self.assertNumQueries(29):
+            self.import_statement('--batch-size=10')
+        self.assertEqual(Transaction.objects.count(), 4)
+        self.assertEqual(Transaction.objects.filter(share_price=self.price).count(), 1)
+        holdings = dict(Holding.objects.values_list('investment__asset__isin', 'volume'))
+        self.assertEqual(holdings, {'DE0000000000': 16, 'DE0000000001': 5})
+
+        self.assertIn('0 created, 4 duplicates', self.import_statement())
+        self.assertEqual(Transaction.objects.count(), 4)
+
+    def test_differing_prices_are_reported(self):
+        with open(self.path, 'w') as stream:
+            stream.write(
+                'isin,type,date,volume,price,currency\n'
+                'DE0000000001,buy,2019-01-03T10:00:00,5,31,EUR\n'
+                'DE0000000000,buy,2019-01-02,10,20,EUR\n'
+                'DE0000000000,buy,2019-01-02,5,20.5,EUR\n'
+                'DE0000000000,sale,2019-02-01,4,25.000,EUR\n')
+        output, errors = io.StringIO(), io.StringIO()
+        call_command('import_transactions', str(self.portfolio.pk), self.path, stdout=output, stderr=errors)
+        self.assertIn('4 created, 0 duplicates, 0 with unknown asset, 2 new investments, 2 new share prices, '
+                      '2 with differing price', output.getvalue())
+        self.assertRegex(
+            errors.getvalue(), 'Prices differing from the stored share price: '
+            'DE0000000000 at 2019-01-02T00:00:00[^,]*, DE0000000001 at 2019-01-03T10:00:00')
+        # the transactions refer to the first known share price
+        self.assertEqual(Transaction.objects.filter(share_price=self.price).count(), 1)
+        self.assertEqual(set(SharePrice.objects.filter(asset=self.stocks[0]).values_list('price', flat=True)), {20, 25})
+
+
+class SimulationTests(TestCase):
+    """Tests of the rebalancing simulations."""
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        self.it = Stock.objects.create(name='IT', isin='DE0000000000', issuer='X', sector='IT')
+        self.energy = Stock.objects.create(name='Energy', isin='DE0000000001', issuer='X', sector='Energy')
+        self.fund = Fund.objects.create(name='Fund', isin='LU0000000000', issuer='X', ter=0.5)
+        start = datetime.date(2019, 1, 1)
+        for day in range(90):
+            date = start + datetime.timedelta(days=day)
+            moment = timezone.make_aware(datetime.datetime.combine(date, datetime.time(12)))
+            for asset, price in ((self.it, 20 if date >= datetime.date(2019, 2, 15) else 10), (self.energy, 10)):
+                share_price = SharePrice.objects.create(asset=asset, date=moment, price=Money(price, 'EUR'))
+                if day == 0:
+                    Transaction.objects.create(
+                        investment=Investment.objects.create(portfolio=self.portfolio, asset=asset),
+                        transaction_date=date, share_price=share_price, volume=decimal.Decimal(10))
+            if date >= datetime.date(2019, 2, 1):
+                SharePrice.objects.create(asset=self.fund, date=moment, price=Money(20, 'EUR'))
+
+    def test_evaluate_trades(self):
+        universe = Universe.load(
+            self.portfolio, datetime.date(2019, 1, 1), datetime.date(2019, 3, 31), Grouping.SECTOR, [self.fund.pk])
+        self.assertEqual(universe.groups, ['', 'Energy', 'IT'])
+        target = {'IT': 1, 'Energy': 1}
+        rebalancing = universe.rebalancing_trades(target)
+        np.testing.assert_allclose(rebalancing, [-2.5, 5, 0])
+
+        trades = np.array([[0, 0, 0], rebalancing, [-20, 0, 1], [0, 10, 5]])
+        evaluation = universe.evaluate_trades(trades, target=target, cost=0.01)
+        np.testing.assert_allclose(evaluation.drift, [1 / 6, 0, 1 / 2, 1 / 5])
+        np.testing.assert_allclose(evaluation.cash, [0, -1, 375.8, -202])
+        self.assertEqual(evaluation.feasible.tolist(), [True, True, False, True])
+        # trades of the fund before its first price aren't feasible
+        self.assertFalse(universe.evaluate_trades(trades[3], date=datetime.date(2019, 1, 15)).feasible[0])
+
+        parallel = universe.evaluate_trades(trades, target=target, cost=0.01, workers=2, chunk_size=2)
+        np.testing.assert_allclose(parallel.weights, evaluation.weights)
+
+    def test_simulate(self):
+        universe = Universe.load(self.portfolio, datetime.date(2019, 1, 1), datetime.date(2019, 3, 31))
+        target = {self.it.pk: 1, self.energy.pk: 1}
+        result = universe.simulate(target, ['never', 'monthly', 'monthly'], thresholds=[0, 0, 0.2], cost=0.01)
+        np.testing.assert_allclose(result.values[0], 10 * universe.prices.sum(axis=0))
+        # prices are balanced on the first of February, so only the first of March drifted beyond the target
+        self.assertEqual(result.rebalances.tolist(), [0, 1, 0])
+        np.testing.assert_allclose(result.costs, [0, 1, 0])
+        np.testing.assert_allclose(result.values[:, -1], [300, 299, 300])
+        # the costs are paid from cash
+        np.testing.assert_allclose(result.cash, [0, -1, 0])
+        np.testing.assert_allclose(result.weights[1], [150 / 299] * 2)
+
+
+class BenchmarkTests(TestCase):
+    """Tests of the synthetic data generator and the benchmark suite."""
+
+    def test_generate_and_run(self):
+        generator = SyntheticData(portfolios=2, stocks=3, bonds=2, funds=1, years=1, investments=3, transactions=4)
+        data = generator.generate()
+        self.assertEqual((data['assets'], data['investments'], data['transactions']), (6, 6, 24))
+        self.assertEqual(Holding.objects.count(), 6)
+        self.assertTrue(Holding.objects.filter(volume__gt=0).exists())
+
+        results = run_benchmarks(['valuation', 'admin_transaction_changelist'], repeat=1)
+        self.assertEqual([result['name'] for result in results], ['valuation', 'admin_transaction_changelist'])
+        self.assertEqual(results[0]['queries'], 3)
+        comparison = compare(results, results)
+        self.assertFalse(any(entry['regression'] for entry in comparison))
+
+    @override_settings(USE_TZ=False)
+    def test_without_time_zone_support(self):
+        generator = SyntheticData(portfolios=1, stocks=2, bonds=0, funds=0, years=1, investments=2, transactions=2)
+        self.assertEqual(generator.generate()['transactions'], 4)
+        self.assertTrue(timezone.is_naive(SharePrice.objects.earliest('date').date))
+        self.assertEqual([result['name'] for result in run_benchmarks(['bulk_import'], repeat=1)], ['bulk_import'])
+
+
+class InstrumentationTests(TestCase):
+    """Tests of the query and latency instrumentation."""
+
+    def setUp(self):
+        get_price_cache().clear()
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        for i in range(3):
+            asset = create_stock(i)
+            Investment.objects.create(portfolio=self.portfolio, asset=asset)
+
+    def test_profile_reveals_repeated_queries(self):
+        with QueryProfile('loop') as profile:
+            names = [str(investment) for investment in Investment.objects.all()]
+            str(Investment.objects.first())
+        self.assertEqual(len(names), 3)
+        self.assertEqual(len(profile.queries), 6)
+        query, count = profile.similar()[0]
+        self.assertEqual(count, 4)
+        self.assertIn('portfolio/models.py', query.origin)
+        self.assertIn('__str__', query.origin)
+        self.assertEqual(profile.duplicate_count(), 1)
+
+    def test_middleware_records_statistics(self):
+        statistics = Statistics(backend=caches['default'], flush_interval=0)
+        middleware = QueryInstrumentationMiddleware(lambda request: IndexView.as_view()(request).render())
+        middleware.options = dict(middleware.options, MAX_QUERIES=1, SERVER_TIMING=True)
+        request = RequestFactory().get('/')
+        request.resolver_match = resolve(reverse('portfolio:index'))
+        with mock.patch('portfolio.instrumentation.get_statistics', return_value=statistics):
+            with self.assertLogs('portfolio.instrumentation', 'WARNING'):
+                response = middleware(request)
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+        percentiles = Statistics(backend=caches['default']).percentiles(statistics.collect())
+        self.assertEqual(percentiles['portfolio:index']['count'], 1)
+        self.assertEqual(percentiles['portfolio:index']['queries']['max'], 4)
+        statistics.clear()
+        self.assertEqual(statistics.collect(), {})
+
+
+class ExchangeRateTests(TestCase):
+    """Tests of the currency conversion."""
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        self.asset = Stock.objects.create(name='Stock', isin='US0000000000', issuer='X', sector='IT')
+        share_price = SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime(2019, 1, 2, 12)), price=Money(10, 'USD'))
+        Transaction.objects.create(
+            investment=Investment.objects.create(portfolio=self.portfolio, asset=self.asset),
+            transaction_date=datetime.date(2019, 1, 2), share_price=share_price, volume=decimal.Decimal(10))
+
+    def rate(self, base, quote, date, rate):
+        return ExchangeRate.objects.create(
+            base_currency=base, quote_currency=quote, date=date, rate=decimal.Decimal(rate))
+
+    def test_lookup(self):
+        self.rate('USD', 'EUR', datetime.date(2019, 1, 1), '0.9')
+        # direct rates are preferred over inverse rates of the same day
+        self.rate('EUR', 'USD', datetime.date(2019, 1, 1), '1.2')
+        self.rate('EUR', 'GBP', datetime.date(2019, 1, 3), '0.8')
+        self.rate('CHF', 'EUR', datetime.date(2018, 11, 30), '0.875')
+        with self.assertNumQueries(1):
+            rates = RateTable.load('EUR', ['USD', 'GBP', 'CHF', 'JPY'], datetime.date(2019, 1, 5),
+                                   datetime.date(2019, 1, 10))
+        np.testing.assert_allclose(
+            rates.lookup(['USD', 'GBP', 'GBP', 'EUR', 'CHF', 'JPY'], [datetime.date(2019, 1, 10)] * 2 + [
+                datetime.date(2019, 1, 2), datetime.date(2019, 1, 2), datetime.date(2019, 1, 5),
+                datetime.date(2019, 1, 5)]),
+            [0.9, 1.25, np.nan, 1, np.nan, np.nan])
+        with self.assertRaisesMessage(MissingRateError, 'GBP at 2019-01-02'):
+            rates.lookup(['GBP'], [datetime.date(2019, 1, 2)], strict=True)
+
+        # the rate valid at the first day is searched within the lookback
+        rates = RateTable.load('EUR', ['CHF'], datetime.date(2019, 1, 5), datetime.date(2019, 1, 10), lookback=40)
+        np.testing.assert_allclose(rates.convert([8], ['CHF'], [datetime.date(2019, 1, 5)]), [7])
+
+        np.testing.assert_allclose(
+            convert([10, 10, 10], ['USD', 'EUR', 'GBP'], [datetime.date(2019, 1, 5)] * 3, 'EUR'), [9, 10, 12.5])
+        self.assertEqual(len(convert([], [], [], 'EUR')), 0)
+
+    def test_valuation(self):
+        self.rate('USD', 'EUR', datetime.date(2019, 1, 1), '0.9')
+        self.rate('EUR', 'USD', datetime.date(2019, 1, 8), '1.25')
+        SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime(2019, 1, 9, 12)), price=Money(10, 'USD'))
+
+        # the cost basis is converted at the transaction date, the price at the valuation date
+        valuation = value_portfolios(self.portfolio, datetime.date(2019, 1, 10), currency='EUR')
+        np.testing.assert_allclose(valuation.cost_basis, [90])
+        np.testing.assert_allclose(valuation.market_value, [80])
+        self.assertEqual(valuation.currency, ['EUR'])
+
+        # the price remains constant in USD but loses value in EUR
+        period = (datetime.date(2019, 1, 2), datetime.date(2019, 1, 10))
+        self.assertEqual(compute_returns(self.portfolio, [period]).twr.tolist(), [[0]])
+        np.testing.assert_allclose(compute_returns(self.portfolio, [period], currency='EUR').twr, [[80 / 90 - 1]])
+
+    def test_missing_rate(self):
+        date = datetime.date(2019, 1, 10)
+        self.assertEqual(value_portfolios(self.portfolio, date).market_value.tolist(), [100])
+        # a price without exchange rate isn't valued at zero
+        with self.assertRaisesMessage(MissingRateError, 'No exchange rate into EUR known for USD at 2019-01-02'):
+            value_portfolios(self.portfolio, date, currency='EUR')
+        with self.assertRaises(MissingRateError):
+            value_history(self.portfolio, datetime.date(2019, 1, 1), date, currency='EUR')
+
+
+class HoldingTests(TestCase):
+    """Tests of the holdings snapshot table."""
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        self.asset = Stock.objects.create(name='Stock', isin='DE0000000000', issuer='X', sector='IT')
+        self.investment = Investment.objects.create(portfolio=self.portfolio, asset=self.asset)
+
+    def trade(self, transaction_type, date, volume, price, investment=None):
+        share_price = SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime.combine(date, datetime.time(12))),
+            price=Money(price, 'EUR'))
+        return Transaction.objects.create(
+            investment=investment or self.investment, transaction_type=transaction_type, transaction_date=date,
+            share_price=share_price, volume=decimal.Decimal(volume))
+
+    def holding(self, investment=None):
+        return Holding.objects.values_list('volume', 'cost_basis', 'last_transaction_date').get(
+            investment=investment or self.investment)
+
+    def test_updates(self):
+        self.assertEqual(self.holding(), (0, 0, None))
+        with mock.patch('portfolio.holdings.recompute_holding', wraps=holdings.recompute_holding) as recompute:
+            self.trade(TransactionType.BUY, datetime.date(2019, 1, 2), 10, 10)
+            sale = self.trade(TransactionType.SALE, datetime.date(2019, 2, 1), 4, 15)
+            # transactions appended to the ledger are applied incrementally
+            self.assertFalse(recompute.called)
+            self.assertEqual(self.holding(), (6, 60, datetime.date(2019, 2, 1)))
+
+            backdated = self.trade(TransactionType.BUY, datetime.date(2018, 12, 1), 10, 5)
+            self.assertEqual(recompute.call_count, 1)
+            self.assertEqual(self.holding(), (16, 120, datetime.date(2019, 2, 1)))
+
+        sale.volume = 8
+        sale.save()
+        self.assertEqual(self.holding(), (12, 90, datetime.date(2019, 2, 1)))
+
+        backdated.share_price.price = Money(20, 'EUR')
+        backdated.share_price.save()
+        self.assertEqual(self.holding(), (12, 180, datetime.date(2019, 2, 1)))
+
+        # moving a transaction recomputes the holdings of both investments
+        other = Investment.objects.create(portfolio=Portfolio.objects.create(name='Beta'), asset=self.asset)
+        backdated.investment = other
+        backdated.save()
+        self.assertEqual(self.holding(), (2, 20, datetime.date(2019, 2, 1)))
+        self.assertEqual(self.holding(other), (10, 200, datetime.date(2018, 12, 1)))
+
+    def test_rebuild(self):
+        self.trade(TransactionType.BUY, datetime.date(2019, 1, 2), 10, 10)
+        self.trade(TransactionType.SALE, datetime.date(2019, 2, 1), 4, 15)
+        Holding.objects.update(volume=0)
+        mismatches = holdings.rebuild_holdings(verify=True)
+        self.assertEqual([(mismatch.investment_id, mismatch.stored, mismatch.expected) for mismatch in mismatches],
+                         [(self.investment.pk, (0, 60), (6, 60))])
+
+        output, errors = io.StringIO(), io.StringIO()
+        with self.assertRaisesMessage(CommandError, '1 holdings are inconsistent'):
+            call_command('rebuild_holdings', '--verify', stdout=output, stderr=errors)
+        self.assertIn('investment {}: stored'.format(self.investment.pk), errors.getvalue())
+
+        call_command('rebuild_holdings', str(self.portfolio.pk), stdout=output)
+        self.assertIn('Rebuilt 1 holdings.', output.getvalue())
+        self.assertEqual(self.holding(), (6, 60, datetime.date(2019, 2, 1)))
+        call_command('rebuild_holdings', '--verify', stdout=output)
+        self.assertIn('All holdings are consistent.', output.getvalue())
+
+
+class HoldingDeletionTests(TransactionTestCase):
+    """Tests of deleted transactions, whose holdings are recomputed once the deletion is committed."""
+
+    def test_delete(self):
+        portfolio = Portfolio.objects.create(name='Alpha')
+        asset = Stock.objects.create(name='Stock', isin='DE0000000000', issuer='X', sector='IT')
+        investment = Investment.objects.create(portfolio=portfolio, asset=asset)
+        for date, transaction_type, volume in ((datetime.date(2019, 1, 2), TransactionType.BUY, 10),
+                                               (datetime.date(2019, 2, 1), TransactionType.SALE, 4)):
+            Transaction.objects.create(
+                investment=investment, transaction_type=transaction_type, transaction_date=date, volume=volume,
+                share_price=SharePrice.objects.create(
+                    asset=asset, date=timezone.make_aware(datetime.datetime.combine(date, datetime.time(12))),
+                    price=Money(10, 'EUR')))
+
+        Transaction.objects.get(transaction_type=TransactionType.SALE).delete()
+        self.assertEqual(Holding.objects.values_list('volume', 'cost_basis', 'last_transaction_date').get(),
+                         (10, 100, datetime.date(2019, 1, 2)))
+
+        # the holding isn't recreated for an investment deleted in the same cascade
+        investment.delete()
+        self.assertFalse(Holding.objects.exists())
+
+
+class ReturnTests(TestCase):
+    """Tests of the time-weighted and money-weighted returns."""
+
+    def test_time_weighted_returns(self):
+        values = np.array([[100, 110, 160, 176], [0, 100, 110, 0], [0, 0, 0, 0]], dtype=np.float64)
+        flows = np.array([[0, 0, 40, 0], [0, 100, 0, -110], [0, 0, 0, 0]], dtype=np.float64)
+        returns = time_weighted_returns(values, flows, np.array([0, 1, 0]), np.array([3, 2, 1]))
+        # 1.1 * (120 / 110) * 1.1, starting without value, never invested
+        np.testing.assert_allclose(returns, [
+            [0.32, 120 / 110 - 1, 0.1],
+            [0.1, 0.1, 0],
+            [np.nan, np.nan, np.nan],
+        ])
+
+    def test_money_weighted_returns(self):
+        days = np.array([0, 365, 730], dtype=np.float64)
+        values = np.array([[100, 110, 121], [100, 210, 231], [0, 100, 110], [100, 50, 0]], dtype=np.float64)
+        flows = np.array([[0, 0, 0], [0, 100, 0], [0, 100, 0], [0, 0, 0]], dtype=np.float64)
+        returns = money_weighted_returns(values, flows, days, np.array([0, 0]), np.array([1, 2]))
+        # no flows, 100 (1 + r) ** 2 + 100 (1 + r) = 231, zero start value and a total loss, the first period of the
+        # third row and the total loss have no root
+        np.testing.assert_allclose(returns, [[0.1, 0.1], [0.1, 0.1], [np.nan, 0.1], [-0.5, np.nan]], atol=1e-9)
+
+        # all cash flows paid by the investor
+        rates = solve_xirr(np.zeros(2, dtype=np.int64), np.array([0, 1.0]), np.array([-100, -50.0]), 1)
+        self.assertTrue(np.isnan(rates[0]))
+
+    def test_compute_returns(self):
+        portfolio = Portfolio.objects.create(name='Alpha')
+        asset = Stock.objects.create(name='Stock', isin='DE0000000000', issuer='X', sector='IT')
+        investment = Investment.objects.create(portfolio=portfolio, asset=asset)
+        for year, price, volume in ((2018, 10, 10), (2019, 11, 10), (2020, '12.1', 0)):
+            share_price = SharePrice.objects.create(
+                asset=asset, date=timezone.make_aware(datetime.datetime(year, 1, 1, 12)), price=Money(price, 'EUR'))
+            if volume:
+                Transaction.objects.create(
+                    investment=investment, transaction_date=datetime.date(year, 1, 1), share_price=share_price,
+                    volume=decimal.Decimal(volume))
+
+        periods = [(datetime.date(2018, 1, 1), datetime.date(2020, 1, 1))]
+        with self.assertNumQueries(4):
+            returns = compute_returns(portfolio, periods)
+        self.assertEqual(returns.ids, [portfolio.pk])
+        # 110 / 100 * (242 - 110) / 220, 100 (1 + r) ** 2 + 110 (1 + r) = 242
+        np.testing.assert_allclose(returns.twr, [[0.21]])
+        np.testing.assert_allclose(returns.xirr, [[0.1]])
+        self.assertEqual(compute_returns(portfolio, periods, by_investment=True).ids, [investment.pk])
+        with self.assertRaises(ValueError):
+            compute_returns(portfolio, [(datetime.date(2019, 1, 3), datetime.date(2019, 1, 1))])
+
+
+class IdentifierTests(TestCase):
+    """Tests of the security identifiers."""
+
+    def test_check_digits(self):
+        self.assertEqual(isin_check_digit('US037833100'), '5')
+        self.assertTrue(is_valid_isin('US0378331005'))
+        self.assertTrue(is_valid_isin('us0378331005'))
+        self.assertFalse(is_valid_isin('US0378331006'))
+        self.assertFalse(is_valid_isin('0S0378331005'))
+        self.assertEqual(cusip_check_digit('03783310'), '0')
+        self.assertTrue(is_valid_cusip('037833100'))
+        self.assertTrue(is_valid_cusip('38259P508'))
+        self.assertFalse(is_valid_cusip('037833101'))
+
+    def test_conversion(self):
+        self.assertEqual(wkn_to_isin('716460'), 'DE0007164600')
+        self.assertEqual(cusip_to_isin('037833100'), 'US0378331005')
+        self.assertEqual(valor_to_isin(1203204), 'CH0012032048')
+        self.assertEqual(national_identifiers('DE0007164600'), {'wkn': '716460'})
+        self.assertEqual(national_identifiers('US0378331005'), {'cusip': '037833100'})
+        self.assertEqual(national_identifiers('CH0012032048'), {'valor': 1203204})
+        self.assertEqual(national_identifiers('GB0002634946'), {})
+
+    def test_candidate_isins(self):
+        self.assertEqual(candidate_isins(' us0378331005 '), ['US0378331005'])
+        # six digits may be a WKN or a VALOR
+        self.assertEqual(candidate_isins('716460'), ['DE0007164600', 'CH0007164608', 'LI0007164606'])
+        self.assertEqual(candidate_isins('037833100'), ['US0378331005', 'CA0378331007', 'CH0378331000', 'LI0378331008'])
+        self.assertEqual(candidate_isins('X'), [])
+
+    def test_resolver(self):
+        sap = Stock.objects.create(name='SAP', isin='DE0007164600', issuer='X', sector='IT')
+        apple = Stock.objects.create(name='Apple', isin='US0378331005', issuer='X', sector='IT')
+        roche = Stock.objects.create(name='Roche', isin='CH0012032048', issuer='X', sector='Health', valor=1203204)
+        bond = Bond.objects.create(name='Bond', isin='XS0000000009', issuer='X', wkn='A0B1C2')
+
+        resolver = AssetResolver()
+        with self.assertNumQueries(1):
+            resolved = resolver.resolve(['716460', '037833100', 'US0378331005', 1203204, 'a0b1c2', 'DE000A0B1C20', 'X'])
+        self.assertEqual(resolved, {
+            '716460': sap.pk, '037833100': apple.pk, 'US0378331005': apple.pk, 1203204: roche.pk, 'a0b1c2': bond.pk,
+            'DE000A0B1C20': bond.pk, 'X': None,
+        })
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve_one('037833100'), apple.pk)
+
+    def test_warm(self):
+        apple = Stock.objects.create(name='Apple', isin='US0378331005', issuer='X', sector='IT')
+        resolver = AssetResolver()
+        with self.assertNumQueries(1):
+            resolver.warm()
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve_one('037833100'), apple.pk)
+
+        # assets created after warming are found with a query
+        sap = Stock.objects.create(name='SAP', isin='DE0007164600', issuer='X', sector='IT')
+        with self.assertNumQueries(1):
+            self.assertEqual(resolver.resolve_one('716460'), sap.pk)
+
+
+class MigrationTests(TransactionTestCase):
+    """Tests of the data migrations."""
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_merge_duplicate_share_prices(self):
+        apps = migrate('0006_alter_transaction_field_types')
+        SharePrice = apps.get_model('portfolio', 'SharePrice')
+        asset = apps.get_model('portfolio', 'Asset').objects.create(name='Stock', isin='DE0000000000', issuer='X')
+        investment = apps.get_model('portfolio', 'Investment').objects.create(
+            portfolio=apps.get_model('portfolio', 'Portfolio').objects.create(name='Alpha'), asset=asset)
+        date = timezone.make_aware(datetime.datetime(2019, 1, 2, 12))
+        prices = [SharePrice.objects.create(asset=asset, date=date, price=price, price_currency='EUR')
+                  for price in (10, 11, 12)]
+        for share_price in prices[1:]:
+            apps.get_model('portfolio', 'Transaction').objects.create(
+                investment=investment, transaction_date=date.date(), volume=1, share_price=share_price)
+
+        apps = migrate('0007_add_share_price_asset_date_index')
+        self.assertEqual(list(apps.get_model('portfolio', 'SharePrice').objects.values_list('pk', flat=True)),
+                         [prices[0].pk])
+        self.assertEqual(
+            list(apps.get_model('portfolio', 'Transaction').objects.values_list('share_price_id', flat=True)),
+            [prices[0].pk] * 2)
+
+    def test_create_holdings(self):
+        apps = migrate('0007_add_share_price_asset_date_index')
+        Asset = apps.get_model('portfolio', 'Asset')
+        Investment = apps.get_model('portfolio', 'Investment')
+        portfolio = apps.get_model('portfolio', 'Portfolio').objects.create(name='Alpha')
+        asset = Asset.objects.create(name='Stock', isin='DE0000000000', issuer='X')
+        investment = Investment.objects.create(portfolio=portfolio, asset=asset)
+        empty = Investment.objects.create(portfolio=portfolio, asset=asset)
+        share_price = apps.get_model('portfolio', 'SharePrice').objects.create(
+            asset=asset, date=timezone.make_aware(datetime.datetime(2019, 1, 2)), price=10, price_currency='EUR')
+        for day, transaction_type, volume in ((2, TransactionType.BUY, 10), (3, TransactionType.SALE, 4)):
+            apps.get_model('portfolio', 'Transaction').objects.create(
+                investment=investment, transaction_type=transaction_type, transaction_date=datetime.date(2019, 1, day),
+                volume=volume, share_price=share_price)
+
+        apps = migrate('0008_add_holding_model')
+        self.assertEqual(
+            list(apps.get_model('portfolio', 'Holding').objects.order_by('pk').values_list(
+                'investment_id', 'volume', 'cost_basis', 'last_transaction_date')),
+            [(investment.pk, 6, 60, datetime.date(2019, 1, 3)), (empty.pk, 0, 0, None)])
+
+    def test_merge_duplicate_assets(self):
+        apps = migrate('0010_add_exchange_rate_model')
+        Asset = apps.get_model('portfolio', 'Asset')
+        SharePrice = apps.get_model('portfolio', 'SharePrice')
+        Investment = apps.get_model('portfolio', 'Investment')
+        Transaction = apps.get_model('portfolio', 'Transaction')
+        kept = Asset.objects.create(name='SAP', isin='DE0007164600', issuer='X', wkn='716460')
+        duplicate = Asset.objects.create(name='SAP SE', isin='DE0007164600', issuer='X', wkn='716460')
+        Asset.objects.create(name='Apple', isin='US0378331005', issuer='X', cusip='037833100')
+        other = Asset.objects.create(name='Other', isin='US0000000000', issuer='X', cusip='037833100')
+        dates = [timezone.make_aware(datetime.datetime(2019, 1, day)) for day in (2, 3)]
+        SharePrice.objects.create(asset=kept, date=dates[0], price=10, price_currency='EUR')
+        investment = Investment.objects.create(
+            portfolio=apps.get_model('portfolio', 'Portfolio').objects.create(name='Alpha'), asset=duplicate)
+        for date in dates:
+            Transaction.objects.create(
+                investment=investment, transaction_date=date.date(), volume=1,
+                share_price=SharePrice.objects.create(asset=duplicate, date=date, price=11, price_currency='EUR'))
+
+        apps = migrate('0011_add_asset_identifier_constraints')
+        Asset = apps.get_model('portfolio', 'Asset')
+        SharePrice = apps.get_model('portfolio', 'SharePrice')
+        self.assertEqual(list(Asset.objects.order_by('pk').values_list('isin', 'wkn', 'cusip')), [
+            ('DE0007164600', '716460', ''), ('US0378331005', '', '037833100'), ('US0000000000', '', '')])
+        self.assertEqual(apps.get_model('portfolio', 'Investment').objects.get().asset_id, kept.pk)
+        # transactions of a duplicate price of the same date are moved to the price of the kept asset
+        self.assertEqual(SharePrice.objects.filter(asset=kept.pk).count(), 2)
+        self.assertEqual(
+            list(apps.get_model('portfolio', 'Transaction').objects.order_by('transaction_date').values_list(
+                'share_price__asset_id', 'share_price__price')),
+            [(kept.pk, 10), (kept.pk, 11)])
+        self.assertEqual(Asset.objects.get(pk=other.pk).cusip, '')
+
+    def test_merge_duplicate_funds(self):
+        apps = migrate('0010_add_exchange_rate_model')
+        Fund = apps.get_model('portfolio', 'Fund')
+        Asset = apps.get_model('portfolio', 'Asset')
+        plain = Asset.objects.create(name='Fund', isin='LU0000000000', issuer='X')
+        kept = Fund.objects.create(name='Fund', isin='LU0000000000', issuer='X', ter=decimal.Decimal('0.2'))
+        duplicate = Fund.objects.create(name='Fund A', isin='LU0000000000', issuer='X', ter=decimal.Decimal('0.2'))
+        # stocks of the historical models don't inherit the fields of assets
+        stock = apps.get_model('portfolio', 'Stock').objects.create(
+            asset_ptr=Asset.objects.create(name='Stock', isin='DE0000000000', issuer='X'), sector='IT')
+        stock.funds.add(duplicate)
+        bond = apps.get_model('portfolio', 'Bond').objects.create(name='Bond', isin='DE0000000001', issuer='X')
+        bond.funds.add(kept, duplicate)
+        apps.get_model('portfolio', 'FundAllocation').objects.create(
+            fund=duplicate, asset_id=stock.pk, weight=decimal.Decimal('0.5'))
+        apps.get_model('portfolio', 'Investment').objects.create(
+            portfolio=apps.get_model('portfolio', 'Portfolio').objects.create(name='Alpha'), asset=plain)
+
+        apps = migrate('0011_add_asset_identifier_constraints')
+        # the oldest fund is kept instead of the plain asset, which would lose the type
+        self.assertEqual(list(apps.get_model('portfolio', 'Fund').objects.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(apps.get_model('portfolio', 'Asset').objects.filter(isin='LU0000000000').count(), 1)
+        self.assertEqual(apps.get_model('portfolio', 'Investment').objects.get().asset_id, kept.pk)
+        Stock = apps.get_model('portfolio', 'Stock')
+        Bond = apps.get_model('portfolio', 'Bond')
+        self.assertEqual(list(Stock.objects.get().funds.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(list(Bond.objects.get().funds.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(list(apps.get_model('portfolio', 'FundAllocation').objects.values_list('fund_id', 'asset_id')),
+                         [(kept.pk, stock.pk)])
+
+    def test_merge_duplicate_assets_of_different_types(self):
+        apps = migrate('0010_add_exchange_rate_model')
+        Asset = apps.get_model('portfolio', 'Asset')
+        apps.get_model('portfolio', 'Stock').objects.create(
+            asset_ptr=Asset.objects.create(name='Stock', isin='DE0000000000', issuer='X'), sector='IT')
+        bond = apps.get_model('portfolio', 'Bond').objects.create(name='Bond', isin='DE0000000000', issuer='X')
+        with self.assertRaisesMessage(ValueError, 'different types (Bond, Stock)'):
+            migrate('0011_add_asset_identifier_constraints')
+        Asset.objects.filter(pk=bond.pk).delete()
+
+
+    def test_build_price_bars(self):
+        apps = migrate('0013_add_portfolio_version')
+        asset = apps.get_model('portfolio', 'Asset').objects.create(name='Stock', isin='DE0000000000', issuer='X')
+        for day, amount in ((29, 12), (30, 8), (31, 15)):
+            apps.get_model('portfolio', 'SharePrice').objects.create(
+                asset=asset, date=timezone.make_aware(datetime.datetime(2018, 1, day, 12)), price=amount,
+                price_currency='EUR')
+
+        migrate('0014_add_price_bar_model')
+        bars = list(PriceBar.objects.order_by('resolution', 'period_start').values_list(
+            'resolution', 'period_start', 'open', 'high', 'low', 'close', 'count'))
+        self.assertIn((Resolution.WEEK, datetime.date(2018, 1, 29), 12, 15, 8, 15, 3), bars)
+        self.assertEqual(len(bars), 5)
+        rebuild_bars()
+        self.assertEqual(list(PriceBar.objects.order_by('resolution', 'period_start').values_list(
+            'resolution', 'period_start', 'open', 'high', 'low', 'close', 'count')), bars)
+
+
+class LookThroughTests(TestCase):
+    """Tests of the look-through exposure."""
+
+    def setUp(self):
+        self.a = Stock.objects.create(name='A', isin='DE0000000000', issuer='A', sector='IT')
+        self.b = Stock.objects.create(name='B', isin='DE0000000001', issuer='B', sector='Energy')
+        self.c = Bond.objects.create(name='C', isin='DE0000000002', issuer='C')
+        self.inner = Fund.objects.create(name='Inner', isin='LU0000000000', issuer='X', ter=0.5)
+        self.outer = Fund.objects.create(name='Outer', isin='LU0000000001', issuer='X', ter=0.5)
+        self.equal = Fund.objects.create(name='Equal', isin='LU0000000002', issuer='X', ter=0.5)
+        for fund, asset, weight in ((self.inner, self.a, '0.5'), (self.inner, self.b, '0.3'),
+                                    (self.outer, self.inner, '0.5'), (self.outer, self.c, '0.5')):
+            FundAllocation.objects.create(fund=fund, asset=asset, weight=decimal.Decimal(weight))
+        # funds without allocations are equally weighted across their members
+        self.a.funds.add(self.equal)
+        self.c.funds.add(self.equal)
+
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        for asset, volume, price in ((self.outer, 10, 10), (self.equal, 10, 10), (self.a, 1, 50)):
+            Transaction.objects.create(
+                investment=Investment.objects.create(portfolio=self.portfolio, asset=asset),
+                transaction_date=datetime.date(2019, 1, 2), volume=decimal.Decimal(volume),
+                share_price=SharePrice.objects.create(
+                    asset=asset, date=timezone.make_aware(datetime.datetime(2019, 1, 2, 12)),
+                    price=Money(price, 'EUR')))
+
+    def test_exposure(self):
+        with self.assertNumQueries(3):
+            graph = FundGraph.load()
+        self.assertEqual(portfolio_exposure(self.portfolio, graph=graph).currency, 'EUR')
+        exposure = portfolio_exposure(self.portfolio, graph=graph).as_dict()[self.portfolio.pk]
+        # the outer fund holds 50 of the inner fund, which keeps its unallocated remainder of 10
+        self.assertEqual(set(exposure), {self.a.pk, self.b.pk, self.c.pk, self.inner.pk})
+        np.testing.assert_allclose(
+            [exposure[asset.pk] for asset in (self.a, self.b, self.c, self.inner)], [125, 15, 100, 10])
+        self.assertEqual(portfolio_exposure(self.portfolio, by='sector', graph=graph).as_dict(), {
+            self.portfolio.pk: {'IT': 125, 'Energy': 15, '': 110}})
+        with self.assertRaises(ValueError):
+            portfolio_exposure(self.portfolio, by='country')
+
+    def test_currency(self):
+        d = Stock.objects.create(name='D', isin='US0000000000', issuer='D', sector='IT')
+        Transaction.objects.create(
+            investment=Investment.objects.create(portfolio=self.portfolio, asset=d),
+            transaction_date=datetime.date(2019, 1, 2), volume=decimal.Decimal(2),
+            share_price=SharePrice.objects.create(
+                asset=d, date=timezone.make_aware(datetime.datetime(2019, 1, 2, 12)), price=Money(20, 'USD')))
+        graph = FundGraph.load()
+        with self.assertRaises(ValueError):
+            portfolio_exposure(self.portfolio, graph=graph)
+
+        ExchangeRate.objects.create(
+            base_currency='USD', quote_currency='EUR', date=datetime.date(2019, 1, 1), rate=decimal.Decimal('0.9'))
+        exposure = portfolio_exposure(self.portfolio, by='sector', graph=graph, currency='EUR')
+        self.assertEqual(exposure.currency, 'EUR')
+        np.testing.assert_allclose([exposure.as_dict()[self.portfolio.pk][key] for key in ('IT', 'Energy', '')],
+                                   [125 + 36, 15, 110])
+        self.assertEqual(portfolio_exposure(Portfolio.objects.none(), graph=graph).currency, None)
+
+    def test_max_depth(self):
+        graph = FundGraph.load()
+        exposure = np.zeros((1, len(graph.asset_ids)))
+        exposure[0, graph.index(np.array([self.outer.pk]))] = 100
+        resolved = dict(zip(graph.asset_ids.tolist(), graph.resolve(exposure, max_depth=1)[0].tolist()))
+        # exposure beyond max_depth stays with the inner fund
+        self.assertEqual({asset_id: value for asset_id, value in resolved.items() if value},
+                         {self.inner.pk: 50, self.c.pk: 50})
+
+    def test_weights(self):
+        FundAllocation(fund=self.inner, asset=self.c, weight=decimal.Decimal('0.2')).full_clean()
+        for asset, weight in ((self.c, '0.3'), (self.c, '0'), (self.inner, '0.1')):
+            with self.assertRaises(ValidationError):
+                FundAllocation(fund=self.inner, asset=asset, weight=decimal.Decimal(weight)).full_clean()
+
+        # weights bypassing the validation are scaled to a sum of one
+        FundAllocation.objects.create(fund=self.inner, asset=self.c, weight=decimal.Decimal('0.4'))
+        with self.assertLogs('portfolio.lookthrough', 'WARNING'):
+            graph = FundGraph.load()
+        exposure = portfolio_exposure(self.portfolio, graph=graph).as_dict()[self.portfolio.pk]
+        np.testing.assert_allclose([exposure[self.a.pk], exposure[self.b.pk], exposure[self.c.pk]],
+                                   [50 + 50 + 25 / 1.2, 15 / 1.2, 100 + 20 / 1.2])
+        self.assertNotIn(self.inner.pk, exposure)
+
+
+class PriceImportTests(TestCase):
+    """Tests of the bulk import of share prices."""
+
+    def setUp(self):
+        self.asset = Stock.objects.create(
+            name='Roche', isin='CH0012032048', issuer='X', sector='Health', valor=1203204)
+        self.date = timezone.make_aware(datetime.datetime(2019, 1, 2))
+        share_price = SharePrice.objects.create(asset=self.asset, date=self.date, price=Money(10, 'CHF'))
+        Transaction.objects.create(
+            investment=Investment.objects.create(portfolio=Portfolio.objects.create(name='Alpha'), asset=self.asset),
+            transaction_date=self.date.date(), share_price=share_price, volume=decimal.Decimal(2))
+
+    def test_read(self):
+        records = list(read_json_prices(io.StringIO(
+            '{"isin": 1203204, "date": "2019-01-03", "price": 10.5, "currency": null}\n'
+            '{"isin": " ch0012032048 ", "date": "2019-01-04T12:00:00", "price": "11", "currency": "chf"}\n'),
+            default_currency='EUR'))
+        self.assertEqual([(record.isin, record.date, record.amount, record.currency) for record in records], [
+            ('1203204', timezone.make_aware(datetime.datetime(2019, 1, 3)), decimal.Decimal('10.5'), 'EUR'),
+            ('CH0012032048', timezone.make_aware(datetime.datetime(2019, 1, 4, 12)), 11, 'CHF'),
+        ])
+
+        for content in ('{"date": "2019-01-03", "price": 1}', '{"isin": null, "date": "2019-01-03", "price": 1}',
+                        '{"isin": ["X"], "date": "2019-01-03", "price": 1}',
+                        '{"isin": "X", "date": "2019-01-03", "price": 1, "currency": {}}',
+                        '{"isin": "X", "date": "yesterday", "price": 1}', '{"isin": "X", "date": "2019-01-03"}',
+                        '{"isin": "X", "date": "2019-01-03", "price": "one"}', '[1]'):
+            with self.assertRaises(ImportDataError, msg=content):
+                list(read_json_prices(io.StringIO(content)))
+        with self.assertRaises(ImportDataError):
+            list(read_csv_prices(io.StringIO('isin;date;price\nCH0012032048;2019-01-03;\n'), delimiter=';'))
+
+    def test_modes(self):
+        def records(price):
+            return [PriceRecord('1203204', self.date, decimal.Decimal(price), 'CHF'),
+                    PriceRecord('CH0012032048', self.date + datetime.timedelta(days=1), decimal.Decimal(price), 'CHF'),
+                    PriceRecord('XX0000000000', self.date, decimal.Decimal(price), 'CHF')]
+
+        result = import_prices(records(11), mode=ImportMode.SKIP)
+        self.assertEqual((result.created, result.replaced, result.skipped, result.unknown), (1, 0, 1, 1))
+        self.assertEqual(result.unknown_isins, {'XX0000000000'})
+        self.assertEqual(SharePrice.objects.get(date=self.date).price, Money(10, 'CHF'))
+
+        result = PriceImporter(batch_size=1, mode=ImportMode.REPLACE).run(records(12))
+        self.assertEqual((result.created, result.replaced, result.skipped, result.unknown), (0, 2, 0, 1))
+        self.assertEqual(list(SharePrice.objects.order_by('date').values_list('price', flat=True)), [12, 12])
+        # holdings depending on replaced prices are recomputed
+        self.assertEqual(Holding.objects.get().cost_basis, 24)
+
+        result = import_prices([PriceRecord('CH0012032048', self.date + datetime.timedelta(days=2), 13, 'CHF')])
+        self.assertEqual(result.created, 1)
+        with self.assertRaises(ValueError):
+            PriceImporter(mode='merge')
+
+    def test_insert_existing_price(self):
+        records = [PriceRecord('CH0012032048', self.date - datetime.timedelta(days=1), 9, 'CHF'),
+                   PriceRecord('CH0012032048', self.date, 11, 'CHF')]
+        with self.assertRaisesMessage(ImportDataError, 'CH0012032048 at 2019-01-02T00:00:00'):
+            PriceImporter(batch_size=1).run(records)
+        # the batches written before stay committed
+        self.assertEqual(list(SharePrice.objects.order_by('date').values_list('price', flat=True)), [9, 10])
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'prices.csv')
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write('isin,date,price,currency\nCH0012032048,2019-01-02,11,CHF\n')
+        with self.assertRaisesMessage(CommandError, '--mode'):
+            call_command('import_prices', path)
+
+    def test_command(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'prices.csv')
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write('isin,date,price,currency\nCH0012032048,2019-01-02,11,CHF\nCH0012032048,2019-01-03,12,\n'
+                         'XX0000000000,2019-01-03,1,\n')
+
+        output, errors = io.StringIO(), io.StringIO()
+        call_command('import_prices', path, '--mode', 'replace', '--currency', 'CHF', stdout=output, stderr=errors)
+        self.assertIn('1 created, 1 replaced, 0 skipped, 1 with unknown asset', output.getvalue())
+        self.assertIn('Unknown ISINs: XX0000000000', errors.getvalue())
+        self.assertEqual(list(SharePrice.objects.order_by('date').values_list('price', flat=True)), [11, 12])
+
+        with self.assertRaisesMessage(CommandError, 'Unable to determine format'):
+            call_command('import_prices', os.path.join(directory.name, 'prices.txt'))
+        with self.assertRaisesMessage(CommandError, 'Failed to import'):
+            call_command('import_prices', os.path.join(directory.name, 'missing.csv'))
+
+
+class ValuationTests(TestCase):
+    """Tests of the vectorized valuation."""
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create(name='Alpha')
+        self.asset = Stock.objects.create(name='Stock', isin='DE0000000000', issuer='X', sector='IT')
+        self.investment = Investment.objects.create(portfolio=self.portfolio, asset=self.asset)
+
+    def price(self, day, price):
+        return SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime(2019, 1, day, 12)), price=Money(price, 'EUR'))
+
+    def trade(self, transaction_type, day, volume, price):
+        return Transaction.objects.create(
+            investment=self.investment, transaction_type=transaction_type, transaction_date=datetime.date(2019, 1, day),
+            share_price=self.price(day, price), volume=decimal.Decimal(volume))
+
+    def test_segmented_cumsum(self):
+        values = np.array([1, 2, 3, 4, 5], dtype=np.float64)
+        starts = np.array([True, False, True, False, False])
+        np.testing.assert_array_equal(segmented_cumsum(values, starts), [1, 3, 3, 7, 12])
+
+    def test_average_cost(self):
+        # two investments: buy 10 for 100, buy 10 for 200, sell 5, sell 15 and buy again, buy 4 for 40 and sell 1
+        starts = np.array([True, False, False, False, False, True, False])
+        volume = np.array([10, 10, -5, -15, 2, 4, -1], dtype=np.float64)
+        amount = np.array([100, 200, 0, 0, 30, 40, 0], dtype=np.float64)
+        holdings, cost = average_cost(starts, volume, amount)
+        np.testing.assert_allclose(holdings, [10, 20, 15, 0, 2, 4, 3])
+        np.testing.assert_allclose(cost, [100, 300, 225, 0, 30, 40, 30])
+
+    def test_ledger(self):
+        self.trade(TransactionType.BUY, 2, 10, 10)
+        self.trade(TransactionType.BUY, 3, 10, 20)
+        self.trade(TransactionType.SALE, 4, 5, 30)
+        self.trade(TransactionType.DEPOT_FEE, 5, 1, 30)
+        Investment.objects.create(portfolio=self.portfolio, asset=self.asset)
+        with self.assertNumQueries(2):
+            ledger = Ledger.load(self.portfolio)
+        self.assertEqual(len(ledger.investment_ids), 2)
+        np.testing.assert_allclose(ledger.flow, [100, 200, -150, 0])
+
+        # partial sales remove the proportional cost basis, 14 of 20 shares remain at an average cost of 15
+        volume, cost_basis = ledger.final_positions()
+        np.testing.assert_allclose(volume, [14, 0])
+        np.testing.assert_allclose(cost_basis, [210, 0])
+        self.assertEqual(ledger.last_dates().tolist(), [datetime.date(2019, 1, 5), None])
+        self.assertEqual(
+            Ledger.load(self.portfolio, until=datetime.date(2019, 1, 3)).final_positions()[1].tolist(), [300, 0])
+
+    def test_price_matrix(self):
+        self.price(2, 10)
+        self.price(5, 12)
+        # the latest price of a day wins
+        SharePrice.objects.create(
+            asset=self.asset, date=timezone.make_aware(datetime.datetime(2019, 1, 5, 18)), price=Money(13, 'EUR'))
+        other = Stock.objects.create(name='Other', isin='DE0000000001', issuer='X', sector='IT')
+        with self.assertNumQueries(2):
+            dates, prices = price_matrix(
+                [self.asset.pk, other.pk], datetime.date(2019, 1, 1), datetime.date(2019, 1, 7))
+        self.assertEqual(dates.tolist()[0], datetime.date(2019, 1, 1))
+        # prices are carried forward across gaps, NaN before the first price
+        np.testing.assert_array_equal(prices, [[np.nan, 10, 10, 10, 13, 13, 13], [np.nan] * 7])
+
+        # the price before the first day is used for it
+        np.testing.assert_array_equal(
+            price_matrix([self.asset.pk], datetime.date(2019, 1, 3), datetime.date(2019, 1, 4))[1], [[10, 10]])
+
+    def test_value_history(self):
+        self.trade(TransactionType.BUY, 2, 10, 10)
+        self.price(4, 12)
+        self.trade(TransactionType.SALE, 6, 5, 15)
+        history = value_history(self.portfolio, datetime.date(2019, 1, 1), datetime.date(2019, 1, 7))
+        np.testing.assert_allclose(history.volume, [[0, 10, 10, 10, 10, 5, 5]])
+        np.testing.assert_allclose(history.values, [[0, 100, 100, 120, 120, 75, 75]])
+        np.testing.assert_allclose(history.flows, [[0, 100, 0, 0, 0, -75, 0]])
+        np.testing.assert_allclose(history.by_portfolio()[self.portfolio.pk], [0, 100, 100, 120, 120, 75, 75])
+
+        valuation = value_portfolios(self.portfolio, datetime.date(2019, 1, 5))
+        self.assertEqual(valuation.by_portfolio(), {self.portfolio.pk: {'cost_basis': 100, 'market_value': 120}})
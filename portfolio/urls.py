@@ -1,11 +1,19 @@
 """URL declarations of the portfolio app."""
 from django.urls import path
 
-from portfolio import views
+from portfolio import api, views
 
 
 app_name = 'portfolio'
 
 urlpatterns = [
-    path('', views.IndexView.as_view(), name='index')
+    path('', views.IndexView.as_view(), name='index'),
+    path('dashboard/', views.DashboardView.as_view(), name='dashboard'),
+    path('export/transactions/', views.TransactionExportView.as_view(), name='export_transactions'),
+    path('export/prices/', views.SharePriceExportView.as_view(), name='export_prices'),
+    path('api/portfolios/', api.PortfolioListView.as_view(), name='api_portfolios'),
+    path('api/portfolios/<int:pk>/investments/', api.InvestmentListView.as_view(), name='api_investments'),
+    path('api/portfolios/<int:pk>/holdings/', api.HoldingListView.as_view(), name='api_holdings'),
+    path('api/portfolios/<int:pk>/prices/', api.PriceListView.as_view(), name='api_prices'),
+    path('api/assets/<int:pk>/chart/', api.PriceChartView.as_view(), name='api_chart'),
 ]
@@ -0,0 +1,55 @@
+"""Helpers shared by the modules of the portfolio app."""
+import datetime
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+
+def object_ids(objects):
+    """Converts a model instance, an id or a collection of both into a list of ids.
+
+    :param objects: model instance, primary key or iterable / queryset of them
+    :return: list of primary keys
+    """
+    if hasattr(objects, 'values_list'):
+        return list(objects.values_list('pk', flat=True))
+    if isinstance(objects, int) or hasattr(objects, 'pk'):
+        objects = [objects]
+    return [getattr(obj, 'pk', obj) for obj in objects]
+
+
+def local_date(value):
+    """Returns the calendar date of a date or datetime in the current time zone.
+
+    :param value: date or datetime
+    :return: the date
+    """
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return value.date()
+    return value
+
+
+def day_start(date):
+    """Returns the beginning of a day as datetime suitable for comparisons with SharePrice.date.
+
+    :param date: the day
+    :return: midnight of the day, aware in the current time zone if time zone support is active
+    """
+    start = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ:
+        start = timezone.make_aware(start)
+    return start
+
+
+def to_datetime64(value):
+    """Converts a datetime into a datetime64 as used by the price archive (see portfolio.archive).
+
+    :param value: aware or naive datetime
+    :return: datetime64 in microseconds, in UTC if value is aware
+    """
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, datetime.timezone.utc)
+    return np.datetime64(value, 'us')
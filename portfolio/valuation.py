@@ -0,0 +1,372 @@
+"""Vectorized valuation of portfolios.
+
+All transactions and share prices required to value a set of portfolios are fetched with a small, constant number of
+queries and loaded into NumPy arrays. Holdings, cost basis and market values are then computed with cumulative sums
+instead of walking the ledger row by row.
+
+Cost basis follows the average cost method: inflows (see TransactionType.INFLOWS) add volume and purchase amount,
+outflows (see TransactionType.OUTFLOWS) remove volume and the proportional share of the cost basis. All amounts are
+expressed in the currency of the share prices involved unless a target currency is requested. Then transaction amounts
+are converted at their transaction date and share prices at their valuation date (see portfolio.fx).
+"""
+import datetime
+
+import numpy as np
+from django.utils import timezone
+
+from portfolio.archive import latest_prices, price_history
+from portfolio.fx import RateTable
+from portfolio.models import Investment, Transaction, TransactionType
+from portfolio.utils import day_start, local_date, object_ids, to_datetime64
+
+# direction of external cash flows, reinvestments and depot fees don't move money into or out of an investment
+_CASH_FLOW_SIGNS = {TransactionType.BUY: 1, TransactionType.SALE: -1, TransactionType.REDEMPTION: -1}
+
+
+def segmented_cumsum(values, starts):
+    """Computes cumulative sums which restart at every segment start.
+
+    :param values: one dimensional array
+    :param starts: boolean array marking the first element of each segment, the first element must be marked
+    :return: array of cumulative sums within each segment
+    """
+    totals = np.cumsum(values)
+    start_indices = np.flatnonzero(starts)
+    offsets = totals[start_indices] - values[start_indices]
+    return totals - offsets[np.cumsum(starts) - 1]
+
+
+def average_cost(starts, volume, amount):
+    """Computes holdings and average cost basis after each transaction of a sorted ledger.
+
+    The cost basis follows the recurrence c[k] = c[k - 1] * f[k] + a[k], where f[k] is the fraction of the holding left
+    after an outflow and a[k] the amount paid for an inflow. It is solved in closed form as c = P * cumsum(a / P) with
+    P being the cumulative product of f. Full liquidations (f = 0) start a new segment.
+
+    :param starts: boolean array marking the first transaction of each investment
+    :param volume: signed volume of each transaction
+    :param amount: amount paid for each inflow, zero for outflows
+    :return: tuple of arrays (holdings, cost basis) after each transaction
+    """
+    holdings = segmented_cumsum(volume, starts)
+    if not len(volume):
+        return holdings, holdings.copy()
+    previous = holdings - volume
+    outflow = volume < 0
+    fraction = np.ones_like(volume)
+    positive = outflow & (previous > 0)
+    fraction[positive] = np.clip(holdings[positive] / previous[positive], 0, 1)
+    fraction[outflow & (previous <= 0)] = 0
+
+    resets = starts | (fraction == 0)
+    fraction[resets] = 1
+    scale = np.exp(segmented_cumsum(np.log(fraction), resets))
+    cost = scale * segmented_cumsum(amount / scale, resets)
+    cost[holdings <= 0] = 0
+    return holdings, cost
+
+
+class Ledger:
+    """Transactions of a set of investments loaded into arrays sorted by investment and date.
+
+    :ivar investment_ids: ids of all investments, also those without transactions
+    :ivar portfolio_ids: portfolio id of each investment
+    :ivar asset_ids: asset id of each investment
+    :ivar index: position of each transaction's investment in investment_ids
+    :ivar dates: transaction dates as datetime64[D]
+    :ivar volume: volume of each transaction, negative for outflows
+    :ivar amount: purchase amount of each inflow, zero for outflows
+    :ivar flow: external cash flow of each transaction, positive for purchases and negative for proceeds
+    :ivar currencies: currency code of the share price of each transaction
+    """
+
+    def __init__(self, investments, transactions):
+        self.investment_ids = np.array([row[0] for row in investments], dtype=np.int64)
+        self.portfolio_ids = np.array([row[1] for row in investments], dtype=np.int64)
+        self.asset_ids = np.array([row[2] for row in investments], dtype=np.int64)
+        position = {investment_id: i for i, investment_id in enumerate(self.investment_ids.tolist())}
+
+        count = len(transactions)
+        self.index = np.fromiter((position[row[0]] for row in transactions), dtype=np.int64, count=count)
+        self.dates = np.array([row[2] for row in transactions], dtype='datetime64[D]').reshape(count)
+        volume = np.fromiter((row[3] for row in transactions), dtype=np.float64, count=count)
+        price = np.fromiter((row[4] for row in transactions), dtype=np.float64, count=count)
+        inflow = np.fromiter((row[1] in TransactionType.INFLOWS for row in transactions), dtype=bool, count=count)
+        self.volume = np.where(inflow, volume, -volume)
+        self.amount = np.where(inflow, volume * price, 0.0)
+        sign = np.fromiter((_CASH_FLOW_SIGNS.get(row[1], 0) for row in transactions), dtype=np.float64, count=count)
+        self.flow = sign * volume * price
+        self.currencies = np.array([row[5] for row in transactions], dtype=object)
+
+    @classmethod
+    def load(cls, portfolios, until=None):
+        """Loads the ledger of all investments of the given portfolios with two queries.
+
+        :param portfolios: portfolio, portfolio id or collection / queryset of them
+        :param until: only transactions executed on or before this date are loaded
+        :return: the loaded ledger
+        """
+        portfolio_ids = object_ids(portfolios)
+        investments = list(
+            Investment.objects.filter(portfolio__in=portfolio_ids).order_by('id')
+            .values_list('id', 'portfolio_id', 'asset_id'))
+        transactions = Transaction.objects.filter(investment__portfolio__in=portfolio_ids)
+        if until is not None:
+            transactions = transactions.filter(transaction_date__lte=local_date(until))
+        transactions = list(
+            transactions.order_by('investment_id', 'transaction_date', 'id')
+            .values_list('investment_id', 'transaction_type', 'transaction_date', 'volume', 'share_price__price',
+                         'share_price__price_currency'))
+        return cls(investments, transactions)
+
+    def convert(self, rates):
+        """Converts the amounts and cash flows of all transactions at their transaction date.
+
+        :param rates: RateTable of the target currency
+        :raises MissingRateError: if no rate of a transaction's currency is known at its date
+        """
+        factors = rates.lookup(self.currencies, self.dates, strict=True)
+        self.amount = self.amount * factors
+        self.flow = self.flow * factors
+        self.currencies = np.full(len(self.currencies), rates.target, dtype=object)
+
+    def positions(self):
+        """Computes holdings and cost basis after each transaction.
+
+        :return: tuple of arrays (holdings, cost basis) aligned with the transactions
+        """
+        starts = np.ones(len(self.index), dtype=bool)
+        starts[1:] = self.index[1:] != self.index[:-1]
+        return average_cost(starts, self.volume, self.amount)
+
+    def final_positions(self):
+        """Computes the current holding and cost basis of every investment.
+
+        :return: tuple of arrays (holdings, cost basis) aligned with investment_ids
+        """
+        holdings, cost = self.positions()
+        volume = np.zeros(len(self.investment_ids))
+        cost_basis = np.zeros(len(self.investment_ids))
+        if len(self.index):
+            last = np.ones(len(self.index), dtype=bool)
+            last[:-1] = self.index[1:] != self.index[:-1]
+            volume[self.index[last]] = holdings[last]
+            cost_basis[self.index[last]] = cost[last]
+        return volume, cost_basis
+
+    def last_dates(self):
+        """Returns the date of the latest transaction of every investment.
+
+        :return: array of datetime64[D] aligned with investment_ids, NaT for investments without transactions
+        """
+        dates = np.full(len(self.investment_ids), np.datetime64('NaT'), dtype='datetime64[D]')
+        if len(self.index):
+            last = np.ones(len(self.index), dtype=bool)
+            last[:-1] = self.index[1:] != self.index[:-1]
+            dates[self.index[last]] = self.dates[last]
+        return dates
+
+
+class Valuation:
+    """Valuation of a set of investments at a point in time.
+
+    :ivar date: date of the valuation
+    :ivar investment_ids: ids of the valued investments
+    :ivar portfolio_ids: portfolio id of each investment
+    :ivar asset_ids: asset id of each investment
+    :ivar volume: number of shares held per investment
+    :ivar cost_basis: average cost basis per investment
+    :ivar price: latest share price per investment, NaN if no price is known
+    :ivar currency: currency code of the latest share price per investment
+    :ivar market_value: market value per investment, zero if no price is known
+    """
+
+    def __init__(self, date, ledger, prices):
+        self.date = date
+        self.investment_ids = ledger.investment_ids
+        self.portfolio_ids = ledger.portfolio_ids
+        self.asset_ids = ledger.asset_ids
+        self.volume, self.cost_basis = ledger.final_positions()
+        self.price = np.array([prices.get(asset_id, (np.nan, ''))[0] for asset_id in self.asset_ids.tolist()])
+        self.currency = [prices.get(asset_id, (0, ''))[1] for asset_id in self.asset_ids.tolist()]
+        self.market_value = np.nan_to_num(self.volume * self.price)
+
+    def by_investment(self):
+        """Returns the valuation of each investment.
+
+        :return: dictionary mapping investment ids to dictionaries of volume, cost_basis, price and market_value
+        """
+        return {
+            investment_id: {
+                'volume': self.volume[i],
+                'cost_basis': self.cost_basis[i],
+                'price': self.price[i],
+                'currency': self.currency[i],
+                'market_value': self.market_value[i],
+            }
+            for i, investment_id in enumerate(self.investment_ids.tolist())
+        }
+
+    def by_portfolio(self):
+        """Aggregates cost basis and market value per portfolio.
+
+        :return: dictionary mapping portfolio ids to dictionaries of cost_basis and market_value
+        """
+        portfolio_ids, index = np.unique(self.portfolio_ids, return_inverse=True)
+        cost_basis = np.bincount(index, weights=self.cost_basis, minlength=len(portfolio_ids))
+        market_value = np.bincount(index, weights=self.market_value, minlength=len(portfolio_ids))
+        return {
+            portfolio_id: {'cost_basis': cost_basis[i], 'market_value': market_value[i]}
+            for i, portfolio_id in enumerate(portfolio_ids.tolist())
+        }
+
+
+def value_portfolios(portfolios, date=None, currency=None):
+    """Values all investments of the given portfolios with three queries, four if converted to a currency.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them
+    :param date: date or datetime of the valuation, defaults to now
+    :param currency: currency code all amounts are converted to, by default amounts are not converted
+    :return: Valuation of all investments
+    :raises MissingRateError: if an amount can't be converted to the currency
+    """
+    if date is None:
+        date = timezone.now()
+    ledger = Ledger.load(portfolios, until=date)
+    prices = {
+        asset_id: (float(price), price_currency)
+        for asset_id, (price, price_currency) in latest_prices(set(ledger.asset_ids.tolist()), date).items()
+    }
+    if currency is not None:
+        day = local_date(date)
+        first = ledger.dates.min().item() if len(ledger.dates) else day
+        rates = RateTable.load(
+            currency, set(ledger.currencies.tolist()) | {price_currency for _, price_currency in prices.values()},
+            min(first, day), day)
+        ledger.convert(rates)
+        asset_ids = list(prices)
+        converted = rates.convert([prices[asset_id][0] for asset_id in asset_ids],
+                                  [prices[asset_id][1] for asset_id in asset_ids], [day] * len(asset_ids), strict=True)
+        prices = {asset_id: (price, currency) for asset_id, price in zip(asset_ids, converted.tolist())}
+    return Valuation(date, ledger, prices)
+
+
+class ValueHistory:
+    """Daily market values of a set of investments over a date range.
+
+    Share prices are carried forward to days without a price.
+
+    :ivar dates: days of the range as datetime64[D]
+    :ivar investment_ids: ids of the valued investments
+    :ivar portfolio_ids: portfolio id of each investment
+    :ivar volume: matrix of holdings with one row per investment and one column per day
+    :ivar values: matrix of market values with one row per investment and one column per day
+    :ivar flows: matrix of external cash flows with one row per investment and one column per day, flows before the
+        range are accumulated in the first day
+    """
+
+    def __init__(self, dates, ledger, volume, values, flows):
+        self.dates = dates
+        self.investment_ids = ledger.investment_ids
+        self.portfolio_ids = ledger.portfolio_ids
+        self.volume = volume
+        self.values = values
+        self.flows = flows
+
+    def aggregate(self, matrix):
+        """Sums the rows of a matrix aligned with investment_ids per portfolio.
+
+        :param matrix: matrix with one row per investment
+        :return: tuple of (sorted portfolio ids, matrix with one row per portfolio)
+        """
+        portfolio_ids, index = np.unique(self.portfolio_ids, return_inverse=True)
+        totals = np.zeros((len(portfolio_ids),) + matrix.shape[1:])
+        np.add.at(totals, index, matrix)
+        return portfolio_ids, totals
+
+    def by_portfolio(self):
+        """Aggregates the daily market values per portfolio.
+
+        :return: dictionary mapping portfolio ids to arrays of daily market values
+        """
+        portfolio_ids, totals = self.aggregate(self.values)
+        return {portfolio_id: totals[i] for i, portfolio_id in enumerate(portfolio_ids.tolist())}
+
+
+def price_matrix(asset_ids, start, end, rates=None):
+    """Loads daily share prices of assets into a matrix with two queries.
+
+    Prices are read from the database and the price archive (see portfolio.archive). The latest price on or before
+    start is used for the first day, later days carry the last known price forward.
+
+    :param asset_ids: sequence of asset ids, one row per asset
+    :param start: first day of the range
+    :param end: last day of the range
+    :param rates: RateTable converting each price at its day, by default prices are not converted
+    :return: tuple of (days as datetime64[D], matrix of prices with NaN for days before the first known price)
+    :raises MissingRateError: if a price can't be converted
+    """
+    start, end = local_date(start), local_date(end)
+    dates = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+    row = {asset_id: i for i, asset_id in enumerate(asset_ids)}
+    prices = np.full((len(row), len(dates)), np.nan)
+    if not row or not len(dates):
+        return dates, prices
+
+    history = price_history(list(row), day_start(start), day_start(end + datetime.timedelta(days=1)))
+    # the beginning of each day, prices before the first day belong to it
+    boundaries = np.array([to_datetime64(day_start(day)) for day in dates.tolist()])
+    rows, columns, amounts, currencies = [], [], [], []
+    for asset_id, series in history.items():
+        rows.append(np.full(len(series), row[asset_id]))
+        columns.append(np.clip(np.searchsorted(boundaries, series.dates, side='right') - 1, 0, None))
+        amounts.append(series.prices)
+        currencies.append(series.currencies)
+    if not rows:
+        return dates, prices
+    rows, columns, amounts = np.concatenate(rows), np.concatenate(columns), np.concatenate(amounts)
+
+    if rates is not None:
+        amounts = rates.convert(amounts, np.concatenate(currencies).astype(str), dates[columns], strict=True)
+    # later prices of the same day overwrite earlier ones as fancy assignment keeps the last value
+    prices[rows, columns] = amounts
+
+    # carry the last known price forward by propagating the column index of the last valid entry
+    known = np.where(np.isnan(prices), 0, np.arange(len(dates)))
+    np.maximum.accumulate(known, axis=1, out=known)
+    return dates, prices[np.arange(len(row))[:, np.newaxis], known]
+
+
+def value_history(portfolios, start, end, currency=None):
+    """Computes daily market values of all investments of the given portfolios with four queries.
+
+    :param portfolios: portfolio, portfolio id or collection / queryset of them
+    :param start: first day of the range
+    :param end: last day of the range
+    :param currency: currency code all amounts are converted to with one additional query, by default amounts are not
+        converted
+    :return: ValueHistory of all investments
+    :raises MissingRateError: if an amount can't be converted to the currency
+    """
+    start, end = local_date(start), local_date(end)
+    ledger = Ledger.load(portfolios, until=end)
+    rates = None
+    if currency is not None:
+        first = ledger.dates.min().item() if len(ledger.dates) else start
+        rates = RateTable.load(currency, None, min(first, start), end)
+        ledger.convert(rates)
+    asset_ids = sorted(set(ledger.asset_ids.tolist()))
+    dates, prices = price_matrix(asset_ids, start, end, rates)
+
+    # add each transaction's volume change at its day, earlier transactions at the first day, and accumulate
+    deltas = np.zeros((len(ledger.investment_ids), len(dates)))
+    flows = np.zeros_like(deltas)
+    if len(dates):
+        days = np.clip((ledger.dates - dates[0]).astype(np.int64), 0, None)
+        np.add.at(deltas, (ledger.index, days), ledger.volume)
+        np.add.at(flows, (ledger.index, days), ledger.flow)
+    volume = np.cumsum(deltas, axis=1)
+
+    asset_row = np.searchsorted(asset_ids, ledger.asset_ids)
+    values = np.nan_to_num(volume * prices[asset_row]) if asset_ids else volume
+    return ValueHistory(dates, ledger, volume, values, flows)
@@ -1,12 +1,182 @@
 """Views representing the user interface of the portfolio app."""
+import itertools
+import json
+
+from django.core.cache.utils import make_template_fragment_key
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 from django.views import generic
 
-from portfolio.models import Investment
+from portfolio.dashboard import iter_summaries
+from portfolio.exports import CONTENT_TYPES, EXPORT_FORMATS, export_prices, export_transactions
+from portfolio.models import Asset, Investment
+from portfolio.page_cache import get_backend, get_options, page_key
+from portfolio.price_cache import get_price_cache
 
 
 class IndexView(generic.ListView):
+    """Paginated overview of all investments grouped by portfolio.
+
+    Independent of the number of investments a page is rendered with at most four queries: the count of the
+    paginator, the investments joined with their portfolio and holding, their assets downcast to stocks, bonds and funds
+    (see AssetQuerySet.polymorphic), and the latest prices of the assets unless all of them are cached.
+
+    If the page cache is enabled (see portfolio.page_cache), pages are answered from the cache without any query until
+    a portfolio changes. Then only the investments of portfolios whose version changed are priced and rendered, the
+    fragments of the others are taken from the cache.
+    """
+
     template_name = 'portfolio/index.html'
     context_object_name = 'investment_list'
+    paginate_by = 50
+
+    def get(self, request, *args, **kwargs):
+        backend = get_backend()
+        if backend is None:
+            return super().get(request, *args, **kwargs)
+        # the key is computed before any data is read, so a concurrent change discards the page
+        key = page_key(backend, 'index', request.get_full_path(), get_language(), timezone.localdate())
+        content = backend.get(key)
+        if content is not None:
+            return HttpResponse(content)
+
+        def store(response):
+            if response.status_code == 200:
+                backend.set(key, response.content, get_options()['TIMEOUT'])
+        response = super().get(request, *args, **kwargs)
+        response.add_post_render_callback(store)
+        return response
 
     def get_queryset(self):
-        return Investment.objects.all()
+        return Investment.objects.select_related('portfolio', 'holding').prefetch_related(
+            Prefetch('asset', queryset=Asset.objects.polymorphic()),
+        ).order_by('portfolio__name', 'portfolio_id', 'asset__name', 'id')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        date = timezone.localdate()
+        groups = []
+        by_portfolio = itertools.groupby(context['investment_list'], key=lambda investment: investment.portfolio_id)
+        for _, investments in by_portfolio:
+            investments = list(investments)
+            portfolio = investments[0].portfolio
+            groups.append({
+                'portfolio': portfolio,
+                'investments': investments,
+                'fragment': '{}:{}:{}:{}'.format(
+                    portfolio.pk, portfolio.version, date, ','.join(str(investment.pk) for investment in investments)),
+            })
+
+        backend = get_backend()
+        if backend is not None:
+            keys = {make_template_fragment_key('portfolio_investments', [group['fragment']]): group for group in groups}
+            for key, html in backend.get_many(list(keys)).items():
+                keys[key]['html'] = mark_safe(html)
+            context['fragment_cache'] = {'backend': get_options()['BACKEND'], 'timeout': get_options()['TIMEOUT']}
+        context['portfolio_groups'] = groups
+
+        investments = [investment for group in groups if 'html' not in group for investment in group['investments']]
+        prices = get_price_cache().get_prices({investment.asset_id for investment in investments}, date)
+        for investment in investments:
+            investment.latest_price = prices.get(investment.asset_id)
+            try:
+                volume = investment.holding.volume
+            except ObjectDoesNotExist:
+                volume = None
+            if investment.latest_price is not None and volume is not None:
+                investment.market_value = investment.latest_price * volume
+            else:
+                investment.market_value = None
+        return context
+
+
+class ExportView(generic.View):
+    """Streams an export as CSV or JSON file.
+
+    The query parameters portfolio and asset may be repeated to filter by portfolio respectively asset ids, start and
+    end restrict the date range (YYYY-MM-DD) and format selects csv (default) or json. The response is streamed while
+    rows are fetched from the database, so memory usage doesn't depend on the size of the export.
+
+    :cvar export: function producing the export (see portfolio.exports)
+    :cvar filename: name of the downloaded file without extension
+    """
+
+    export = None
+    filename = None
+
+    def get(self, request):
+        file_format = request.GET.get('format', 'csv')
+        if file_format not in EXPORT_FORMATS:
+            return HttpResponseBadRequest('Unknown format: {}'.format(file_format))
+        try:
+            filters = {
+                'portfolios': [int(value) for value in request.GET.getlist('portfolio')] or None,
+                'assets': [int(value) for value in request.GET.getlist('asset')] or None,
+                'start': self.parse_date(request.GET.get('start')),
+                'end': self.parse_date(request.GET.get('end')),
+            }
+        except ValueError as error:
+            return HttpResponseBadRequest('Invalid filter: {}'.format(error))
+
+        response = StreamingHttpResponse(self.export(file_format, **filters), content_type=CONTENT_TYPES[file_format])
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(self.filename, file_format)
+        return response
+
+    @staticmethod
+    def parse_date(value):
+        """Parses an optional date query parameter.
+
+        :param value: ISO 8601 formatted date or None
+        :return: the date or None
+        :raises ValueError: if the value is not a valid date
+        """
+        if not value:
+            return None
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(value)
+        return date
+
+
+class TransactionExportView(ExportView):
+    """Streams the transactions of all or selected portfolios and assets."""
+
+    export = staticmethod(export_transactions)
+    filename = 'transactions'
+
+
+class SharePriceExportView(ExportView):
+    """Streams the share price histories of all or selected portfolios and assets."""
+
+    export = staticmethod(export_prices)
+    filename = 'prices'
+
+
+class DashboardView(generic.View):
+    """Streams summaries of all or selected portfolios as JSON lines.
+
+    The query parameter portfolio may be repeated to select portfolio ids, date (YYYY-MM-DD) sets the valuation date
+    and currency converts all amounts into a currency. Portfolios are summarized concurrently and each summary is sent
+    as soon as it is complete (see portfolio.dashboard), so the order of the lines is undefined.
+    """
+
+    def get(self, request):
+        try:
+            portfolios = [int(value) for value in request.GET.getlist('portfolio')] or None
+            date = ExportView.parse_date(request.GET.get('date'))
+        except ValueError as error:
+            return HttpResponseBadRequest('Invalid filter: {}'.format(error))
+        currency = request.GET.get('currency') or None
+        if currency is not None and not (len(currency) == 3 and currency.isalpha()):
+            return HttpResponseBadRequest('Invalid currency: {}'.format(currency))
+
+        summaries = iter_summaries(portfolios, date, currency and currency.upper())
+        return StreamingHttpResponse(
+            (json.dumps(summary, cls=DjangoJSONEncoder) + '\n' for summary in summaries),
+            content_type='application/x-ndjson')
@@ -15,8 +15,9 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        'Django~=2.0',
+        'Django~=2.2',
         'django-money~=0.12',
+        'numpy>=1.13',
     ],
     url='https://github.com/ferraith/django-portfolio',
     license='MIT License',
@@ -29,7 +30,7 @@ setup(
         'Development Status :: 1 - Planing',
         'Environment :: Web Environment',
         'Framework :: Django',
-        'Framework :: Django :: 2.0',
+        'Framework :: Django :: 2.2',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',